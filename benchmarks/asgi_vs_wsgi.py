@@ -0,0 +1,57 @@
+"""
+Compare the read endpoints served by sync gunicorn (WSGI) against gunicorn with uvicorn workers (ASGI + async views).
+
+The catalog and the user are taken from the database configured by --settings, for example:
+
+    python benchmarks/asgi_vs_wsgi.py --username bench --password bench --concurrency 64 --requests 4000
+"""
+import argparse
+import random
+import sys
+
+from loadgen import RequestSpec, obtain_token, run_load, run_server
+
+MODES = {
+    'wsgi': (['image_backend.wsgi:application'], {'ASYNC_READ_VIEWS': 'False'}),
+    'asgi': (['image_backend.asgi:application', '-k', 'uvicorn_worker.UvicornWorker'], {'ASYNC_READ_VIEWS': 'True'}),
+}
+
+
+def endpoint_requests(image_ids):
+
+    def make_request(i):
+        choice = i % 3
+        if choice == 0:
+            return RequestSpec('GET', '/image_api/image/?limit=20&random=true')
+        elif choice == 1 and image_ids:
+            return RequestSpec('GET', f'/image_api/image/{random.choice(image_ids)}/')
+        return RequestSpec('GET', '/image_api/image/tags/')
+
+    return make_request
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--settings', default='image_backend.settings')
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-image-id', type=int, default=100, help='Retrieve ids are drawn from 1..N')
+    args = parser.parse_args(argv)
+
+    headers = {'Authorization': f'Bearer {obtain_token(args.username, args.password, args.settings)}'}
+    make_request = endpoint_requests(list(range(1, args.max_image_id + 1)))
+
+    for mode, (app_args, env) in MODES.items():
+        command = ['gunicorn', *app_args, '--workers', str(args.workers), '--bind', f'127.0.0.1:{args.port}']
+        with run_server(command, args.port, args.settings, env) as base_url:
+            # warm up connections and caches before measuring
+            run_load(mode, base_url, make_request, args.concurrency, args.concurrency, headers)
+            print(run_load(mode, base_url, make_request, args.requests, args.concurrency, headers))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""
+Store benchmark results as JSON baselines and compare later runs against them.
+
+A baseline file maps a case name to a dict of metrics. Each metric is compared in its own direction:
+metrics listed in HIGHER_IS_BETTER regress when they drop, every other numeric metric regresses when it grows.
+A change regresses when it is beyond the relative tolerance and the metric's ABSOLUTE_FLOORS, so noise on tiny
+values (a 2ms case, 0.1MB of RSS) doesn't fail the run. Any error above the baseline count is a regression.
+"""
+import json
+import os
+from typing import Dict, List
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+HIGHER_IS_BETTER = {'rps'}
+IGNORED_METRICS = {'requests'}
+# smallest change of a metric that counts as a regression, whatever the tolerance
+ABSOLUTE_FLOORS = {
+    'wall_ms': 10, 'p50_ms': 5, 'p95_ms': 10, 'p99_ms': 20, 'rps': 5, 'peak_rss_mb': 5, 'output_bytes': 1024,
+}
+
+
+def baseline_path(name: str) -> str:
+    return os.path.join(BASELINE_DIR, f'{name}.json')
+
+
+def has_baseline(name: str) -> bool:
+    return os.path.exists(baseline_path(name))
+
+
+def load_baseline(name: str) -> Dict[str, dict]:
+    with open(baseline_path(name)) as f:
+        return json.load(f)
+
+
+def save_baseline(name: str, results: Dict[str, dict]) -> str:
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    path = baseline_path(name)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+    return path
+
+
+def compare(baseline: Dict[str, dict], results: Dict[str, dict], tolerance: float) -> List[str]:
+    """Return a description of every metric worse than the baseline by more than `tolerance` (0.2 = 20%)."""
+    regressions = []
+    for case, metrics in results.items():
+        for metric, value in metrics.items():
+            expected = baseline.get(case, {}).get(metric)
+            if metric in IGNORED_METRICS or not isinstance(expected, (int, float)):
+                continue
+            worse = expected - value if metric in HIGHER_IS_BETTER else value - expected
+            allowed = 0 if metric == 'errors' else max(tolerance * expected, ABSOLUTE_FLOORS.get(metric, 0))
+            if worse > allowed:
+                change = f' ({(value - expected) / expected:+.0%})' if expected else ''
+                regressions.append(f'{case}.{metric}: {expected} -> {value}{change}')
+    return regressions
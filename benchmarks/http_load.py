@@ -0,0 +1,176 @@
+"""
+HTTP load test for the image API.
+
+Seeds a synthetic catalog with the seed_catalog management command, starts the app under gunicorn
+(or targets an already running server), drives every scenario concurrently and reports RPS and
+p50/p95/p99 latency. Results can be stored as a baseline and later runs fail when they regress:
+
+    python benchmarks/http_load.py --seed-images 5000 --seed-tags 200 --save-baseline
+    python benchmarks/http_load.py --no-seed --tolerance 0.2
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import uuid
+from datetime import date, timedelta
+from io import BytesIO
+
+from PIL import Image
+
+from baseline import (baseline_path, compare, has_baseline, load_baseline,
+                      save_baseline)
+from loadgen import RequestSpec, manage_py, obtain_token, run_load, run_server
+
+SERVERS = {
+    'wsgi': (['image_backend.wsgi:application'], {'ASYNC_READ_VIEWS': 'False'}),
+    'asgi': (['image_backend.asgi:application', '-k', 'uvicorn_worker.UvicornWorker'], {'ASYNC_READ_VIEWS': 'True'}),
+}
+# the upload scenario measures processing, not the per-user rates and processing slots turning it away
+BENCH_ENV = {'API_THROTTLING': 'False', 'PROCESSING_CONCURRENCY': '0'}
+READ_SCENARIOS = ['list_page', 'list_tag', 'list_date_range', 'list_random', 'retrieve']
+WRITE_SCENARIOS = ['upload', 'delete']
+
+
+def seed(args):
+    output = manage_py('seed_catalog', '--images', str(args.seed_images), '--tags', str(args.seed_tags),
+                       '--user', args.username, '--password', args.password, settings=args.settings)
+    match = re.search(r'ids (\d+)-(\d+)', output)
+    if not match:
+        raise RuntimeError(f'Unexpected seed_catalog output: {output.strip()}')
+    return int(match.group(1)), int(match.group(2))
+
+
+def multipart_body(image_bytes):
+    boundary = uuid.uuid4().hex
+    fields = [('title', b'Bench upload'), ('tags[]', b'bench-upload')]
+    parts = [
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode() + value + b'\r\n'
+        for name, value in fields
+    ]
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="bench.jpg"\r\n'
+        f'Content-Type: image/jpeg\r\n\r\n'.encode() + image_bytes + b'\r\n'
+    )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+
+
+def upload_image(size):
+    output = BytesIO()
+    Image.effect_noise(size, 64).convert('RGB').save(output, 'jpeg', quality=90)
+    return output.getvalue()
+
+
+def build_scenarios(args, first_id, last_id):
+    rng = random.Random(args.random_seed)
+    today = date.today()
+    body, upload_headers = multipart_body(upload_image((args.upload_width, args.upload_height)))
+    uploaded_ids = []
+    lock = threading.Lock()
+
+    def date_range(_):
+        after = today - timedelta(days=rng.randint(30, 365))
+        before = after + timedelta(days=30)
+        return RequestSpec('GET', f'/image_api/image/?created_date__after={after}&created_date__before={before}&limit=20')
+
+    def collect_id(status, response_body):
+        with lock:
+            uploaded_ids.append(json.loads(response_body)['id'])
+
+    scenarios = {
+        'list_page': (lambda _: RequestSpec('GET', f'/image_api/image/?limit=20&offset={rng.randint(0, 500)}'), None),
+        'list_tag': (lambda _: RequestSpec(
+            'GET', f'/image_api/image/?tags=bench-tag-{rng.randrange(max(args.seed_tags, 1))}&limit=20'), None),
+        'list_date_range': (date_range, None),
+        'list_random': (lambda _: RequestSpec('GET', '/image_api/image/?random=true&limit=20'), None),
+        'retrieve': (lambda _: RequestSpec('GET', f'/image_api/image/{rng.randint(first_id, last_id)}/'), None),
+        'upload': (lambda _: RequestSpec('POST', '/image_api/image/upload/', body, upload_headers), collect_id),
+        'delete': (lambda i: RequestSpec('DELETE', f'/image_api/image/{uploaded_ids[i]}/delete'), None),
+    }
+    return scenarios, uploaded_ids
+
+
+def run_scenarios(args, base_url, first_id, last_id):
+    headers = {'Authorization': f'Bearer {obtain_token(args.username, args.password, args.settings)}'}
+    scenarios, uploaded_ids = build_scenarios(args, first_id, last_id)
+    results = {}
+
+    for name in args.scenarios:
+        make_request, on_response = scenarios[name]
+        # deletes remove exactly the images created by the upload scenario
+        total = len(uploaded_ids) if name == 'delete' else args.requests
+        if not total:
+            continue
+        if name in READ_SCENARIOS:
+            run_load(name, base_url, make_request, args.concurrency, args.concurrency, headers)
+        elif name == 'upload':
+            # creates the upload tag alone, concurrent first uploads would each insert one (Tag.name isn't unique)
+            run_load(name, base_url, make_request, 1, 1, headers, on_response)
+        result = run_load(name, base_url, make_request, total, args.concurrency, headers, on_response)
+        print(result)
+        results[name] = result.as_dict()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--settings', default='image_backend.settings')
+    parser.add_argument('--server', choices=[*SERVERS, 'external'], default='wsgi')
+    parser.add_argument('--base-url', help='Server to target with --server external, run it with the BENCH_ENV variables')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=500, help='Requests per scenario')
+    parser.add_argument('--scenarios', nargs='+', choices=READ_SCENARIOS + WRITE_SCENARIOS,
+                        default=READ_SCENARIOS + WRITE_SCENARIOS)
+    parser.add_argument('--seed-images', type=int, default=2000)
+    parser.add_argument('--seed-tags', type=int, default=100)
+    parser.add_argument('--no-seed', action='store_true', help='Reuse the catalog seeded by a previous run')
+    parser.add_argument('--first-id', type=int, default=1, help='Retrieve id range with --no-seed')
+    parser.add_argument('--last-id', type=int, default=1000, help='Retrieve id range with --no-seed')
+    parser.add_argument('--upload-width', type=int, default=1600)
+    parser.add_argument('--upload-height', type=int, default=1200)
+    parser.add_argument('--username', default='bench')
+    parser.add_argument('--password', default='bench')
+    parser.add_argument('--random-seed', type=int, default=0)
+    parser.add_argument('--baseline', default='http_load', help='Baseline name under benchmarks/baselines')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed regression ratio against the baseline')
+    args = parser.parse_args(argv)
+    if not args.save_baseline and not has_baseline(args.baseline):
+        # without one every run would pass
+        parser.error(f'no baseline at {baseline_path(args.baseline)}, record one with --save-baseline')
+
+    first_id, last_id = (args.first_id, args.last_id) if args.no_seed else seed(args)
+
+    if args.server == 'external':
+        if not args.base_url:
+            parser.error('--base-url is required with --server external')
+        results = run_scenarios(args, args.base_url, first_id, last_id)
+    else:
+        app_args, env = SERVERS[args.server]
+        command = ['gunicorn', *app_args, '--workers', str(args.workers), '--bind', f'127.0.0.1:{args.port}']
+        with run_server(command, args.port, args.settings, {**BENCH_ENV, **env}) as base_url:
+            results = run_scenarios(args, base_url, first_id, last_id)
+
+    failed = [name for name, stats in results.items() if stats['errors']]
+    if failed:
+        # latencies of a run answered with errors (e.g. 429s) are not comparable, nor worth a baseline
+        print(f"ERRORS in {', '.join(failed)}")
+        return 1
+
+    if args.save_baseline:
+        print(f'Baseline saved to {save_baseline(args.baseline, results)}')
+        return 0
+
+    regressions = compare(load_baseline(args.baseline), results, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
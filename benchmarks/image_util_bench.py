@@ -0,0 +1,183 @@
+"""
+Micro-benchmarks for ImageUtil over generated PNG/JPEG/WebP inputs from small images up to 50MP.
+
+Every (operation, format, size) case runs in a fresh process so its peak RSS is measured in isolation.
+Reports median wall time, peak RSS growth and output size, and compares against a stored baseline.
+Encoding operations run once per encoder profile, to compare the CPU/bytes trade-off of each:
+
+    python benchmarks/image_util_bench.py --save-baseline
+    python benchmarks/image_util_bench.py --sizes small medium --formats jpeg --tolerance 0.15
+    python benchmarks/image_util_bench.py --operations PIL_to_bytes --profiles fast max-compression
+"""
+import argparse
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from PIL import Image
+
+from baseline import (baseline_path, compare, has_baseline, load_baseline,
+                      save_baseline)
+from loadgen import PROJECT_DIR
+
+SIZES = {
+    'small': (640, 480),
+    'medium': (1920, 1080),
+    'large': (4000, 3000),
+    'xlarge': (8660, 5774),  # 50MP
+}
+FORMATS = ['png', 'jpeg', 'webp']
+OPERATIONS = ['open_image', 'convert_image_type', 'reduce_image_size', 'optimize_image_bytes_size', 'PIL_to_bytes']
+ENCODING_OPERATIONS = {'optimize_image_bytes_size', 'PIL_to_bytes'}
+PROFILES = ['fast', 'balanced', 'max-compression']  # image_api.util.image_util.ENCODER_PROFILES
+
+
+def generate_input(size, file_ext, directory):
+    """Smooth photo-like content with some noise, so encoders see realistic entropy."""
+    path = os.path.join(directory, f'{size[0]}x{size[1]}.{file_ext}')
+    if not os.path.exists(path):
+        base = Image.effect_noise((32, 24), 100).convert('RGB').resize(size, Image.BICUBIC)
+        noise = Image.effect_noise(size, 20).convert('RGB')
+        Image.blend(base, noise, 0.15).save(path, file_ext.upper(), quality=90)
+    return path
+
+
+def read_proc_status(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def reset_peak_rss():
+    """Reset the kernel's RSS high-water mark (Linux), returns the current RSS in bytes or None when unsupported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return read_proc_status('VmRSS')
+    except OSError:
+        return None
+
+
+def peak_rss_since(rss_before):
+    if rss_before is None:
+        # ru_maxrss is reported in KiB on Linux and only tracks the process lifetime peak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return read_proc_status('VmHWM') - rss_before
+
+
+def convert_target(file_ext):
+    return 'jpeg' if file_ext == 'webp' else 'webp'
+
+
+def run_case(operation, path, file_ext, repeat, profile=None):
+    """Executed in a child process, returns (wall times, peak RSS growth in bytes, output size)."""
+    sys.path.insert(0, PROJECT_DIR)
+    from image_api.util.image_util import ImageUtil
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    def prepare():
+        if operation in ('reduce_image_size', 'PIL_to_bytes'):
+            image = ImageUtil.open_image(data)
+            image.load()
+            return image
+        return data
+
+    def execute(arg):
+        if operation == 'open_image':
+            image = ImageUtil.open_image(arg)
+            image.load()
+            return None
+        if operation == 'convert_image_type':
+            image = ImageUtil.convert_image_type(arg, convert_target(file_ext))
+            image.load()
+            return None
+        if operation == 'reduce_image_size':
+            ImageUtil.reduce_image_size(arg)
+            return None
+        if operation == 'optimize_image_bytes_size':
+            return ImageUtil.optimize_image_bytes_size(
+                arg, convert_target(file_ext), profile=profile).getbuffer().nbytes
+        return ImageUtil.PIL_to_bytes(arg, file_ext, profile=profile).getbuffer().nbytes
+
+    times = []
+    peak_growth = 0
+    output_size = None
+    for _ in range(repeat):
+        arg = prepare()
+        rss_before = reset_peak_rss()
+        start = time.perf_counter()
+        output_size = execute(arg)
+        times.append(time.perf_counter() - start)
+        peak_growth = max(peak_growth, peak_rss_since(rss_before))
+        del arg
+    return times, peak_growth, output_size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', choices=SIZES, default=list(SIZES))
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=FORMATS)
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=OPERATIONS)
+    parser.add_argument('--profiles', nargs='+', choices=PROFILES, default=PROFILES,
+                        help='Encoder profiles of the encoding operations')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--input-dir', help='Directory to cache generated inputs (default: a temp dir)')
+    parser.add_argument('--baseline', default='image_util', help='Baseline name under benchmarks/baselines')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed regression ratio against the baseline')
+    args = parser.parse_args(argv)
+    if not args.save_baseline and not has_baseline(args.baseline):
+        # without one every run would pass
+        parser.error(f'no baseline at {baseline_path(args.baseline)}, record one with --save-baseline')
+
+    input_dir = args.input_dir or tempfile.mkdtemp(prefix='image_util_bench_')
+    os.makedirs(input_dir, exist_ok=True)
+    context = get_context('spawn')
+    results = {}
+
+    print(f"{'case':<56} {'median ms':>10} {'peak RSS MB':>12} {'output KB':>10}")
+    for size_name in args.sizes:
+        for file_ext in args.formats:
+            path = generate_input(SIZES[size_name], file_ext, input_dir)
+            cases = [
+                (operation, profile)
+                for operation in args.operations
+                for profile in (args.profiles if operation in ENCODING_OPERATIONS else [None])
+            ]
+            for operation, profile in cases:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    times, peak_growth, output_size = executor.submit(
+                        run_case, operation, path, file_ext, args.repeat, profile).result()
+
+                case = f'{operation}/{file_ext}/{size_name}' + (f'/{profile}' if profile else '')
+                results[case] = {
+                    'wall_ms': round(statistics.median(times) * 1000, 2),
+                    'peak_rss_mb': round(peak_growth / 1024 / 1024, 1),
+                }
+                if output_size is not None:
+                    results[case]['output_bytes'] = output_size
+                output_kb = f'{output_size / 1024:.0f}' if output_size is not None else '-'
+                print(f"{case:<56} {results[case]['wall_ms']:>10.1f} {results[case]['peak_rss_mb']:>12.1f} "
+                      f"{output_kb:>10}")
+
+    if args.save_baseline:
+        print(f'Baseline saved to {save_baseline(args.baseline, results)}')
+        return 0
+
+    regressions = compare(load_baseline(args.baseline), results, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+Small concurrent HTTP load generator shared by the benchmark scripts.
+
+Only the standard library is used so the benchmarks run in the same environment as the app.
+"""
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'image_backend')
+
+
+class RequestSpec(NamedTuple):
+    method: str
+    path: str
+    body: Optional[bytes] = None
+    headers: Optional[Dict[str, str]] = None
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """Nearest-rank percentile of the samples, 0 when there are none."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(int(round(pct / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class LoadResult:
+
+    def __init__(self, name: str, latencies: List[float], errors: int, elapsed: float):
+        self.name = name
+        self.latencies = latencies
+        self.errors = errors
+        self.elapsed = elapsed
+
+    @property
+    def rps(self) -> float:
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'requests': len(self.latencies),
+            'errors': self.errors,
+            'rps': round(self.rps, 2),
+            'p50_ms': round(percentile(self.latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(self.latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(self.latencies, 99) * 1000, 2),
+        }
+
+    def __str__(self):
+        stats = self.as_dict()
+        return (f"{self.name:<32} {stats['requests']:>7} req {stats['errors']:>5} err {stats['rps']:>9.1f} rps  "
+                f"p50 {stats['p50_ms']:>8.1f}ms  p95 {stats['p95_ms']:>8.1f}ms  p99 {stats['p99_ms']:>8.1f}ms")
+
+
+def run_load(name: str, base_url: str, make_request: Callable[[int], RequestSpec],
+             total: int, concurrency: int, headers: Optional[Dict[str, str]] = None,
+             on_response: Optional[Callable[[int, bytes], None]] = None) -> LoadResult:
+    """
+    Send `total` requests built by `make_request(i)` using `concurrency` worker threads.
+
+    Each thread keeps its own keep-alive connection and reconnects when the server closes it.
+    A response is counted as an error when the request fails or its status is 400 or above,
+    successful response bodies are passed to `on_response(status, body)` when given.
+    """
+    url = urlsplit(base_url)
+    local = threading.local()
+    lock = threading.Lock()
+    latencies: List[float] = []
+    errors = [0]
+
+    def send(i):
+        spec = make_request(i)
+        request_headers = dict(headers or {})
+        request_headers.update(spec.headers or {})
+        if not getattr(local, 'conn', None):
+            local.conn = http.client.HTTPConnection(url.hostname, url.port, timeout=60)
+
+        start = time.perf_counter()
+        try:
+            local.conn.request(spec.method, spec.path, body=spec.body, headers=request_headers)
+            response = local.conn.getresponse()
+            body = response.read()
+            failed = response.status >= 400
+            if response.will_close:
+                local.conn.close()
+                local.conn = None
+        except (OSError, http.client.HTTPException):
+            failed = True
+            local.conn.close()
+            local.conn = None
+        elapsed = time.perf_counter() - start
+
+        if on_response and not failed:
+            on_response(response.status, body)
+        with lock:
+            if failed:
+                errors[0] += 1
+            else:
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(total)))
+    return LoadResult(name, latencies, errors[0], time.perf_counter() - start)
+
+
+def manage_py(*args: str, settings: str) -> str:
+    """Run a manage.py command of the project and return its stdout."""
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings)
+    result = subprocess.run([sys.executable, 'manage.py', *args], cwd=PROJECT_DIR, env=env,
+                            check=True, capture_output=True, text=True)
+    return result.stdout
+
+
+def obtain_token(username: str, password: str, settings: str) -> str:
+    """Mint a JWT access token through the generate_token management command."""
+    output = manage_py('generate_token', username, password, settings=settings)
+    if 'Token: ' not in output:
+        raise RuntimeError(output.strip())
+    return output.split('Token: ', 1)[1].strip()
+
+
+def wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Server did not start listening on port {port}')
+
+
+@contextmanager
+def run_server(args: List[str], port: int, settings: str, extra_env: Optional[Dict[str, str]] = None):
+    """Start a server process from the project directory and stop it on exit."""
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings, **(extra_env or {}))
+    process = subprocess.Popen(args, cwd=PROJECT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        yield f'http://127.0.0.1:{port}'
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
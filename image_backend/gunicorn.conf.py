@@ -0,0 +1,39 @@
+"""
+Gunicorn configuration, loaded automatically when gunicorn is started from this directory.
+"""
+import os
+import shutil
+
+from image_backend.workers import current_rss, max_worker_rss
+
+# Workers whose resident memory is above this are replaced (0: never), after a request for the sync and gthread
+# workers, on the heartbeat for image_backend.workers.RecyclingUvicornWorker
+MAX_WORKER_RSS = max_worker_rss()
+
+# Fallback for worker classes without a memory check: replace workers after this many requests (0: never), the
+# jitter keeps them from restarting all at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', '0'))
+
+
+def on_starting(server):
+    # start every deployment with an empty Prometheus multiprocess directory
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_request(worker, req, environ, resp):
+    # only called by the sync and gthread workers, the worker finishes the request then exits and is replaced
+    if MAX_WORKER_RSS and worker.alive:
+        rss = current_rss()
+        if rss > MAX_WORKER_RSS:
+            worker.log.info(f'Worker {worker.pid} uses {rss // 2 ** 20}MB after {req.path}, restarting')
+            worker.alive = False
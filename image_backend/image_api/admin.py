@@ -19,7 +19,7 @@ admin.site.register(ImageInfo, ImageInfoModelAdmin)
 
 
 class TagModelAdmin(admin.ModelAdmin):
-    list_display = ('name', )
+    list_display = ('name', 'image_count')
     search_fields = ('name',)
 
 admin.site.register(Tag, TagModelAdmin)
\ No newline at end of file
@@ -1,4 +1,7 @@
+import PIL.Image
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.models.signals import post_migrate
 
 
 class ImageApiConfig(AppConfig):
@@ -6,4 +9,8 @@ class ImageApiConfig(AppConfig):
     name = "image_api"
 
     def ready(self):
+        import image_api.metrics
         import image_api.signals
+        post_migrate.connect(image_api.signals.create_search_index, sender=self)
+        # PIL warns above this and refuses twice this, for images opened outside ImageProcessor (variants, commands)
+        PIL.Image.MAX_IMAGE_PIXELS = settings.IMAGE_MAX_PIXELS
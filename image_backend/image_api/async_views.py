@@ -0,0 +1,77 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.http import Http404
+from rest_framework.response import Response
+
+from .models import ImageInfo
+from .views import ImageListView, ImageRetrieveView, TagListView
+
+
+class AsyncAPIViewMixin:
+    """
+    Run a DRF view with async handlers.
+
+    DRF's dispatch is sync only, authentication, permission and throttle checks still use the sync ORM
+    so they are run in a thread, the handler itself is awaited on the event loop.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+
+            response = handler(request, *args, **kwargs)
+            # options and method-not-allowed handlers are inherited sync methods
+            if asyncio.iscoroutine(response):
+                response = await response
+
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+
+class AsyncTagListView(AsyncAPIViewMixin, TagListView):
+
+    async def get(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = await sync_to_async(self.paginate_queryset)(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+        tags = [tag async for tag in queryset]
+        serializer = self.get_serializer(tags, many=True)
+        return Response(serializer.data)
+
+
+class AsyncImageListView(AsyncAPIViewMixin, ImageListView):
+
+    async def get(self, request, *args, **kwargs):
+        serializer = self.get_values_serializer()
+        rows = [row async for row in self.filter_queryset(self.get_queryset())]
+        tag_rows = [row async for row in serializer.select_tags(rows)]
+        return Response(serializer.to_representation(rows, tag_rows))
+
+
+class AsyncImageRetrieveView(AsyncAPIViewMixin, ImageRetrieveView):
+
+    async def get(self, request, *args, **kwargs):
+        try:
+            instance = await self.filter_queryset(self.get_queryset()).aget(pk=self.kwargs['pk'])
+        except ImageInfo.DoesNotExist:
+            raise Http404('No ImageInfo matches the given query.')
+        self.check_object_permissions(request, instance)
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
@@ -0,0 +1,52 @@
+import contextvars
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+_read_alias = contextvars.ContextVar('db_read_alias', default=None)
+
+STICKY_CACHE_KEY = 'db_primary_sticky:{user_id}'
+
+
+def replica_alias():
+    """The configured replica database alias, or None when no replica is set up."""
+    alias = getattr(settings, 'DATABASE_REPLICA_ALIAS', 'replica')
+    return alias if alias in settings.DATABASES else None
+
+
+def use_read_alias(alias):
+    """Route reads of the current request/context to `alias` (None routes them to the primary)."""
+    _read_alias.set(alias)
+
+
+def mark_primary_sticky(user):
+    """After a write, read from the primary for a while so the user sees their own changes."""
+    if user and user.is_authenticated:
+        cache.set(STICKY_CACHE_KEY.format(user_id=user.pk), True, settings.DATABASE_REPLICA_STICKY_SECONDS)
+
+
+def is_primary_sticky(user):
+    return bool(user and user.is_authenticated and cache.get(STICKY_CACHE_KEY.format(user_id=user.pk)))
+
+
+class ReplicaRouter:
+    """
+    Send reads to the replica only where a view opted in through `use_read_alias`,
+    everything else (writes, admin, auth, migrations) stays on the default database.
+    """
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        # never fall back to the alias an instance was read from, it may be the replica
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == replica_alias():
+            return False
+        return None
@@ -0,0 +1,41 @@
+import json
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+def _ndjson_lines(serializer, rows, tag_rows):
+    return ''.join(json.dumps(item, separators=(',', ':')) + '\n' for item in serializer.to_representation(rows, tag_rows))
+
+
+def iter_ndjson(queryset, serializer, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield `queryset` as NDJSON, one chunk of lines per `chunk_size` images.
+
+    `queryset` is the `.values()` queryset built by `serializer.select()`, it is read with a server-side
+    cursor on Postgres and only one chunk of rows (with its tags) is held in memory at a time.
+    """
+    rows = []
+    for row in queryset.iterator(chunk_size=chunk_size):
+        rows.append(row)
+        if len(rows) == chunk_size:
+            yield _ndjson_lines(serializer, rows, serializer.select_tags(rows).using(queryset.db))
+            rows = []
+    if rows:
+        yield _ndjson_lines(serializer, rows, serializer.select_tags(rows).using(queryset.db))
+
+
+async def aiter_ndjson(queryset, serializer, chunk_size=EXPORT_CHUNK_SIZE):
+    """Async variant of iter_ndjson, for streaming responses served under ASGI."""
+
+    async def chunk_lines(rows):
+        tag_rows = [row async for row in serializer.select_tags(rows).using(queryset.db)]
+        return _ndjson_lines(serializer, rows, tag_rows)
+
+    rows = []
+    async for row in queryset.aiterator(chunk_size=chunk_size):
+        rows.append(row)
+        if len(rows) == chunk_size:
+            yield await chunk_lines(rows)
+            rows = []
+    if rows:
+        yield await chunk_lines(rows)
@@ -0,0 +1,63 @@
+from datetime import datetime
+
+from rest_framework.exceptions import ValidationError
+
+from .search import search_images
+
+
+class ImageFilter:
+    """
+    Filters of the image list (tags, created date, full-text search) read from query parameters,
+    or any QueryDict built the same way (e.g. by the export command).
+    """
+
+    PARAMS = ['tags', 'tags[]', 'created_date', 'created_date__after', 'created_date__before', 'q']
+
+    def __init__(self, params):
+        self.params = params
+
+    def filter(self, queryset):
+        queryset = self.__filter_by_tags(queryset)
+        queryset = self.__filter_by_created_date(queryset)
+        queryset = self.__filter_by_search(queryset)
+        return queryset
+
+    def is_active(self):
+        return any(self.params.get(name, '').strip() for name in self.PARAMS)
+
+    def __filter_by_tags(self, queryset):
+        tags = self.params.getlist('tags') + self.params.getlist('tags[]')
+        if tags:
+            queryset = queryset.filter(tags__name__in=tags).distinct()
+        return queryset
+
+    def __filter_by_created_date(self, queryset):
+        created_date_exact = self.params.get('created_date')
+        created_date_after = self.params.get('created_date__after')
+        created_date_before = self.params.get('created_date__before')
+
+        if created_date_exact:
+            if created_date_after or created_date_before:
+                raise ValidationError(
+                    "Invalid query parameters. 'created_date' cannot be used with 'created_date__after' or 'created_date__before'."
+                )
+            date = datetime.strptime(created_date_exact, '%Y-%m-%d')
+            queryset = queryset.filter(created_at__date=date)
+
+        if created_date_after and created_date_before:
+            date_after = datetime.strptime(created_date_after, '%Y-%m-%d')
+            date_before = datetime.strptime(created_date_before, '%Y-%m-%d')
+            queryset = queryset.filter(created_at__date__range=[date_after, date_before])
+        elif created_date_after:
+            date = datetime.strptime(created_date_after, '%Y-%m-%d')
+            queryset = queryset.filter(created_at__date__gt=date)
+        elif created_date_before:
+            date = datetime.strptime(created_date_before, '%Y-%m-%d')
+            queryset = queryset.filter(created_at__date__lt=date)
+        return queryset
+
+    def __filter_by_search(self, queryset):
+        search_text = self.params.get('q', '').strip()
+        if search_text:
+            queryset = search_images(queryset, search_text)
+        return queryset
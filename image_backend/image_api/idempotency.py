@@ -0,0 +1,123 @@
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+# the client may succeed by retrying these with the same key, they are not stored
+RETRYABLE_STATUS = (status.HTTP_409_CONFLICT, status.HTTP_429_TOO_MANY_REQUESTS)
+
+# seconds a retry sent while the first request runs is asked to wait
+IDEMPOTENCY_RETRY_AFTER = 1
+
+
+def request_fingerprint(request):
+    """Hash of the method, path, query string and body (uploaded file contents included)."""
+    digest = hashlib.sha256(f'{request.method} {request.get_full_path()}\n'.encode())
+    data = request.data
+    if hasattr(data, 'lists'):
+        for name, values in sorted(data.lists(), key=lambda item: item[0]):
+            for value in values:
+                digest.update(name.encode() + b'\0')
+                if isinstance(value, UploadedFile):
+                    for chunk in value.chunks():
+                        digest.update(chunk)
+                    value.seek(0)
+                else:
+                    digest.update(str(value).encode() + b'\0')
+    else:
+        digest.update(json.dumps(data, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def claim_key(user, key, fingerprint):
+    """
+    (record, claimed) for the IdempotencyKey row of this request, committed before the request runs.
+
+    A new or expired key is claimed: its row is stored pending (no response) until IDEMPOTENCY_PENDING_TIMEOUT,
+    a request that dies before storing its response frees the key then. An unexpired key is returned unclaimed,
+    with the stored response or still pending while another request runs it.
+    """
+    expires_at = timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_PENDING_TIMEOUT)
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(
+                    user=user, key=key, fingerprint=fingerprint, expires_at=expires_at
+                )
+            return record, True
+        except IntegrityError:
+            pass
+
+        record = IdempotencyKey.objects.select_for_update().get(user=user, key=key)
+        if record.expires_at > timezone.now():
+            return record, False
+        # an expired key is free for a new request
+        record.fingerprint, record.status_code, record.response_data = fingerprint, None, None
+        record.expires_at = expires_at
+        record.save(update_fields=['fingerprint', 'status_code', 'response_data', 'expires_at'])
+        return record, True
+
+
+class IdempotencyMixin:
+    """
+    Honor the Idempotency-Key header on write handlers run through `idempotent()`.
+
+    The response of the first request is stored with the key, a retry gets it back without running the handler
+    again (no processing, no storage writes). A retry sent while the first request runs gets 409 with Retry-After,
+    a key reused for a different request gets 422. Server errors and RETRYABLE_STATUS responses are not stored,
+    the request can be retried with the same key.
+
+    The handler runs outside of any transaction, the key is claimed before and its response stored after it.
+    """
+
+    def idempotent(self, handler, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return handler(request, *args, **kwargs)
+        if not key or len(key) > IdempotencyKey._meta.get_field('key').max_length:
+            return Response({'error': f'Invalid {IDEMPOTENCY_HEADER} header.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        fingerprint = request_fingerprint(request)
+        record, claimed = claim_key(request.user, key, fingerprint)
+        if not claimed:
+            if record.fingerprint != fingerprint:
+                return Response(
+                    {'error': f'{IDEMPOTENCY_HEADER} was already used for a different request.'},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                )
+            if record.status_code is None:
+                return Response(
+                    {'error': f'A request with this {IDEMPOTENCY_HEADER} is still in progress.'},
+                    status=status.HTTP_409_CONFLICT, headers={'Retry-After': str(IDEMPOTENCY_RETRY_AFTER)},
+                )
+            return Response(record.response_data, status=record.status_code, headers={'Idempotent-Replayed': 'true'})
+
+        try:
+            try:
+                response = handler(request, *args, **kwargs)
+            except Exception as exc:
+                # API errors are responses like any other
+                response = self.handle_exception(exc)
+        except Exception:
+            # anything else frees the key, the client can retry with it
+            record.delete()
+            raise
+
+        if response.status_code >= 500 or response.status_code in RETRYABLE_STATUS:
+            record.delete()
+        else:
+            record.status_code = response.status_code
+            record.response_data = response.data
+            record.expires_at = timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+            record.save(update_fields=['status_code', 'response_data', 'expires_at'])
+        return response
@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import PIL.Image
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from image_api.models import ImageInfo
+from image_api.processing import image_metadata
+from image_api.util.image_util import ImageUtil
+
+
+def read_file_metadata(storage, name):
+    """(metadata, error) of a stored file, from its header only, pixel data is never decoded."""
+    try:
+        with storage.open(name) as stored:
+            header = ImageUtil.read_image_header(stored)
+        return image_metadata(header, storage.size(name)), None
+    except (PIL.UnidentifiedImageError, PIL.Image.DecompressionBombError, OSError, SyntaxError) as error:
+        return None, str(error) or error.__class__.__name__
+
+
+class Command(BaseCommand):
+    help = ('Record width, height, file size, format and mime type of stored images that miss them, '
+            'reading only the file headers')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Threads reading headers from storage (the work is storage latency bound)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows read and updated per round')
+
+    def handle(self, *args, **options):
+        fields = ImageInfo.FILE_METADATA_FIELDS
+        storage = ImageInfo._meta.get_field('image').storage
+        missing = Q()
+        for field in fields:
+            missing |= Q(**{f'{field}__isnull': True})
+        queryset = ImageInfo.objects.filter(missing).exclude(image='').order_by('pk').only('pk', 'image', *fields)
+
+        last_id = backfilled = failed = 0
+        with ThreadPoolExecutor(options['workers']) as executor:
+            while True:
+                # keyset pagination, rows that keep failing don't come back in the next batch
+                batch = list(queryset.filter(pk__gt=last_id)[:options['batch_size']])
+                if not batch:
+                    break
+
+                results = executor.map(lambda image: read_file_metadata(storage, image.image.name), batch)
+                changed = []
+                for image, (metadata, error) in zip(batch, results):
+                    if error:
+                        failed += 1
+                        self.stderr.write(f'{image.pk} {image.image.name}: {error}')
+                        continue
+                    for field, value in metadata.items():
+                        setattr(image, field, value)
+                    changed.append(image)
+
+                ImageInfo.objects.bulk_update(changed, fields)
+                backfilled += len(changed)
+                last_id = batch[-1].pk
+                self.stdout.write(f'Backfilled {backfilled} images (last id {last_id})')
+
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {backfilled} images, {failed} failed'))
@@ -0,0 +1,31 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from image_api.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = 'Delete expired chunked upload sessions and their temporary files'
+
+    def handle(self, *args, **options):
+        # deleted one by one so the post_delete signal removes each temporary file
+        expired = 0
+        for session in UploadSession.objects.filter(expires_at__lte=timezone.now()).iterator():
+            session.delete()
+            expired += 1
+
+        # files left behind by a crash between creating the file and the session row
+        orphaned = 0
+        if os.path.isdir(settings.UPLOAD_SESSION_DIR):
+            live = {f'{pk}.part' for pk in UploadSession.objects.values_list('pk', flat=True)}
+            cutoff = time.time() - settings.UPLOAD_SESSION_TTL
+            for entry in os.scandir(settings.UPLOAD_SESSION_DIR):
+                if entry.name not in live and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    orphaned += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Deleted {expired} expired sessions and {orphaned} orphaned files'))
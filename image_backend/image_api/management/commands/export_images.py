@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.http import QueryDict
+from rest_framework.exceptions import ValidationError
+
+from image_api.export import iter_ndjson
+from image_api.filters import ImageFilter
+from image_api.models import ImageInfo
+from image_api.serializers import ImageSerializer, ImageValuesSerializer
+
+
+class Command(BaseCommand):
+    help = 'Export images with their tags as NDJSON, with the same filters as the image list endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', type=str, help='Output file (stdout by default)')
+        parser.add_argument('--tags', action='append', default=[], help='Only images with this tag (repeatable)')
+        parser.add_argument('--created-date', type=str, help='YYYY-MM-DD')
+        parser.add_argument('--created-after', type=str, help='YYYY-MM-DD')
+        parser.add_argument('--created-before', type=str, help='YYYY-MM-DD')
+        parser.add_argument('--q', type=str, help='Full-text search')
+        parser.add_argument('--fields', type=str, default=','.join(ImageSerializer.Meta.fields),
+                            help='Comma separated fields to export')
+        parser.add_argument('--expand-tags', action='store_true', help='Export tags as objects instead of names')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--database', type=str, default='default', help='Database alias to read from')
+
+    def handle(self, *args, **options):
+        fields = tuple(name.strip() for name in options['fields'].split(',') if name.strip())
+        unknown = set(fields) - set(ImageSerializer.Meta.fields)
+        if unknown:
+            raise CommandError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        fields = tuple(name for name in ImageSerializer.Meta.fields if name in fields)
+
+        serializer = ImageValuesSerializer(fields, ('tags',) if options['expand_tags'] else ())
+        try:
+            queryset = ImageFilter(self.build_params(options)).filter(ImageInfo.objects.using(options['database']))
+        except (ValidationError, ValueError) as error:
+            raise CommandError(error)
+        queryset = serializer.select(queryset).order_by('id')
+
+        output = open(options['output'], 'w') if options['output'] else None
+        count = 0
+        try:
+            for lines in iter_ndjson(queryset, serializer, options['chunk_size']):
+                if output:
+                    output.write(lines)
+                else:
+                    self.stdout.write(lines, ending='')
+                count += lines.count('\n')
+        finally:
+            if output:
+                output.close()
+
+        self.stderr.write(self.style.SUCCESS(f'Exported {count} images'))
+
+    @staticmethod
+    def build_params(options):
+        params = QueryDict(mutable=True)
+        params.setlist('tags', options['tags'])
+        for param, option in (('created_date', 'created_date'), ('created_date__after', 'created_after'),
+                              ('created_date__before', 'created_before'), ('q', 'q')):
+            if options[option]:
+                params[param] = options[option]
+        return params
@@ -0,0 +1,215 @@
+import csv
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import islice
+from typing import List, NamedTuple, Optional
+
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from image_api.models import ImageInfo, Tag
+from image_api.processing import ImageProcessor
+from image_api.search import refresh_search_vectors
+from image_api.tag_counts import recount_tag_image_counts
+
+IMAGE_FILE_EXT = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tif', '.tiff')
+
+
+class ImportItem(NamedTuple):
+    key: str  # path relative to the source, recorded in the checkpoint
+    path: str
+    title: str
+    description: str
+    tags: List[str]
+
+
+class ImportResult(NamedTuple):
+    item: ImportItem
+    name: Optional[str] = None
+    metadata: Optional[dict] = None  # ImageInfo.FILE_METADATA_FIELDS values
+    error: Optional[str] = None
+
+
+def process_import_item(item, transform_ext, encoder_profile=None):
+    """Apply the upload rules to one file and write it to storage (runs in a worker process)."""
+    image_field = ImageInfo._meta.get_field('image')
+    try:
+        with open(item.path, 'rb') as source:
+            processed = ImageProcessor(transform_ext, encoder_profile).process(File(source, name=os.path.basename(item.path)))
+            name = image_field.storage.save(
+                image_field.generate_filename(None, os.path.basename(processed.file.name)), processed.file
+            )
+    except ValidationError as error:
+        return ImportResult(item, error='; '.join(str(detail) for detail in error.detail))
+    except OSError as error:
+        return ImportResult(item, error=str(error))
+    return ImportResult(item, name, processed.metadata())
+
+
+class Command(BaseCommand):
+    help = ('Import images from a directory, or a CSV/JSON manifest of path, title, description and tags, '
+            'with the same processing rules as the upload endpoint')
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', type=str, help='Directory of images, or a .csv/.json manifest')
+        parser.add_argument('--tags', action='append', default=[], help='Tag added to every image (repeatable)')
+        parser.add_argument('--file-ext', type=str, choices=ImageProcessor.SUPPORT_FILE_EXT,
+                            help='Convert images to this format, like the upload file_ext parameter')
+        parser.add_argument('--encoder-profile', type=str, choices=ImageProcessor.ENCODER_PROFILES,
+                            help='Encoder effort of re-encoded images (default: IMAGE_ENCODER_PROFILE)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes, 1 processes the files inline')
+        parser.add_argument('--batch-size', type=int, default=200, help='Rows inserted per transaction')
+        parser.add_argument('--checkpoint', type=str,
+                            help='File recording imported paths, to resume an interrupted import '
+                                 '(default: <source>.checkpoint next to the source)')
+
+    def handle(self, *args, **options):
+        source = os.path.abspath(options['source'])
+        if not os.path.exists(source):
+            raise CommandError(f'{source} does not exist')
+
+        checkpoint = options['checkpoint'] or source.rstrip(os.sep) + '.checkpoint'
+        done = self.read_checkpoint(checkpoint)
+        items = [item for item in self.load_items(source, options['tags']) if item.key not in done]
+        self.stdout.write(f'{len(items)} images to import ({len(done)} already imported)')
+
+        imported = failed = 0
+        with ExitStack() as stack:
+            checkpoint_file = stack.enter_context(open(checkpoint, 'a'))
+            transform_exts = [options['file_ext']] * len(items)
+            encoder_profiles = [options['encoder_profile']] * len(items)
+            if options['workers'] > 1:
+                # forked workers only touch files and storage, never the inherited database connections
+                executor = stack.enter_context(
+                    ProcessPoolExecutor(options['workers'], mp_context=multiprocessing.get_context('fork'))
+                )
+                results = executor.map(process_import_item, items, transform_exts, encoder_profiles, chunksize=8)
+            else:
+                results = map(process_import_item, items, transform_exts, encoder_profiles)
+
+            while True:
+                batch = list(islice(results, options['batch_size']))
+                if not batch:
+                    break
+
+                for result in batch:
+                    if result.error:
+                        failed += 1
+                        self.stderr.write(f'{result.item.key}: {result.error}')
+                stored = [result for result in batch if not result.error]
+                self.insert_batch(stored)
+
+                checkpoint_file.writelines(result.item.key + '\n' for result in stored)
+                checkpoint_file.flush()
+                imported += len(stored)
+                self.stdout.write(f'Imported {imported}/{len(items)}')
+
+        self.stdout.write(self.style.SUCCESS(f'Imported {imported} images, {failed} failed'))
+
+    def insert_batch(self, results):
+        if not results:
+            return
+        try:
+            with transaction.atomic():
+                images = ImageInfo.objects.bulk_create([
+                    ImageInfo(
+                        image=result.name,
+                        title=result.item.title,
+                        description=result.item.description,
+                        **result.metadata,
+                    )
+                    for result in results
+                ])
+
+                tags = self.get_or_create_tags({name for result in results for name in result.item.tags})
+                through = ImageInfo.tags.through
+                through.objects.bulk_create([
+                    through(imageinfo_id=image.id, tag_id=tags[name].id)
+                    for image, result in zip(images, results) for name in set(result.item.tags)
+                ])
+
+                # bulk_create sends no signals, update what the signal handlers would have
+                recount_tag_image_counts(Tag.objects.filter(pk__in=[tag.id for tag in tags.values()]))
+                refresh_search_vectors(ImageInfo.objects.filter(pk__in=[image.id for image in images]))
+        except Exception:
+            # the rows are not there, neither should the files be
+            for result in results:
+                ImageInfo._meta.get_field('image').storage.delete(result.name)
+            raise
+
+    @staticmethod
+    def get_or_create_tags(names):
+        tags = {}
+        for tag in Tag.objects.filter(name__in=names).order_by('id'):
+            tags.setdefault(tag.name, tag)
+        missing = [Tag(name=name) for name in sorted(names - tags.keys())]
+        for tag in Tag.objects.bulk_create(missing):
+            tags[tag.name] = tag
+        return tags
+
+    def load_items(self, source, extra_tags):
+        if os.path.isdir(source):
+            return self.walk_directory(source, extra_tags)
+        if source.endswith('.csv'):
+            with open(source, newline='') as manifest:
+                rows = list(csv.DictReader(manifest))
+            # tags are separated by ';' in a CSV manifest
+            for row in rows:
+                row['tags'] = [name for name in (row.get('tags') or '').split(';')]
+        elif source.endswith('.json'):
+            with open(source) as manifest:
+                rows = json.load(manifest)
+        else:
+            raise CommandError('source must be a directory, a .csv or a .json manifest')
+
+        base_dir = os.path.dirname(source)
+        items = []
+        for row in rows:
+            if not row.get('path'):
+                raise CommandError(f'Manifest entry without path: {row}')
+            path = os.path.join(base_dir, row['path'])
+            items.append(ImportItem(
+                key=row['path'],
+                path=path,
+                title=row.get('title') or os.path.splitext(os.path.basename(path))[0],
+                description=row.get('description') or '',
+                tags=self.clean_tags(list(row.get('tags') or []) + extra_tags),
+            ))
+        return items
+
+    def walk_directory(self, directory, extra_tags):
+        items = []
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for file_name in sorted(files):
+                if not file_name.lower().endswith(IMAGE_FILE_EXT):
+                    continue
+                path = os.path.join(root, file_name)
+                items.append(ImportItem(
+                    key=os.path.relpath(path, directory),
+                    path=path,
+                    title=os.path.splitext(file_name)[0],
+                    description='',
+                    tags=self.clean_tags(extra_tags),
+                ))
+        return items
+
+    @staticmethod
+    def clean_tags(names):
+        names = [name.strip() for name in names if name.strip()]
+        too_long = [name for name in names if len(name) > Tag._meta.get_field('name').max_length]
+        if too_long:
+            raise CommandError(f'Tag name too long: {too_long[0]}')
+        return names
+
+    @staticmethod
+    def read_checkpoint(path):
+        if not os.path.exists(path):
+            return set()
+        with open(path) as checkpoint_file:
+            return {line.rstrip('\n') for line in checkpoint_file if line.strip()}
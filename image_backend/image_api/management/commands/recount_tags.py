@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from image_api.tag_counts import recount_tag_image_counts
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored image count of every tag from the image/tag relation'
+
+    def handle(self, *args, **options):
+        updated = recount_tag_image_counts()
+        self.stdout.write(self.style.SUCCESS(f'Recounted {updated} tags'))
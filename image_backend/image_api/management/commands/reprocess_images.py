@@ -0,0 +1,179 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import ExitStack
+from typing import NamedTuple, Optional
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from image_api.models import ImageInfo, ImageVariant
+from image_api.processing import ImageProcessor
+
+
+class ReprocessResult(NamedTuple):
+    id: int
+    old_name: str
+    new_name: Optional[str] = None  # None when the stored file is kept
+    metadata: Optional[dict] = None  # ImageInfo.FILE_METADATA_FIELDS values
+    error: Optional[str] = None
+
+
+def reprocess_image(image_id, name, transform_ext, encoder_profile, dry_run):
+    """Apply the current processing rules to one stored image (runs in a worker process)."""
+    image_field = ImageInfo._meta.get_field('image')
+    storage = image_field.storage
+    try:
+        with storage.open(name) as stored:
+            processed = ImageProcessor(transform_ext, encoder_profile).process(stored)
+            new_name = None
+            if processed.file is not stored and not dry_run:
+                new_name = storage.save(
+                    image_field.generate_filename(None, os.path.basename(processed.file.name)), processed.file
+                )
+            elif processed.file is not stored:
+                new_name = processed.file.name
+    except ValidationError as error:
+        return ReprocessResult(image_id, name, error='; '.join(str(detail) for detail in error.detail))
+    except OSError as error:
+        return ReprocessResult(image_id, name, error=str(error))
+    return ReprocessResult(image_id, name, new_name, processed.metadata())
+
+
+class RateLimiter:
+
+    def __init__(self, per_second):
+        self.per_second = per_second
+        self.start = time.monotonic()
+        self.count = 0
+
+    def wait(self):
+        if self.per_second:
+            delay = self.start + self.count / self.per_second - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        self.count += 1
+
+
+class Command(BaseCommand):
+    help = ('Apply the current processing rules to stored images (resize, convert, refresh file metadata), '
+            'in id order, resumable from a checkpoint')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file-ext', type=str, choices=ImageProcessor.SUPPORT_FILE_EXT,
+                            help='Convert images to this format, like the upload file_ext parameter')
+        parser.add_argument('--encoder-profile', type=str, choices=ImageProcessor.ENCODER_PROFILES,
+                            help='Encoder effort of re-encoded images (default: IMAGE_ENCODER_PROFILE)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Worker processes, 1 processes the images inline')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Images read, processed and updated per round (bounds the work in flight)')
+        parser.add_argument('--max-per-second', type=float, default=0,
+                            help='Start at most this many images per second (0: no limit)')
+        parser.add_argument('--checkpoint', type=str, default='reprocess_images.checkpoint',
+                            help='File holding the last processed id')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start from the first id')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would change without writing')
+
+    def handle(self, *args, **options):
+        last_id = 0 if options['restart'] else self.read_checkpoint(options['checkpoint'])
+        if last_id:
+            self.stdout.write(f'Resuming after id {last_id}')
+
+        limiter = RateLimiter(options['max_per_second'])
+        processed = rewritten = failed = 0
+        with ExitStack() as stack:
+            executor = None
+            if options['workers'] > 1:
+                # forked workers only touch storage, never the inherited database connections
+                executor = stack.enter_context(
+                    ProcessPoolExecutor(options['workers'], mp_context=multiprocessing.get_context('fork'))
+                )
+
+            while True:
+                # keyset pagination, the cost of a batch doesn't grow with the position in the table
+                batch = list(
+                    ImageInfo.objects.filter(pk__gt=last_id).exclude(image='')
+                    .order_by('pk').values_list('pk', 'image')[:options['batch_size']]
+                )
+                if not batch:
+                    break
+
+                futures = []
+                for image_id, name in batch:
+                    limiter.wait()
+                    args = (image_id, name, options['file_ext'], options['encoder_profile'], options['dry_run'])
+                    futures.append(executor.submit(reprocess_image, *args) if executor else self.run_inline(*args))
+                results = [future.result() for future in futures]
+
+                for result in results:
+                    if result.error:
+                        failed += 1
+                        self.stderr.write(f'{result.id} {result.old_name}: {result.error}')
+                    elif result.new_name:
+                        rewritten += 1
+                        if options['dry_run']:
+                            self.stdout.write(f'{result.id} {result.old_name} -> {result.new_name}')
+                if not options['dry_run']:
+                    self.apply_results([result for result in results if not result.error])
+
+                processed += len(batch)
+                last_id = batch[-1][0]
+                if not options['dry_run']:
+                    self.write_checkpoint(options['checkpoint'], last_id)
+                self.stdout.write(f'Processed {processed} images (last id {last_id})')
+
+        verb = 'would be rewritten' if options['dry_run'] else 'rewritten'
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {processed} images, {rewritten} {verb}, {failed} failed'
+        ))
+
+    @staticmethod
+    def run_inline(*args):
+        future = Future()
+        future.set_result(reprocess_image(*args))
+        return future
+
+    def apply_results(self, results):
+        storage = ImageInfo._meta.get_field('image').storage
+        fields = ImageInfo.FILE_METADATA_FIELDS
+        images = ImageInfo.objects.only('pk', 'image', *fields).in_bulk([result.id for result in results])
+        changed, replaced = [], []
+        for result in results:
+            image = images.get(result.id)
+            if image is None:
+                # deleted while it was processed
+                if result.new_name:
+                    storage.delete(result.new_name)
+                continue
+            if result.new_name:
+                image.image.name = result.new_name
+                replaced.append(result)
+            elif all(getattr(image, field) == value for field, value in result.metadata.items()):
+                continue
+            for field, value in result.metadata.items():
+                setattr(image, field, value)
+            changed.append(image)
+
+        with transaction.atomic():
+            ImageInfo.objects.bulk_update(changed, ['image', *fields])
+            # variants were built from the replaced files, they are rebuilt on their next request
+            ImageVariant.objects.filter(image_id__in=[result.id for result in replaced]).delete()
+            # old files are only removed once the rows point at the new ones
+            transaction.on_commit(lambda: [storage.delete(result.old_name) for result in replaced])
+
+    @staticmethod
+    def read_checkpoint(path):
+        if not os.path.exists(path):
+            return 0
+        with open(path) as checkpoint_file:
+            return int(checkpoint_file.read().strip() or 0)
+
+    @staticmethod
+    def write_checkpoint(path, last_id):
+        # write then rename, a crash never leaves a truncated checkpoint
+        with open(path + '.tmp', 'w') as checkpoint_file:
+            checkpoint_file.write(str(last_id))
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,95 @@
+import random
+from datetime import timedelta
+from io import BytesIO
+
+from django.contrib.auth.models import Group, User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from PIL import Image
+
+from image_api.models import ImageInfo, Tag
+from image_api.tag_counts import recount_tag_image_counts
+
+
+class Command(BaseCommand):
+    help = 'Seed a synthetic image catalog (and optionally a user) for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=1000, help='Number of images to create')
+        parser.add_argument('--tags', type=int, default=100, help='Number of distinct tags')
+        parser.add_argument('--tags-per-image', type=int, default=3, help='Max tags attached to each image')
+        parser.add_argument('--days', type=int, default=365, help='Spread created_at over the last N days')
+        parser.add_argument('--with-files', action='store_true', help='Write a small image file for every row')
+        parser.add_argument('--user', type=str, help='Create (or update) this user in the admin group')
+        parser.add_argument('--password', type=str, default='bench', help='Password for --user')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        if options['user']:
+            self.create_user(options['user'], options['password'])
+
+        tags = self.create_tags(options['tags'])
+        images = self.create_images(rng, options)
+        self.attach_tags(rng, images, tags, options['tags_per_image'], options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded {len(images)} images with {len(tags)} tags (ids {images[0].id}-{images[-1].id})'
+            if images else f'Seeded {len(tags)} tags'
+        ))
+
+    def create_user(self, username, password):
+        user, _ = User.objects.get_or_create(username=username)
+        user.set_password(password)
+        user.save()
+        user.groups.add(Group.objects.get_or_create(name='admin')[0])
+
+    def create_tags(self, count):
+        tags = []
+        for i in range(count):
+            tag, _ = Tag.objects.get_or_create(name=f'bench-tag-{i}')
+            tags.append(tag)
+        return tags
+
+    def create_images(self, rng, options):
+        now = timezone.now()
+        image_name = self.write_image_file(rng) if options['with_files'] else ''
+        images = []
+        for i in range(options['images']):
+            if options['with_files'] and i:
+                image_name = self.write_image_file(rng)
+            images.append(ImageInfo(
+                image=image_name,
+                title=f'Bench image {i}',
+                description=f'Synthetic image {i} for load testing',
+                width=64 if image_name else None,
+                height=48 if image_name else None,
+            ))
+        images = ImageInfo.objects.bulk_create(images, batch_size=options['batch_size'])
+
+        # auto_now_add ignores values given on insert, spread the dates afterwards
+        for image in images:
+            image.created_at = now - timedelta(days=rng.uniform(0, options['days']))
+        ImageInfo.objects.bulk_update(images, ['created_at'], batch_size=options['batch_size'])
+        return images
+
+    def write_image_file(self, rng):
+        output = BytesIO()
+        Image.new('RGB', (64, 48), tuple(rng.randrange(256) for _ in range(3))).save(output, 'jpeg')
+        return default_storage.save('images/bench.jpg', ContentFile(output.getvalue()))
+
+    def attach_tags(self, rng, images, tags, tags_per_image, batch_size):
+        if not tags or not tags_per_image:
+            return
+        through = ImageInfo.tags.through
+        links = []
+        for image in images:
+            for tag in rng.sample(tags, rng.randint(1, min(tags_per_image, len(tags)))):
+                links.append(through(imageinfo_id=image.id, tag_id=tag.id))
+        through.objects.bulk_create(links, batch_size=batch_size)
+        # bulk_create sends no m2m_changed, the stored counts are rebuilt in one pass
+        recount_tag_image_counts(Tag.objects.filter(pk__in=[tag.id for tag in tags]))
@@ -0,0 +1,99 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from image_api.models import ImageInfo, ImageVariant
+
+SHARDED_FIELDS = ((ImageInfo, 'image'), (ImageVariant, 'file'))
+
+
+def copy_to_sharded_name(field, name):
+    """(new_name, error) of a copy of a stored file under the sharded layout of the field."""
+    storage = field.storage
+    new_name = field.generate_filename(None, os.path.basename(name))
+    if isinstance(storage, FileSystemStorage):
+        # a hard link copies no data, removing the old name later leaves the file in place
+        try:
+            os.makedirs(os.path.dirname(storage.path(new_name)), exist_ok=True)
+            os.link(storage.path(name), storage.path(new_name))
+            return new_name, None
+        except OSError:
+            pass  # e.g. no hard links on this file system, copied below
+    try:
+        with storage.open(name) as stored:
+            return storage.save(new_name, stored), None
+    except OSError as error:
+        return None, str(error) or error.__class__.__name__
+
+
+class Command(BaseCommand):
+    help = ('Move stored images and variants from the flat images/ and variants/ directories to the sharded '
+            '<prefix>/ab/cd/<key>.<ext> layout, updating the rows in batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Threads copying files in storage (the work is storage latency bound)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows read and updated per round')
+        parser.add_argument('--dry-run', action='store_true', help='Count the files to move without moving them')
+
+    def handle(self, *args, **options):
+        with ThreadPoolExecutor(options['workers']) as executor:
+            for model, field_name in SHARDED_FIELDS:
+                moved, failed = self.shard_field(executor, model, field_name, options)
+                verb = 'to move' if options['dry_run'] else 'moved'
+                self.stdout.write(self.style.SUCCESS(
+                    f'{model.__name__}.{field_name}: {moved} files {verb}, {failed} failed'
+                ))
+
+    def shard_field(self, executor, model, field_name, options):
+        field = model._meta.get_field(field_name)
+        last_id = moved = failed = 0
+        while True:
+            # keyset pagination, files that keep failing don't come back in the next batch
+            batch = list(
+                model.objects.filter(pk__gt=last_id).exclude(**{field_name: ''})
+                .order_by('pk').values_list('pk', field_name)[:options['batch_size']]
+            )
+            if not batch:
+                break
+            last_id = batch[-1][0]
+
+            pending = [(pk, name) for pk, name in batch if not field.upload_to.is_sharded(name)]
+            if options['dry_run']:
+                moved += len(pending)
+                continue
+
+            copies = executor.map(lambda row: copy_to_sharded_name(field, row[1]), pending)
+            renamed = {}
+            for (pk, name), (new_name, error) in zip(pending, copies):
+                if error:
+                    failed += 1
+                    self.stderr.write(f'{pk} {name}: {error}')
+                else:
+                    renamed[pk] = (name, new_name)
+            moved += self.apply_renames(model, field, renamed)
+            self.stdout.write(f'{model.__name__}.{field_name}: moved {moved} files (last id {last_id})')
+        return moved, failed
+
+    @staticmethod
+    def apply_renames(model, field, renamed):
+        storage = field.storage
+        with transaction.atomic():
+            rows = model.objects.select_for_update().only('pk', field.name).in_bulk(list(renamed))
+            changed, stale = [], []
+            for pk, (name, new_name) in renamed.items():
+                row = rows.get(pk)
+                # deleted, or given another file while it was copied
+                if row is None or getattr(row, field.name).name != name:
+                    stale.append(new_name)
+                    continue
+                getattr(row, field.name).name = new_name
+                changed.append(row)
+            model.objects.bulk_update(changed, [field.name])
+            # old files are only removed once the rows point at the new ones
+            old_names = [renamed[row.pk][0] for row in changed]
+            transaction.on_commit(lambda: [storage.delete(name) for name in old_names + stale])
+        return len(changed)
@@ -0,0 +1,217 @@
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from auth_api.permissions import GuestPermission
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.handlers.asgi import ASGIRequest
+from django.http import (Http404, HttpResponse, HttpResponseRedirect,
+                         StreamingHttpResponse)
+from django.shortcuts import get_object_or_404
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from rest_framework.negotiation import BaseContentNegotiation
+from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from .models import ImageInfo, ImageVariant
+from .variants import (RENDITION_FORMATS, get_or_build_variant,
+                       negotiate_variant_format, original_format,
+                       supported_variant_formats)
+
+FILE_CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class IgnoreClientContentNegotiation(BaseContentNegotiation):
+    """Media responses are files, the Accept header (e.g. image/webp) must not fail JSON renderer negotiation."""
+
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+def parse_range(header, size):
+    """
+    (start, end) of a single `bytes=` range, both inclusive, None if the header should be ignored.
+
+    Raises:
+        ValueError: If the range can't be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or not any(match.groups()):
+        return None
+
+    start, end = match.groups()
+    if not start:
+        # suffix range: the last N bytes
+        length = int(end)
+        if not length:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError(header)
+    return start, end
+
+
+def iter_file(file, length):
+    try:
+        while length > 0:
+            chunk = file.read(min(FILE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+async def aiter_file(file, length):
+    try:
+        while length > 0:
+            chunk = await sync_to_async(file.read, thread_sensitive=False)(min(FILE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+class MediaAccessMixin:
+    """Image files are public unless MEDIA_REQUIRE_AUTHENTICATION is set, then they need the API guest permission."""
+    content_negotiation_class = IgnoreClientContentNegotiation
+
+    def get_permissions(self):
+        if getattr(settings, 'MEDIA_REQUIRE_AUTHENTICATION', False):
+            return [IsAuthenticated(), GuestPermission()]
+        return []
+
+    def set_cache_control(self, response, max_age):
+        visibility = 'private' if getattr(settings, 'MEDIA_REQUIRE_AUTHENTICATION', False) else 'public'
+        response['Cache-Control'] = f'{visibility}, max-age={max_age}'
+
+
+class MediaView(MediaAccessMixin, APIView):
+    """
+    Serve uploaded images from MEDIA_ROOT (non-production, without S3).
+
+    Only files of existing images and their variants are served, behind the API permissions when
+    MEDIA_REQUIRE_AUTHENTICATION is set. The bytes are sent by the front proxy when MEDIA_ACCEL_REDIRECT is 'nginx'
+    (X-Accel-Redirect) or 'sendfile' (X-Sendfile), otherwise by Python with ETag/Last-Modified validation and
+    Range support.
+    """
+
+    def get(self, request, path):
+        try:
+            full_path = safe_join(settings.MEDIA_ROOT, path)
+        except SuspiciousFileOperation:
+            raise Http404('Not found.')
+        if not (ImageInfo.objects.filter(image=path).exists() or ImageVariant.objects.filter(file=path).exists()):
+            raise Http404('Not found.')
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            raise Http404('Not found.')
+
+        content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+        accel = getattr(settings, 'MEDIA_ACCEL_REDIRECT', None)
+        if accel == 'nginx':
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + quote(path)
+        elif accel == 'sendfile':
+            response = HttpResponse(content_type=content_type)
+            response['X-Sendfile'] = full_path
+        else:
+            response = self.file_response(request, full_path, stat, content_type)
+
+        self.set_cache_control(response, settings.MEDIA_CACHE_MAX_AGE)
+        return response
+
+    def file_response(self, request, full_path, stat, content_type):
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        last_modified = http_date(int(stat.st_mtime))
+        conditional = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+        if conditional is not None:
+            if conditional.status_code == 304:
+                conditional['ETag'], conditional['Last-Modified'] = etag, last_modified
+            return conditional
+
+        size = stat.st_size
+        byte_range = None
+        if_range = request.headers.get('If-Range')
+        # a stale If-Range gets the whole (changed) file instead of a part
+        if not if_range or if_range in (etag, last_modified):
+            try:
+                byte_range = parse_range(request.headers.get('Range'), size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{size}'
+                return response
+
+        start, end = byte_range or (0, size - 1)
+        file = open(full_path, 'rb')
+        file.seek(start)
+        length = end - start + 1 if size else 0
+        iterator = aiter_file if isinstance(request._request, ASGIRequest) else iter_file
+        response = StreamingHttpResponse(iterator(file, length), content_type=content_type)
+        response['Content-Length'] = str(length)
+        if byte_range:
+            response.status_code = 206
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
+        return response
+
+
+class ImageVariantView(MediaAccessMixin, APIView):
+    """
+    Redirect to the best file of an image for the client's Accept header and the `w` width (see srcset).
+
+    Clients listing a format of IMAGE_VARIANT_FORMATS (e.g. `image/avif`, `image/webp`) get a variant of the image
+    in that format, encoded and stored on the first request. Other clients get the original file, or a rendition
+    in the original format when `w` (one of IMAGE_RENDITION_WIDTHS) is below the image width.
+    """
+
+    def get(self, request, pk):
+        image_info = get_object_or_404(ImageInfo.objects.only('id', 'image', 'width'), pk=pk)
+        if not image_info.image:
+            raise Http404('Not found.')
+
+        width = request.query_params.get('w')
+        if width is not None:
+            if not width.isdigit() or int(width) not in settings.IMAGE_RENDITION_WIDTHS:
+                return Response(
+                    {'error': f'w must be one of {sorted(settings.IMAGE_RENDITION_WIDTHS)}.'},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            width = int(width)
+
+        variant = None
+        file_format = negotiate_variant_format(request.headers.get('Accept'), supported_variant_formats())
+        # the width keys the stored variants, unknown for rows created before dimensions were recorded
+        if image_info.width:
+            width = min(width or image_info.width, image_info.width)
+            if not file_format and width < image_info.width and original_format(image_info) in RENDITION_FORMATS:
+                file_format = original_format(image_info)
+            if file_format:
+                variant = get_or_build_variant(image_info, file_format, width)
+
+        response = HttpResponseRedirect(variant.file.url if variant else image_info.image.url)
+        patch_vary_headers(response, ['Accept'])
+        self.set_cache_control(response, settings.IMAGE_VARIANT_REDIRECT_MAX_AGE)
+        return response
@@ -0,0 +1,69 @@
+import os
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+
+from .util import perf
+
+# With PROMETHEUS_MULTIPROC_DIR set (gunicorn), every worker writes its samples to files in that
+# directory and the /metrics view aggregates them, see gunicorn.conf.py for the worker cleanup.
+
+SIZE_BUCKETS = tuple(2 ** power for power in range(14, 27))  # 16KB .. 64MB
+
+PROCESSING_STAGE_SECONDS = Histogram(
+    'image_processing_stage_seconds', 'Image processing duration by stage',
+    ['stage'], buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30),
+)
+UPLOAD_BYTES = Histogram(
+    'image_upload_bytes', 'Size of uploaded images before (input) and after (output) processing',
+    ['direction'], buckets=SIZE_BUCKETS,
+)
+UPLOAD_DECISIONS = Counter(
+    'image_upload_decisions_total', 'Processing decision taken for uploaded images',
+    ['decision'],
+)
+STORAGE_DELETE_SECONDS = Histogram(
+    'image_storage_delete_seconds', 'Latency of deleting image files from storage',
+)
+REQUEST_SECONDS = Histogram(
+    'image_api_request_seconds', 'Request latency by view',
+    ['view', 'method', 'status'],
+)
+THROTTLED_REQUESTS = Counter(
+    'image_api_throttled_total', 'Requests rejected with 429, by rate limit scope or processing concurrency',
+    ['reason'],
+)
+
+STAGE_LABELS = {
+    'image.decode': 'decode',
+    'image.convert': 'convert',
+    'image.resize': 'resize',
+    'image.encode': 'encode',
+    'storage.write': 'storage_write',
+}
+
+
+def observe_stage(name, seconds):
+    if name in STAGE_LABELS:
+        PROCESSING_STAGE_SECONDS.labels(stage=STAGE_LABELS[name]).observe(seconds)
+    elif name == 'storage.delete':
+        STORAGE_DELETE_SECONDS.observe(seconds)
+
+
+perf.add_observer(observe_stage)
+
+
+def metrics_view(request):
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponseForbidden()
+
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,164 @@
+import json
+import logging
+import random
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import (iscoroutinefunction, markcoroutinefunction,
+                          sync_to_async)
+from django.conf import settings
+from django.db import connections
+
+from .metrics import REQUEST_SECONDS
+from .util import perf
+
+logger = logging.getLogger('image_api.perf')
+
+
+class AsyncCapableMiddleware:
+    """
+    Middleware running in the mode of the handler, `__acall__` under ASGI.
+
+    A sync-only middleware first in MIDDLEWARE would make Django run every ASGI request in a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.handle(request)
+
+
+class MetricsMiddleware(AsyncCapableMiddleware):
+    """Observe the latency of every request by view name on the Prometheus histogram."""
+
+    def handle(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self.observe(request, response, start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, response, start)
+        return response
+
+    @staticmethod
+    def observe(request, response, start):
+        resolver_match = getattr(request, 'resolver_match', None)
+        REQUEST_SECONDS.labels(
+            view=resolver_match.view_name if resolver_match else 'unresolved',
+            method=request.method,
+            status=response.status_code,
+        ).observe(time.perf_counter() - start)
+
+
+class PerfTimingMiddleware(AsyncCapableMiddleware):
+    """
+    Per-request performance breakdown.
+
+    For a sampled request (PERF_SAMPLE_RATE) records SQL query count and time, ImageUtil stages,
+    storage I/O, serialization and rendering time, then emits them as a `Server-Timing` header
+    and one structured log line on the `image_api.perf` logger.
+    """
+
+    @staticmethod
+    def sampled():
+        sample_rate = getattr(settings, 'PERF_SAMPLE_RATE', 0)
+        return bool(sample_rate) and random.random() < sample_rate
+
+    def handle(self, request):
+        if not self.sampled():
+            return self.get_response(request)
+
+        record = perf.start_record()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(self.record_query))
+                response = self.get_response(request)
+        finally:
+            perf.end_record(record)
+        self.finish(request, response, record, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        if not self.sampled():
+            return await self.get_response(request)
+
+        record = perf.start_record()
+        start = time.perf_counter()
+        # the ORM runs in the request's sync thread (thread_sensitive), whose connections are not this thread's
+        await sync_to_async(self.add_query_timing)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(self.remove_query_timing)()
+            perf.end_record(record)
+        self.finish(request, response, record, time.perf_counter() - start)
+        return response
+
+    def finish(self, request, response, record, total):
+        response['Server-Timing'] = self.server_timing(record, total)
+        self.log(request, response, record, total)
+
+    @classmethod
+    def add_query_timing(cls):
+        for connection in connections.all():
+            connection.execute_wrappers.append(cls.record_query)
+
+    @classmethod
+    def remove_query_timing(cls):
+        for connection in connections.all():
+            if cls.record_query in connection.execute_wrappers:
+                connection.execute_wrappers.remove(cls.record_query)
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the view returns, time it with a post-render callback
+        record = perf.current_record()
+        if record is not None:
+            start = time.perf_counter()
+            response.add_post_render_callback(lambda r: record.add('render', time.perf_counter() - start))
+        return response
+
+    @staticmethod
+    def record_query(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            record = perf.current_record()
+            if record is not None:
+                record.add('db', time.perf_counter() - start)
+
+    @staticmethod
+    def server_timing(record, total):
+        metrics = []
+        for name, seconds in sorted(record.durations.items()):
+            metric = f'{name};dur={seconds * 1000:.2f}'
+            if name == 'db':
+                metric += f';desc="{record.counts[name]} queries"'
+            metrics.append(metric)
+        metrics.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(metrics)
+
+    @staticmethod
+    def log(request, response, record, total):
+        resolver_match = getattr(request, 'resolver_match', None)
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'view': resolver_match.view_name if resolver_match else None,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 2),
+            'db_queries': record.counts.get('db', 0),
+            'stages_ms': {name: round(seconds * 1000, 2) for name, seconds in sorted(record.durations.items())},
+        }))
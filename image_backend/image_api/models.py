@@ -1,27 +1,119 @@
+import os
+import uuid
+
 from autoslug import AutoSlugField
+from django.conf import settings
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
+from rest_framework.utils.encoders import JSONEncoder
+
+from .storage import ShardedUploadTo
 
 # Create your models here.
 
 class Tag(models.Model):
     name = models.CharField(max_length=50)
     name_slug = AutoSlugField(populate_from='name')
-    
+    # number of images with this tag, maintained by signals (see tag_counts.py)
+    image_count = models.PositiveIntegerField(default=0, editable=False)
+
     # TODO lsit of tag category
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # image_count is only written with F() updates, a stale in-memory value must not overwrite it
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'image_count'
+            ]
+        super().save(*args, **kwargs)
+
 class ImageInfo(models.Model):
-    image = models.ImageField(
-        upload_to='images/', height_field='height', width_field='width')
+    # no height_field/width_field: Django would read them from the file (a storage GET) when they are null,
+    # the file metadata below is recorded from the processed image when the file is stored
+    image = models.ImageField(upload_to=ShardedUploadTo('images'), db_index=True)
     title = models.CharField(max_length=255)
     description = models.TextField(blank=True, null=True)
     tags = models.ManyToManyField(Tag)
     height = models.PositiveIntegerField(null=True, blank=True, editable=False)
     width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    file_size = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+    format = models.CharField(max_length=10, null=True, blank=True, editable=False)
+    mime_type = models.CharField(max_length=50, null=True, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # title, description and tag names, maintained by signals (Postgres only, see search.py)
+    search_vector = SearchVectorField(null=True, editable=False)
     # TODO add user field
 
+    FILE_METADATA_FIELDS = ('width', 'height', 'file_size', 'format', 'mime_type')
+
     def __str__(self):
         return self.image.name
+
+
+class ImageVariant(models.Model):
+    """A copy of an image in another format and/or a smaller width, built on first request (see variants.py)."""
+    image = models.ForeignKey(ImageInfo, on_delete=models.CASCADE, related_name='variants')
+    format = models.CharField(max_length=10)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    # MediaView looks up every non-original media path here
+    file = models.FileField(upload_to=ShardedUploadTo('variants'), max_length=255, db_index=True)
+    size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['image', 'format', 'width'], name='unique_image_variant'),
+        ]
+
+    def __str__(self):
+        return self.file.name
+
+
+class UploadSession(models.Model):
+    """A resumable chunked upload, chunks are appended to `temp_path` until it is finalized into an ImageInfo."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    title = models.CharField(max_length=255)
+    description = models.TextField(blank=True, null=True)
+    tags = models.JSONField(default=list, blank=True)
+    file_ext = models.CharField(max_length=10, blank=True, null=True)
+    encoder_profile = models.CharField(max_length=20, blank=True, null=True)
+    # set while the completed file is processed, chunks and other finalize calls are rejected meanwhile
+    finalizing_at = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    @property
+    def temp_path(self):
+        return os.path.join(settings.UPLOAD_SESSION_DIR, f'{self.id}.part')
+
+    def __str__(self):
+        return f'{self.filename} ({self.offset}/{self.size})'
+
+
+class IdempotencyKey(models.Model):
+    """The response to a write sent with an Idempotency-Key header, replayed to retries of the same request."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    # hash of the method, path and body, the same key can't be reused for a different request
+    fingerprint = models.CharField(max_length=64)
+    # null while the first request runs, retries get 409 until its response is stored
+    status_code = models.PositiveSmallIntegerField(null=True)
+    # encoded like the JSON renderer does, querysets and lazy strings included
+    response_data = models.JSONField(null=True, encoder=JSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_key_per_user')]
+
+    def __str__(self):
+        return self.key
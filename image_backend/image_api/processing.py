@@ -0,0 +1,174 @@
+from typing import NamedTuple, Union
+
+import PIL.Image
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadedfile import InMemoryUploadedFile
+from rest_framework.exceptions import ValidationError
+
+from .metrics import UPLOAD_BYTES, UPLOAD_DECISIONS
+from .util.image_util import (ANIMATION_FILE_EXT, ENCODER_PROFILES, ImageHeader,
+                               ImageTooLargeError, ImageUtil)
+
+
+def image_metadata(header: ImageHeader, file_size: int) -> dict:
+    """ImageInfo.FILE_METADATA_FIELDS values of a stored file."""
+    # MPO is a JPEG carrying extra frames, served and decoded as a JPEG
+    image_format = 'JPEG' if header.format == 'MPO' else header.format
+    return {
+        'width': header.width,
+        'height': header.height,
+        'file_size': file_size,
+        'format': image_format,
+        'mime_type': PIL.Image.MIME.get(image_format),
+    }
+
+
+class ProcessedImage(NamedTuple):
+    file: File
+    header: ImageHeader  # header of the processed (stored) image
+
+    def metadata(self) -> dict:
+        """File metadata to store with the image, from the processed file in memory, never from storage."""
+        return image_metadata(self.header, self.file.size)
+
+
+class ImageProcessor:
+    """
+    Validation and pre-processing rules applied to every stored image (upload view, import command).
+
+    The header is checked before any pixel data is decoded. Images above MAX_IMG_SIZE are re-encoded
+    (and resized if needed) to fit, images in another format than `transform_ext` are converted,
+    anything else is stored byte-for-byte. Re-encoded images use the `encoder_profile` options
+    (IMAGE_ENCODER_PROFILE by default). Decoding is bounded by MEMORY_BUDGET, JPEGs over it are
+    decoded at a reduced scale, other images over it are rejected.
+
+    Animated GIF/WebP images keep their animation when re-encoded to WebP (the default for animations over
+    MAX_IMG_SIZE), frame by frame, up to MAX_ANIMATION_DURATION. Other formats keep the first frame.
+    """
+
+    SUPPORT_FILE_EXT = ["jpg", "png", "webp"]
+    SUPPORT_INPUT_FORMAT = ["JPEG", "MPO", "PNG", "WEBP", "GIF", "BMP", "TIFF"]
+    MAX_IMG_SIZE = 2 * 1024 * 1024  # 2MB
+    MAX_IMG_PIXELS = settings.IMAGE_MAX_PIXELS
+    MEMORY_BUDGET = settings.IMAGE_MEMORY_BUDGET
+    MAX_IMG_FRAMES = 300
+    MAX_ANIMATION_DURATION = 60 * 1000  # ms, checked while the frames are re-encoded
+    ENCODER_PROFILES = list(ENCODER_PROFILES)
+
+    def __init__(self, transform_ext=None, encoder_profile=None):
+        if transform_ext:
+            self.__validate_file_ext(transform_ext)
+        if encoder_profile and encoder_profile not in self.ENCODER_PROFILES:
+            raise ValidationError(f'Not Support encoder_profile: {encoder_profile}')
+        self.transform_ext = transform_ext
+        self.encoder_profile = encoder_profile or settings.IMAGE_ENCODER_PROFILE
+
+    def process(self, image: Union[File, None]) -> ProcessedImage:
+        """
+        Raises:
+            ValidationError: If the image breaks one of the rules above.
+        """
+        header = self.validate_image_header(image)
+        UPLOAD_BYTES.labels(direction='input').observe(image.size)
+        try:
+            processed = self.__validate_image(image, header)
+        except ImageTooLargeError as error:
+            raise ValidationError(f'Image is too large to process. {error}')
+        UPLOAD_BYTES.labels(direction='output').observe(processed.file.size)
+        return processed
+
+    def validate_image_header(self, image):
+        if not image:
+            raise ValidationError('No image file was submitted.')
+
+        # only the header is parsed here, pixel data is never decoded
+        try:
+            header = ImageUtil.read_image_header(image)
+        except PIL.Image.DecompressionBombError:
+            raise ValidationError(f'Image exceeds the maximum of {self.MAX_IMG_PIXELS} pixels.')
+        except (PIL.UnidentifiedImageError, OSError, SyntaxError):
+            raise ValidationError('Uploaded file is not a valid image.')
+
+        if header.format not in self.SUPPORT_INPUT_FORMAT:
+            raise ValidationError(f'Not Support image format: {header.format}')
+        if not header.width or not header.height:
+            raise ValidationError('Image has invalid dimensions.')
+        if header.pixel_count > self.MAX_IMG_PIXELS:
+            raise ValidationError(
+                f'Image dimensions {header.width}x{header.height} exceed the maximum of {self.MAX_IMG_PIXELS} pixels.'
+            )
+        if header.frame_count > self.MAX_IMG_FRAMES:
+            raise ValidationError(
+                f'Image has {header.frame_count} frames, exceeds the maximum of {self.MAX_IMG_FRAMES} frames.'
+            )
+        return header
+
+    def __validate_file_ext(self, file_ext):
+        if file_ext not in self.SUPPORT_FILE_EXT:
+            raise ValidationError(f'Not Support file_ext: {file_ext}')
+        return True
+
+    def __validate_image(self, image, header):
+        transform_ext = self.transform_ext
+
+        # size exceeded do resize
+        if image.size > self.MAX_IMG_SIZE:
+            UPLOAD_DECISIONS.labels(decision='resize').inc()
+            if not transform_ext:
+                default_ext = 'webp' if header.is_animation else 'jpeg'
+                return self.__resize_image(image, default_ext, self.MAX_IMG_SIZE, header)
+            else:
+                return self.__resize_image(image, transform_ext, self.MAX_IMG_SIZE, header)
+
+        # size not exceeded but image format needed to covert,
+        # otherwise the upload is stored byte-for-byte without decoding
+        if transform_ext and not self.__is_same_format(header.format, transform_ext):
+            UPLOAD_DECISIONS.labels(decision='convert').inc()
+            return self.__convert_image(image, transform_ext, header)
+
+        UPLOAD_DECISIONS.labels(decision='passthrough').inc()
+        return ProcessedImage(image, header)
+
+    @staticmethod
+    def __is_same_format(image_format, file_ext):
+        # jpg is jpeg in PIL, MPO is a JPEG carrying extra frames
+        if file_ext == 'jpg':
+            file_ext = 'jpeg'
+        if image_format == 'MPO':
+            image_format = 'JPEG'
+        return image_format == file_ext.upper()
+
+    def __resize_image(self, image, transform_ext, target_size, header):
+        if header.is_animation and transform_ext in ANIMATION_FILE_EXT:
+            resized_image = self.__reencode_animation(image, transform_ext, target_size)
+        else:
+            resized_image = ImageUtil.optimize_image_bytes_size(
+                image.read(), transform_ext, target_size, profile=self.encoder_profile, memory_budget=self.MEMORY_BUDGET
+            )
+        return self.__create_memory_upload_file(resized_image, image.name, transform_ext)
+
+    def __convert_image(self, image, transform_ext, header):
+        if header.is_animation and transform_ext in ANIMATION_FILE_EXT:
+            converted_image = self.__reencode_animation(image, transform_ext)
+            return self.__create_memory_upload_file(converted_image, image.name, transform_ext)
+
+        converted_image = ImageUtil.convert_image_type(image.read(), transform_ext, self.MEMORY_BUDGET)
+        converted_image = ImageUtil.PIL_to_bytes(converted_image, transform_ext, profile=self.encoder_profile)
+        return self.__create_memory_upload_file(converted_image, image.name, transform_ext)
+
+    def __reencode_animation(self, image, transform_ext, target_size=None):
+        return ImageUtil.reencode_animation(
+            image.read(), transform_ext, target_size=target_size, profile=self.encoder_profile,
+            memory_budget=self.MEMORY_BUDGET, max_duration=self.MAX_ANIMATION_DURATION,
+        )
+
+    def __create_memory_upload_file(self, image, image_name, ext):
+        if not image_name.endswith("." + ext):
+            image_name = image_name.replace(image_name.split(".")[-1], ext, 1)
+
+        new_image = InMemoryUploadedFile(image, None, image_name, 'image/' + ext, image.getbuffer().nbytes, None)
+        if not new_image:
+            raise ValidationError("Could not resize the image.")
+
+        return ProcessedImage(new_image, ImageUtil.read_image_header(image))
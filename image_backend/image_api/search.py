@@ -0,0 +1,83 @@
+import logging
+
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import DatabaseError, connections
+from django.db.models import F, OuterRef, Q, Subquery
+
+logger = logging.getLogger(__name__)
+
+# Postgres only, created after migrate since the GIN/trigram indexes can't be expressed portably in Meta.indexes.
+# The trigram indexes match the UPPER(...) LIKE query Django generates for icontains (admin search_fields).
+POSTGRES_SEARCH_DDL = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS image_api_imageinfo_search_vector_gin '
+    'ON image_api_imageinfo USING gin (search_vector)',
+    'CREATE INDEX IF NOT EXISTS image_api_imageinfo_title_trgm '
+    'ON image_api_imageinfo USING gin (UPPER(title::text) gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS image_api_imageinfo_image_trgm '
+    'ON image_api_imageinfo USING gin (UPPER(image::text) gin_trgm_ops)',
+]
+
+
+def search_config():
+    return getattr(settings, 'IMAGE_SEARCH_CONFIG', 'english')
+
+
+def is_postgres(queryset):
+    return connections[queryset.db].vendor == 'postgresql'
+
+
+def refresh_search_vectors(queryset):
+    """Recompute the stored search vector (title, description, tag names) of every image in the queryset."""
+    if not is_postgres(queryset):
+        return
+
+    config = search_config()
+    through = queryset.model.tags.through
+    tag_names = (
+        through.objects.filter(imageinfo=OuterRef('pk'))
+        .order_by()
+        .values('imageinfo')
+        .annotate(names=StringAgg('tag__name', ' '))
+        .values('names')
+    )
+    queryset.update(search_vector=(
+        SearchVector('title', weight='A', config=config)
+        + SearchVector('description', weight='B', config=config)
+        + SearchVector(Subquery(tag_names), weight='C', config=config)
+    ))
+
+
+def search_images(queryset, text):
+    """
+    Filter images matching `text`, ranked by relevance on Postgres.
+
+    Other databases (SQLite in tests) fall back to case-insensitive matching on the same fields.
+    """
+    if is_postgres(queryset):
+        query = SearchQuery(text, search_type='websearch', config=search_config())
+        return (
+            queryset.filter(search_vector=query)
+            .annotate(search_rank=SearchRank(F('search_vector'), query))
+            .order_by('-search_rank', '-id')
+        )
+
+    return queryset.filter(
+        Q(title__icontains=text) | Q(description__icontains=text) | Q(tags__name__icontains=text)
+    ).distinct()
+
+
+def create_search_indexes(using):
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+
+    with connection.cursor() as cursor:
+        for statement in POSTGRES_SEARCH_DDL:
+            try:
+                cursor.execute(statement)
+            except DatabaseError as error:
+                # e.g. missing privilege for CREATE EXTENSION, search still works without the indexes
+                logger.warning(f"Could not create search index: {error}")
@@ -1,19 +1,36 @@
 import json
+from collections import defaultdict
 
+from django.conf import settings
 from django.http import QueryDict
 from rest_framework import serializers
 
-from .models import ImageInfo, Tag
+from .models import ImageInfo, Tag, UploadSession
+from .processing import ImageProcessor
 from .util.image_util import ImageUtil
+from .util.perf import stage
+from .variants import srcset
 
 
-class TagSerializer(serializers.ModelSerializer):
+class TimedRepresentationMixin:
+
+    def to_representation(self, instance):
+        with stage('serialize'):
+            return super().to_representation(instance)
+
+
+class TagSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     label = serializers.CharField(source='name')
     value = serializers.CharField(source='name_slug')
+    count = serializers.IntegerField(source='image_count', read_only=True)
 
     class Meta:
         model = Tag
-        fields = ('label', 'value')
+        fields = ('label', 'value', 'count')
+
+
+class TagFacetSerializer(TagSerializer):
+    count = serializers.IntegerField(source='facet_count', read_only=True)
 
 
 class TagListingField(serializers.RelatedField):
@@ -22,15 +39,110 @@ class TagListingField(serializers.RelatedField):
         return value.name
 
 
-class ImageSerializer(serializers.ModelSerializer):
+class SparseFieldsMixin:
+    """Serialize only the fields listed in context['fields'], DEFAULT_FIELDS when not given."""
+
+    DEFAULT_FIELDS = None
+
+    def get_field_names(self, declared_fields, info):
+        field_names = super().get_field_names(declared_fields, info)
+        requested = self.context.get('fields') or self.DEFAULT_FIELDS
+        if requested is None:
+            return field_names
+        return [name for name in field_names if name in requested]
+
+
+class ImageSerializer(TimedRepresentationMixin, SparseFieldsMixin, serializers.ModelSerializer):
     tags = TagListingField(many=True, read_only=True)
+    srcset = serializers.SerializerMethodField()
+
+    DEFAULT_FIELDS = ('id', 'image', 'title', 'description', 'tags', 'srcset')
+    EXPANDABLE_FIELDS = ('tags',)
 
     class Meta:
         model = ImageInfo
-        fields = ('id', 'image', 'title', 'description', 'tags')
-
-
-class ImageUploadSerializer(serializers.ModelSerializer):
+        fields = ('id', 'image', 'title', 'description', 'tags', 'srcset', 'width', 'height', 'file_size', 'format',
+                  'mime_type', 'created_at')
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if 'tags' in fields and 'tags' in self.context.get('expand', ()):
+            fields['tags'] = TagSerializer(many=True, read_only=True)
+        return fields
+
+    def get_srcset(self, obj):
+        return srcset(obj.pk, obj.width if obj.image else None, self.context.get('request'))
+
+    @staticmethod
+    def model_columns(fields):
+        """Columns to load for `fields`, for QuerySet.only()."""
+        columns = {'id'} | {name for name in fields if name not in ('tags', 'srcset')}
+        if 'srcset' in fields:
+            columns |= {'image', 'width'}
+        return sorted(columns)
+
+
+class ImageValuesSerializer:
+    """
+    Fast path for image lists, builds the same output as ImageSerializer from `.values()` rows
+    and one query for the tags, without model instances or per-row field objects.
+    """
+
+    def __init__(self, fields=ImageSerializer.DEFAULT_FIELDS, expand=(), context=None):
+        self.fields = fields
+        self.expand = expand
+        self.context = context or {}
+        self.storage = ImageInfo._meta.get_field('image').storage
+        self.datetime_field = serializers.DateTimeField()
+
+    def select(self, queryset):
+        columns = {name for name in self.fields if name not in ('id', 'tags', 'srcset')}
+        if 'srcset' in self.fields:
+            columns |= {'image', 'width'}
+        return queryset.values('id', *sorted(columns))
+
+    def select_tags(self, rows):
+        through = ImageInfo.tags.through
+        if 'tags' not in self.fields:
+            return through.objects.none()
+
+        columns = ['imageinfo_id', 'tag__name']
+        if 'tags' in self.expand:
+            columns += ['tag__name_slug', 'tag__image_count']
+        return through.objects.filter(imageinfo_id__in=[row['id'] for row in rows]).values_list(*columns)
+
+    def to_representation(self, rows, tag_rows):
+        with stage('serialize'):
+            tags = defaultdict(list)
+            for image_id, name, *expanded in tag_rows:
+                tags[image_id].append({'label': name, 'value': expanded[0], 'count': expanded[1]} if expanded else name)
+
+            request = self.context.get('request')
+            return [self.row_representation(row, tags, request) for row in rows]
+
+    def row_representation(self, row, tags, request):
+        data = {}
+        for name in self.fields:
+            if name == 'tags':
+                data[name] = tags.get(row['id'], [])
+            elif name == 'image':
+                data[name] = self.image_url(row[name], request)
+            elif name == 'srcset':
+                data[name] = srcset(row['id'], row['width'] if row['image'] else None, request)
+            elif name == 'created_at':
+                data[name] = self.datetime_field.to_representation(row[name])
+            else:
+                data[name] = row[name]
+        return data
+
+    def image_url(self, name, request):
+        if not name:
+            return None
+        url = self.storage.url(name)
+        return request.build_absolute_uri(url) if request is not None else url
+
+
+class ImageUploadSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     tags = serializers.ListField(child=serializers.CharField(max_length=50), write_only=True, required=False)
     tags_info = serializers.SerializerMethodField()
 
@@ -54,7 +166,7 @@ class ImageUploadSerializer(serializers.ModelSerializer):
         return instance
 
 
-class ImageUpdateSerializer(serializers.ModelSerializer):
+class ImageUpdateSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     tags = serializers.ListField(
         child=serializers.CharField(max_length=50), required=False, write_only=True)
 
@@ -82,3 +194,22 @@ class ImageUpdateSerializer(serializers.ModelSerializer):
 
         instance.save()
         return instance
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    tags = serializers.ListField(child=serializers.CharField(max_length=50), required=False)
+    file_ext = serializers.ChoiceField(choices=ImageProcessor.SUPPORT_FILE_EXT, required=False, allow_null=True)
+    encoder_profile = serializers.ChoiceField(choices=ImageProcessor.ENCODER_PROFILES, required=False, allow_null=True)
+
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'filename', 'size', 'offset', 'title', 'description', 'tags', 'file_ext', 'encoder_profile',
+                  'expires_at')
+        read_only_fields = ('offset', 'expires_at')
+
+    def validate_size(self, value):
+        if not value:
+            raise serializers.ValidationError('size must be greater than 0.')
+        if value > settings.UPLOAD_SESSION_MAX_SIZE:
+            raise serializers.ValidationError(f'size exceeds the maximum of {settings.UPLOAD_SESSION_MAX_SIZE} bytes.')
+        return value
@@ -2,11 +2,17 @@ import logging
 import os
 
 from django.conf import settings
-from django.db.models.signals import post_delete
+from django.db import transaction
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete)
 from django.dispatch import receiver
-from storages.backends.s3boto3 import S3Boto3Storage
 
-from .models import ImageInfo
+from .models import ImageInfo, ImageVariant, Tag, UploadSession
+from .search import create_search_indexes, refresh_search_vectors
+from .storage import TimedS3Boto3Storage
+from .tag_counts import adjust_tag_image_counts
+from .tag_index import tag_index
+from .util.perf import stage
 
 logger = logging.getLogger(__name__)
 
@@ -17,10 +23,102 @@ def delete_image_from_s3(sender, instance, **kwargs):
     if not settings.IS_PRODUCTION:
         # Delete the image file from the local directory
         image_path = instance.image.path
-        if os.path.exists(image_path):
-            os.remove(image_path)
+        with stage('storage.delete'):
+            try:
+                os.remove(image_path)
+            except FileNotFoundError:
+                pass
     else:
         # Delete the image file from S3 using django-storages
         file_name = instance.image.name
-        storage = S3Boto3Storage()
+        storage = TimedS3Boto3Storage()
         storage.delete(file_name)
+
+
+@receiver(post_save, sender=ImageInfo)
+def update_image_search_vector(sender, instance, **kwargs):
+    refresh_search_vectors(ImageInfo.objects.filter(pk=instance.pk))
+
+
+@receiver(m2m_changed, sender=ImageInfo.tags.through)
+def update_tagged_images_search_vector(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        refresh_search_vectors(ImageInfo.objects.filter(pk=instance.pk))
+    elif pk_set:
+        refresh_search_vectors(ImageInfo.objects.filter(pk__in=pk_set))
+
+
+@receiver(post_save, sender=Tag)
+def update_renamed_tag_search_vector(sender, instance, created, **kwargs):
+    if not created:
+        refresh_search_vectors(ImageInfo.objects.filter(tags=instance))
+
+
+def create_search_index(sender, using, **kwargs):
+    create_search_indexes(using)
+    # rows created before the search vector existed
+    refresh_search_vectors(ImageInfo.objects.using(using).filter(search_vector__isnull=True))
+
+
+@receiver(post_save, sender=Tag)
+def index_saved_tag(sender, instance, **kwargs):
+    transaction.on_commit(lambda: tag_index.upsert(instance))
+
+
+@receiver(post_delete, sender=Tag)
+def unindex_deleted_tag(sender, instance, **kwargs):
+    tag_id = instance.id
+    transaction.on_commit(lambda: tag_index.remove(tag_id))
+
+
+@receiver(m2m_changed, sender=ImageInfo.tags.through)
+def update_tag_usage_on_tags_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # the cleared rows are gone by post_clear, remember which tags lose how many usages
+        if reverse:
+            instance._cleared_tag_usage = ([instance.pk], -instance.imageinfo_set.count())
+        else:
+            instance._cleared_tag_usage = (list(instance.tags.values_list('pk', flat=True)), -1)
+        return
+
+    if action in ('post_add', 'post_remove'):
+        delta = 1 if action == 'post_add' else -1
+        if reverse:
+            tag_ids, delta = [instance.pk], delta * len(pk_set)
+        else:
+            tag_ids = list(pk_set)
+    elif action == 'post_clear':
+        tag_ids, delta = instance._cleared_tag_usage
+    else:
+        return
+
+    if tag_ids and delta:
+        adjust_tag_image_counts(tag_ids, delta)
+        transaction.on_commit(lambda: tag_index.adjust_counts(tag_ids, delta))
+
+
+@receiver(pre_delete, sender=ImageInfo)
+def update_tag_usage_on_image_delete(sender, instance, **kwargs):
+    # the through rows are removed by cascade, which sends no m2m_changed signal
+    tag_ids = list(instance.tags.values_list('pk', flat=True))
+    if tag_ids:
+        adjust_tag_image_counts(tag_ids, -1)
+        transaction.on_commit(lambda: tag_index.adjust_counts(tag_ids, -1))
+
+
+@receiver(post_delete, sender=UploadSession)
+def delete_upload_session_file(sender, instance, **kwargs):
+    temp_path = instance.temp_path
+
+    def remove():
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    transaction.on_commit(remove)
+
+
+@receiver(post_delete, sender=ImageVariant)
+def delete_image_variant_file(sender, instance, **kwargs):
+    storage, name = instance.file.storage, instance.file.name
+    transaction.on_commit(lambda: storage.delete(name))
@@ -0,0 +1,61 @@
+import os
+import re
+import uuid
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+from storages.backends.s3boto3 import S3Boto3Storage
+
+from .util.perf import stage
+
+
+class TimedStorageMixin:
+    """Record the time spent in storage I/O on the current request's perf record."""
+
+    def _save(self, name, content):
+        with stage('storage.write'):
+            return super()._save(name, content)
+
+    def _open(self, name, mode='rb'):
+        with stage('storage.read'):
+            return super()._open(name, mode)
+
+    def delete(self, name):
+        with stage('storage.delete'):
+            return super().delete(name)
+
+    def exists(self, name):
+        with stage('storage.exists'):
+            return super().exists(name)
+
+
+class TimedFileSystemStorage(TimedStorageMixin, FileSystemStorage):
+    pass
+
+
+class TimedS3Boto3Storage(TimedStorageMixin, S3Boto3Storage):
+    pass
+
+
+@deconstructible
+class ShardedUploadTo:
+    """
+    `upload_to` spreading files over two levels of 256 directories: `<prefix>/ab/cd/<key>.<ext>` where `abcd...` is
+    a random hex key, so directories stay small on local disks and keys are spread over S3 prefixes.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix.rstrip('/')
+        self.sharded_re = re.compile(rf'^{re.escape(self.prefix)}/[0-9a-f]{{2}}/[0-9a-f]{{2}}/[^/]+$')
+
+    def __call__(self, instance, filename):
+        # instance is None for files stored outside a model save (import, reprocess, variants)
+        key = uuid.uuid4().hex
+        ext = os.path.splitext(filename)[1].lower()
+        return f'{self.prefix}/{key[:2]}/{key[2:4]}/{key}{ext}'
+
+    def is_sharded(self, name):
+        return bool(self.sharded_re.match(name))
+
+    def __eq__(self, other):
+        return isinstance(other, ShardedUploadTo) and self.prefix == other.prefix
@@ -0,0 +1,22 @@
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import ImageInfo, Tag
+
+
+def adjust_tag_image_counts(tag_ids, delta):
+    """Atomically add `delta` to the stored image count of the given tags (never below zero)."""
+    Tag.objects.filter(pk__in=tag_ids).update(image_count=Greatest(F('image_count') + delta, Value(0)))
+
+
+def recount_tag_image_counts(queryset=None):
+    """Recompute the stored image count from the through table, e.g. after bulk inserts that send no signals."""
+    queryset = Tag.objects.all() if queryset is None else queryset
+    usage = (
+        ImageInfo.tags.through.objects.filter(tag=OuterRef('pk'))
+        .order_by()
+        .values('tag')
+        .annotate(usage=Count('*'))
+        .values('usage')
+    )
+    return queryset.update(image_count=Coalesce(Subquery(usage), Value(0)))
@@ -0,0 +1,103 @@
+import heapq
+import threading
+import time
+from bisect import bisect_left, insort
+from typing import Dict, List, NamedTuple, Optional
+
+from django.conf import settings
+
+from .models import Tag
+
+
+class TagEntry(NamedTuple):
+    id: int
+    name: str
+    name_slug: str
+    count: int
+
+
+class TagPrefixIndex:
+    """
+    In-process prefix index over tag `name` and `name_slug`, ranked by usage count.
+
+    Kept up to date incrementally by the tag signals of this process, and fully reloaded
+    every TAG_INDEX_TTL seconds so workers converge on changes made by other processes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys: List[tuple] = []  # sorted (key, tag_id)
+        self._entries: Dict[int, TagEntry] = {}
+        self._loaded_at: Optional[float] = None
+
+    @staticmethod
+    def _tag_keys(entry: TagEntry):
+        return {entry.name.casefold(), entry.name_slug}
+
+    def _ensure_loaded(self):
+        ttl = getattr(settings, 'TAG_INDEX_TTL', 300)
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < ttl:
+            return
+        self.reload()
+
+    def reload(self):
+        entries = {
+            tag.id: TagEntry(tag.id, tag.name, tag.name_slug, tag.image_count)
+            for tag in Tag.objects.only('name', 'name_slug', 'image_count')
+        }
+        keys = sorted((key, entry.id) for entry in entries.values() for key in self._tag_keys(entry))
+        with self._lock:
+            self._entries = entries
+            self._keys = keys
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def suggest(self, prefix: str, limit: int = 10) -> List[TagEntry]:
+        """Tags whose name or slug starts with `prefix` (case-insensitive), most used first."""
+        self._ensure_loaded()
+        prefix = prefix.casefold()
+        with self._lock:
+            matched = set()
+            position = bisect_left(self._keys, (prefix,))
+            while position < len(self._keys) and self._keys[position][0].startswith(prefix):
+                matched.add(self._keys[position][1])
+                position += 1
+            entries = [self._entries[tag_id] for tag_id in matched]
+        return heapq.nsmallest(limit, entries, key=lambda entry: (-entry.count, entry.name.casefold()))
+
+    def upsert(self, tag):
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            previous = self._entries.get(tag.id)
+            entry = TagEntry(tag.id, tag.name, tag.name_slug, previous.count if previous else 0)
+            self._replace(previous, entry)
+
+    def remove(self, tag_id: int):
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            self._replace(self._entries.get(tag_id), None)
+
+    def adjust_counts(self, tag_ids, delta: int):
+        with self._lock:
+            for tag_id in tag_ids:
+                entry = self._entries.get(tag_id)
+                if entry:
+                    self._entries[tag_id] = entry._replace(count=max(entry.count + delta, 0))
+
+    def _replace(self, previous: Optional[TagEntry], entry: Optional[TagEntry]):
+        if previous:
+            for key in self._tag_keys(previous):
+                self._keys.remove((key, previous.id))
+            del self._entries[previous.id]
+        if entry:
+            for key in self._tag_keys(entry):
+                insort(self._keys, (key, entry.id))
+            self._entries[entry.id] = entry
+
+
+tag_index = TagPrefixIndex()
@@ -1,21 +1,41 @@
+import json
 import os
-from datetime import datetime
-from io import BytesIO
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
+from asgiref.sync import async_to_sync
 from django.conf import settings
 from django.contrib.auth.models import Group, User
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
 from django.db.models.signals import post_delete
-from django.test import RequestFactory, TestCase
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from image_api.signals import delete_image_from_s3
 from PIL import Image
 from rest_framework import status
-from rest_framework.test import APIClient, APITestCase, force_authenticate
+from rest_framework.response import Response
+from rest_framework.test import (APIClient, APIRequestFactory, APITestCase,
+                                 force_authenticate)
 
-from ..models import ImageInfo, Tag
-from ..serializers import ImageUploadSerializer
+from ..async_views import (AsyncImageListView, AsyncImageRetrieveView,
+                           AsyncTagListView)
+from ..db_router import ReplicaRouter, use_read_alias
+from ..export import aiter_ndjson
+from ..models import IdempotencyKey, ImageInfo, Tag, UploadSession
+from ..processing import ImageProcessor
+from ..serializers import (ImageSerializer, ImageUploadSerializer,
+                           ImageValuesSerializer)
+from ..tag_index import tag_index
+from ..throttling import RoleTokenBucketThrottle, processing_slot
+from ..util.image_util import ImageUtil
 from ..views import ImageUploadView
 
 
@@ -99,6 +119,30 @@ class ImageAndTagGetTest(APITestCase):
         )
         self.assertEqual(response_before.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_search_image_list(self):
+        self.image1.title = 'Sunset over Tokyo'
+        self.image1.save()
+        self.image2.description = 'Mountain lake at dawn'
+        self.image2.save()
+        self.image2.tags.set([self.tag1])
+
+        response = self.client.get(self.url_image_list, {'q': 'tokyo'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([image['title'] for image in response.data], ['Sunset over Tokyo'])
+
+        response = self.client.get(self.url_image_list, {'q': 'mountain'})
+        self.assertEqual([image['title'] for image in response.data], ['image2'])
+
+        # tag names are searchable too
+        response = self.client.get(self.url_image_list, {'q': 'tag1'})
+        self.assertEqual([image['title'] for image in response.data], ['image2'])
+
+        response = self.client.get(self.url_image_list, {'q': 'tokyo', 'tags': ['tag1']})
+        self.assertEqual(len(response.data), 0)
+
+        response = self.client.get(self.url_image_list, {'q': 'nothing-matches'})
+        self.assertEqual(len(response.data), 0)
+
     def test_apply_limit_and_offset_to_image_list(self):
         # Assuming you have at least 5 images in the database
         response_off1_lim1 = self.client.get(self.url_image_list, {'limit': 1, 'offset': 1})
@@ -109,6 +153,280 @@ class ImageAndTagGetTest(APITestCase):
         self.assertEqual(response_off0_lim2.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response_off0_lim2.data), 2)
 
+    def test_image_list_matches_image_serializer(self):
+        ImageInfo.objects.filter(pk=self.image1.pk).update(image='images/image1.png', width=1000, height=500)
+        self.image1.tags.set([self.tag1, self.tag2])
+
+        response = self.client.get(self.url_image_list, {'fields': ','.join(ImageSerializer.Meta.fields)})
+        request = response.wsgi_request
+        expected = ImageSerializer(
+            ImageInfo.objects.all(), many=True,
+            context={'request': request, 'fields': ImageSerializer.Meta.fields},
+        ).data
+        self.assertEqual(response.data, expected)
+        self.assertEqual(self.client.get(self.url_image_list).data[0].keys(), set(ImageSerializer.DEFAULT_FIELDS))
+
+    def test_sparse_fieldset_on_image_list(self):
+        self.image1.tags.set([self.tag1])
+        through_table = ImageInfo.tags.through._meta.db_table
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url_image_list, {'fields': 'title,id'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [{'id': self.image1.id, 'title': 'image1'}, {'id': self.image2.id, 'title': 'image2'}])
+        self.assertFalse(any(through_table in query['sql'] for query in queries.captured_queries))
+        self.assertFalse(any('description' in query['sql'] for query in queries.captured_queries))
+
+        response = self.client.get(self.url_image_list, {'fields': 'id,tags', 'expand': 'tags', 'tags': 'tag1'})
+        self.assertEqual(response.data, [{'id': self.image1.id, 'tags': [{'label': 'tag1', 'value': 'tag1', 'count': 1}]}])
+
+        response = self.client.get(self.url_image_list, {'fields': 'id,secret'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_sparse_fieldset_on_image_retrieve(self):
+        self.image1.tags.set([self.tag1])
+        url = reverse('image-retrieve', kwargs={'pk': self.image1.pk})
+
+        response = self.client.get(url, {'fields': 'id,tags', 'expand': 'tags'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'id': self.image1.id, 'tags': [{'label': 'tag1', 'value': 'tag1', 'count': 1}]})
+
+        response = self.client.get(url, {'fields': 'title,created_at'})
+        self.assertEqual(response.data, {'title': 'image1', 'created_at': '2023-06-01T00:00:00Z'})
+
+    def test_paginated_tag_list(self):
+        response = self.client.get(self.url_tag_list, {'limit': 1, 'offset': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual([tag['label'] for tag in response.data['results']], ['tag2'])
+
+
+class TagCountTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='guest', password='test')
+        self.user.groups.add(Group.objects.create(name='guest'))
+        self.client.force_authenticate(user=self.user)
+
+        self.tag1 = Tag.objects.create(name='tag1')
+        self.tag2 = Tag.objects.create(name='tag2')
+        self.tag3 = Tag.objects.create(name='tag3')
+        self.image1 = ImageInfo.objects.create(title='sunset')
+        self.image2 = ImageInfo.objects.create(title='beach')
+        self.image3 = ImageInfo.objects.create(title='sunrise')
+        self.image1.tags.set([self.tag1, self.tag2])
+        self.image2.tags.set([self.tag1])
+        self.image3.tags.set([self.tag2, self.tag3])
+
+    def assertCounts(self, expected):
+        counts = dict(Tag.objects.values_list('name', 'image_count'))
+        self.assertEqual(counts, expected)
+
+    def test_counts_follow_tag_changes(self):
+        self.assertCounts({'tag1': 2, 'tag2': 2, 'tag3': 1})
+
+        self.image1.tags.remove(self.tag2)
+        self.tag3.imageinfo_set.add(self.image1, self.image2)
+        self.assertCounts({'tag1': 2, 'tag2': 1, 'tag3': 3})
+
+        self.image2.tags.clear()
+        self.tag3.imageinfo_set.clear()
+        self.assertCounts({'tag1': 1, 'tag2': 1, 'tag3': 0})
+
+        self.image1.delete()
+        self.assertCounts({'tag1': 0, 'tag2': 1, 'tag3': 0})
+
+    def test_saving_a_stale_tag_keeps_its_count(self):
+        self.image2.tags.add(self.tag3)  # self.tag3.image_count is still 1 in memory
+        self.tag3.name = 'tag3 renamed'
+        self.tag3.save()
+        self.assertEqual(Tag.objects.get(pk=self.tag3.pk).image_count, 2)
+
+    def test_recount_tags_command(self):
+        Tag.objects.update(image_count=0)
+        call_command('recount_tags', stdout=StringIO())
+        self.assertCounts({'tag1': 2, 'tag2': 2, 'tag3': 1})
+
+    def test_tag_list_includes_counts(self):
+        response = self.client.get(reverse('tag-list'))
+        self.assertEqual({tag['label']: tag['count'] for tag in response.data}, {'tag1': 2, 'tag2': 2, 'tag3': 1})
+
+    def test_facets_without_filters_use_stored_counts(self):
+        through_table = ImageInfo.tags.through._meta.db_table
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('tag-facets'))
+        self.assertFalse(any(through_table in query['sql'] for query in queries.captured_queries))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [
+            {'label': 'tag1', 'value': 'tag1', 'count': 2},
+            {'label': 'tag2', 'value': 'tag2', 'count': 2},
+            {'label': 'tag3', 'value': 'tag3', 'count': 1},
+        ])
+
+    def test_facets_follow_image_list_filters(self):
+        response = self.client.get(reverse('tag-facets'), {'q': 'sun'})
+        self.assertEqual([(tag['label'], tag['count']) for tag in response.data], [('tag2', 2), ('tag1', 1), ('tag3', 1)])
+
+        response = self.client.get(reverse('tag-facets'), {'tags': ['tag3'], 'facet_limit': 2})
+        self.assertEqual([(tag['label'], tag['count']) for tag in response.data], [('tag2', 1), ('tag3', 1)])
+
+
+class TagSuggestTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='guest', password='test')
+        self.user.groups.add(Group.objects.create(name='guest'))
+        self.client.force_authenticate(user=self.user)
+        tag_index.invalidate()
+
+        self.landscape = Tag.objects.create(name='Landscape')
+        self.lake = Tag.objects.create(name='Lake')
+        self.tokyo = Tag.objects.create(name='Tokyo Night')
+        for title in ('image1', 'image2'):
+            ImageInfo.objects.create(title=title).tags.set([self.lake])
+        ImageInfo.objects.create(title='image3').tags.set([self.landscape, self.tokyo])
+
+        self.url_tag_suggest = reverse('tag-suggest')
+
+    def test_suggest_by_prefix_ranked_by_usage(self):
+        response = self.client.get(self.url_tag_suggest, {'prefix': 'la'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [
+            {'label': 'Lake', 'value': 'lake', 'count': 2},
+            {'label': 'Landscape', 'value': 'landscape', 'count': 1},
+        ])
+
+        response = self.client.get(self.url_tag_suggest, {'prefix': 'tokyo-', 'limit': 5})
+        self.assertEqual([tag['label'] for tag in response.data], ['Tokyo Night'])
+
+    def test_suggest_is_updated_incrementally(self):
+        self.client.get(self.url_tag_suggest, {'prefix': 'la'})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.create(name='Lava')
+        with self.captureOnCommitCallbacks(execute=True):
+            ImageInfo.objects.get(title='image3').tags.add(Tag.objects.get(name='Lava'))
+        with self.captureOnCommitCallbacks(execute=True):
+            ImageInfo.objects.get(title='image1').delete()
+
+        with mock.patch.object(tag_index, 'reload') as reload_mock:
+            response = self.client.get(self.url_tag_suggest, {'prefix': 'la'})
+        reload_mock.assert_not_called()
+        self.assertEqual(response.data, [
+            {'label': 'Lake', 'value': 'lake', 'count': 1},
+            {'label': 'Landscape', 'value': 'landscape', 'count': 1},
+            {'label': 'Lava', 'value': 'lava', 'count': 1},
+        ])
+
+    def test_invalid_limit_is_rejected(self):
+        response = self.client.get(self.url_tag_suggest, {'prefix': 'la', 'limit': 'ten'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ImageExportTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='guest', password='test')
+        self.user.groups.add(Group.objects.create(name='guest'))
+        self.client.force_authenticate(user=self.user)
+
+        self.tag1 = Tag.objects.create(name='tag1')
+        self.tag2 = Tag.objects.create(name='tag2')
+        self.images = [ImageInfo.objects.create(title=f'image{i}') for i in range(5)]
+        for image in self.images[:3]:
+            image.tags.set([self.tag1, self.tag2])
+
+    def parse_ndjson(self, content):
+        return [json.loads(line) for line in content.splitlines()]
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_export_streams_filtered_images(self):
+        response = self.client.get(reverse('image-export'), {'tags': 'tag1', 'fields': 'id,title,tags'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+
+        lines = self.parse_ndjson(b''.join(response.streaming_content).decode())
+        self.assertEqual(lines, [
+            {'id': image.id, 'title': image.title, 'tags': ['tag1', 'tag2']} for image in self.images[:3]
+        ])
+
+    def test_export_includes_all_fields_by_default(self):
+        response = self.client.get(reverse('image-export'))
+        lines = self.parse_ndjson(b''.join(response.streaming_content).decode())
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(tuple(lines[0]), ImageSerializer.Meta.fields)
+
+    def test_async_export_iterator(self):
+        serializer = ImageValuesSerializer(('id', 'tags'))
+        queryset = serializer.select(ImageInfo.objects.all()).order_by('id')
+
+        async def collect():
+            return ''.join([chunk async for chunk in aiter_ndjson(queryset, serializer, chunk_size=2)])
+
+        lines = self.parse_ndjson(async_to_sync(collect)())
+        self.assertEqual([line['id'] for line in lines], [image.id for image in self.images])
+        self.assertEqual(lines[0]['tags'], ['tag1', 'tag2'])
+        self.assertEqual(lines[4]['tags'], [])
+
+    def test_export_images_command(self):
+        output = StringIO()
+        call_command('export_images', '--tags', 'tag2', '--fields', 'title', '--chunk-size', '2', stdout=output, stderr=StringIO())
+        self.assertEqual(self.parse_ndjson(output.getvalue()), [{'title': image.title} for image in self.images[:3]])
+
+
+class AsyncReadViewTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='guest', password='test')
+        self.user.groups.add(Group.objects.create(name='guest'))
+        self.factory = APIRequestFactory()
+
+        self.tag1 = Tag.objects.create(name='tag1')
+        self.tag2 = Tag.objects.create(name='tag2')
+        self.image1 = ImageInfo.objects.create(title='image1', description='description1')
+        self.image2 = ImageInfo.objects.create(title='image2', description='description2')
+        self.image1.tags.set([self.tag1])
+        self.image2.tags.set([self.tag2])
+
+    def call_view(self, view_class, path, user=None, data=None, **kwargs):
+        request = self.factory.get(path, data)
+        if user:
+            force_authenticate(request, user=user)
+        response = async_to_sync(view_class.as_view())(request, **kwargs)
+        return response.render()
+
+    def test_async_image_list(self):
+        response = self.call_view(AsyncImageListView, '/', self.user, {'tags': ['tag1']})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['tags'], ['tag1'])
+
+        response = self.call_view(AsyncImageListView, '/', self.user, {'fields': 'id,tags', 'expand': 'tags'})
+        self.assertEqual(response.data[1], {'id': self.image2.id, 'tags': [{'label': 'tag2', 'value': 'tag2', 'count': 1}]})
+
+    def test_async_image_retrieve(self):
+        response = self.call_view(AsyncImageRetrieveView, '/', self.user, pk=self.image2.pk)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['title'], 'image2')
+
+        response = self.call_view(AsyncImageRetrieveView, '/', self.user, pk=self.image2.pk + 100)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_async_tag_list(self):
+        response = self.call_view(AsyncTagListView, '/', self.user)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 2)
+
+        response = self.call_view(AsyncTagListView, '/', self.user, {'limit': 1})
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_async_views_require_authentication(self):
+        response = self.call_view(AsyncImageListView, '/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
 class ImageUploadTest(APITestCase):
 
     def setUp(self):
@@ -150,8 +468,99 @@ class ImageUploadTest(APITestCase):
         }
         response = self.client.post(self.url_image_upload, data, format='multipart')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'][0], 'Uploaded file is not a valid image.')
+        self.assertEqual(ImageInfo.objects.count(), 0)
+
+    def test_unsupported_image_format_is_rejected(self):
+        data = {'image': create_test_image(file_ext='ppm'), 'title': 'Test Image'}
+        response = self.client.post(self.url_image_upload, data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'][0], 'Not Support image format: PPM')
+        self.assertEqual(ImageInfo.objects.count(), 0)
+
+    def test_image_exceeding_pixel_limit_is_rejected_before_decoding(self):
+        data = {'image': create_test_image(img_size=(200, 100)), 'title': 'Test Image'}
+        with mock.patch.object(ImageProcessor, 'MAX_IMG_PIXELS', 100 * 100), \
+                mock.patch('image_api.processing.ImageUtil.convert_image_type') as convert_mock:
+            response = self.client.post(f"{self.url_image_upload}?file_ext=webp", data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('200x100', response.data['error'][0])
+        convert_mock.assert_not_called()
         self.assertEqual(ImageInfo.objects.count(), 0)
 
+    def test_image_exceeding_frame_limit_is_rejected(self):
+        file = BytesIO()
+        frames = [Image.new('RGB', (10, 10), color) for color in ('red', 'green', 'blue')]
+        frames[0].save(file, 'gif', save_all=True, append_images=frames[1:])
+        data = {'image': SimpleUploadedFile('anim.gif', file.getvalue()), 'title': 'Test Image'}
+        with mock.patch.object(ImageProcessor, 'MAX_IMG_FRAMES', 2):
+            response = self.client.post(self.url_image_upload, data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('3 frames', response.data['error'][0])
+
+    def test_animated_gif_keeps_its_animation_as_webp(self):
+        file = BytesIO()
+        frames = [Image.new('RGB', (40, 30), color) for color in ('red', 'green', 'blue')]
+        frames[0].save(file, 'gif', save_all=True, append_images=frames[1:], duration=100, loop=0)
+        data = {'image': SimpleUploadedFile('anim.gif', file.getvalue()), 'title': 'Test Image'}
+        response = self.client.post(f"{self.url_image_upload}?file_ext=webp", data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        image_info = ImageInfo.objects.get(title='Test Image')
+        try:
+            with Image.open(image_info.image.path) as stored:
+                self.assertEqual((stored.format, stored.size, stored.n_frames), ('WEBP', (40, 30), 3))
+                stored.seek(2)
+                self.assertEqual(stored.convert('RGB').getpixel((0, 0)), (0, 0, 255))
+        finally:
+            os.remove(settings.MEDIA_ROOT + image_info.image.name)
+
+    def test_animation_exceeding_duration_limit_is_rejected(self):
+        file = BytesIO()
+        frames = [Image.new('RGB', (10, 10), color) for color in ('red', 'green', 'blue')]
+        frames[0].save(file, 'gif', save_all=True, append_images=frames[1:], duration=500)
+        data = {'image': SimpleUploadedFile('anim.gif', file.getvalue()), 'title': 'Test Image'}
+        with mock.patch.object(ImageProcessor, 'MAX_ANIMATION_DURATION', 1000):
+            response = self.client.post(f"{self.url_image_upload}?file_ext=webp", data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('more than 1 seconds', response.data['error'][0])
+        self.assertEqual(ImageInfo.objects.count(), 0)
+
+    def test_image_over_memory_budget_is_rejected(self):
+        data = {'image': create_test_image(img_size=(400, 400)), 'title': 'Test Image'}
+        with mock.patch.object(ImageProcessor, 'MEMORY_BUDGET', 400 * 400 * 4):
+            response = self.client.post(f"{self.url_image_upload}?file_ext=webp", data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('too large to process', response.data['error'][0])
+        self.assertEqual(ImageInfo.objects.count(), 0)
+
+    def test_jpeg_over_memory_budget_is_decoded_at_reduced_scale(self):
+        data = {'image': create_test_image(img_size=(400, 400), file_ext='jpeg'), 'title': 'Test Image'}
+        with mock.patch.object(ImageProcessor, 'MEMORY_BUDGET', 400 * 400 * 2):
+            response = self.client.post(f"{self.url_image_upload}?file_ext=webp", data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        image_info = ImageInfo.objects.get(title='Test Image')
+        os.remove(settings.MEDIA_ROOT + image_info.image.name)
+        self.assertEqual((image_info.width, image_info.height), (200, 200))
+
+    def test_image_within_limits_is_stored_byte_for_byte(self):
+        upload = create_test_image(file_ext='jpeg')
+        original = upload.read()
+        upload.seek(0)
+        data = {'image': upload, 'title': 'Test Image'}
+        with mock.patch('image_api.processing.ImageUtil.convert_image_type') as convert_mock:
+            response = self.client.post(f"{self.url_image_upload}?file_ext=jpg", data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        convert_mock.assert_not_called()
+
+        image_info = ImageInfo.objects.get(title='Test Image')
+        try:
+            with open(settings.MEDIA_ROOT + image_info.image.name, 'rb') as stored:
+                self.assertEqual(stored.read(), original)
+        finally:
+            os.remove(settings.MEDIA_ROOT + image_info.image.name)
+
     def test_image_upload_with_file_ext_param(self):
         data = {
             'image': create_test_image(),
@@ -167,9 +576,34 @@ class ImageUploadTest(APITestCase):
             image = Image.open(settings.MEDIA_ROOT + image_info.image.name)
             image.close()
             self.assertEqual(image.format.lower(), 'webp')
+            # recorded from the converted image, not the upload
+            self.assertEqual(
+                [getattr(image_info, field) for field in ImageInfo.FILE_METADATA_FIELDS],
+                [100, 100, os.path.getsize(image_info.image.path), 'WEBP', 'image/webp'],
+            )
+        finally:
+            os.remove(settings.MEDIA_ROOT + image_info.image.name)
+
+    def test_image_upload_with_encoder_profile_param(self):
+        data = {'image': create_test_image(), 'title': 'Test Image'}
+        url = f'{self.url_image_upload}?file_ext=jpg&encoder_profile=max-compression'
+        with mock.patch('image_api.processing.ImageUtil.encoder_options', wraps=ImageUtil.encoder_options) as options:
+            response = self.client.post(url, data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        options.assert_called_once_with('jpeg', 'max-compression')
+
+        image_info = ImageInfo.objects.get(title='Test Image')
+        try:
+            with Image.open(settings.MEDIA_ROOT + image_info.image.name) as image:
+                self.assertEqual(image.format, 'JPEG')
+                self.assertTrue(image.info.get('progressive'))
         finally:
             os.remove(settings.MEDIA_ROOT + image_info.image.name)
 
+        data = {'image': create_test_image(), 'title': 'Test Image'}
+        response = self.client.post(f'{self.url_image_upload}?encoder_profile=slowest', data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_uploaded_image_is_resized_if_it_exceeds_maximum_file_size(self):
         file_size = ImageUploadView.MAX_IMG_SIZE
         width = 6000
@@ -186,6 +620,217 @@ class ImageUploadTest(APITestCase):
             os.remove(settings.MEDIA_ROOT + image_info.image.name)
 
 
+    def test_retried_upload_with_idempotency_key_is_replayed(self):
+        def upload(title='Test Image'):
+            data = {'image': create_test_image(), 'title': title, 'tags[]': ['tag1']}
+            return self.client.post(self.url_image_upload, data, format='multipart', HTTP_IDEMPOTENCY_KEY='upload-1')
+
+        response = upload()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        image_info = ImageInfo.objects.get()
+        try:
+            with mock.patch('image_api.views.ImageProcessor') as processor_mock:
+                retry = upload()
+            processor_mock.assert_not_called()
+            self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(retry.data, response.data)
+            self.assertEqual(retry['Idempotent-Replayed'], 'true')
+            self.assertEqual(ImageInfo.objects.count(), 1)
+
+            # the same key with another body is a client error, not a replay
+            self.assertEqual(upload(title='Other').status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        finally:
+            os.remove(settings.MEDIA_ROOT + image_info.image.name)
+
+    def test_failed_upload_with_idempotency_key_is_not_replayed_after_server_error(self):
+        data = {'image': create_test_image(), 'title': 'Test Image'}
+        with mock.patch('image_api.views.create_image', return_value=Response(status=503)):
+            response = self.client.post(self.url_image_upload, data, format='multipart', HTTP_IDEMPOTENCY_KEY='k')
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_upload_retried_while_the_first_one_runs_is_asked_to_wait(self):
+        data = {'title': 'Test Image'}
+        IdempotencyKey.objects.create(
+            user=self.user, key='k', fingerprint='', expires_at=timezone.now() + timedelta(minutes=1)
+        )
+        with mock.patch('image_api.idempotency.request_fingerprint', return_value=''):
+            with mock.patch('image_api.views.create_image', return_value=Response({'id': 1}, status=201)) as create:
+                response = self.client.post(self.url_image_upload, data, format='multipart', HTTP_IDEMPOTENCY_KEY='k')
+                create.assert_not_called()
+                self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+                self.assertIn('Retry-After', response)
+
+                # the first request died without storing its response, the key is claimed again
+                IdempotencyKey.objects.update(expires_at=timezone.now())
+                response = self.client.post(self.url_image_upload, data, format='multipart', HTTP_IDEMPOTENCY_KEY='k')
+                create.assert_called_once()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(IdempotencyKey.objects.get().status_code, 201)
+
+
+class ThrottleTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user(username='user', password='test')
+        self.user.groups.add(Group.objects.create(name='user'))
+        self.client.force_authenticate(user=self.user)
+
+    @override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': {
+        'export_user': '2/min', 'export': '100/min',
+    }})
+    def test_token_bucket_uses_the_rate_of_the_role(self):
+        url = reverse('image-export')
+        with mock.patch.object(RoleTokenBucketThrottle, 'timer', return_value=1000.0) as timer:
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(response['Retry-After'], '30')
+
+            # one token is back after 30 seconds
+            timer.return_value = 1030.0
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+            # buckets are per user, a role without its own rate gets the scope rate
+            other = User.objects.create_user(username='guest', password='test')
+            other.groups.add(Group.objects.create(name='guest'))
+            self.client.force_authenticate(user=other)
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+    @override_settings(PROCESSING_CONCURRENCY=1)
+    def test_upload_is_rejected_when_processing_is_at_capacity(self):
+        with processing_slot():
+            data = {'image': create_test_image(), 'title': 'Test Image'}
+            response = self.client.post(reverse('image-upload'), data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], str(settings.PROCESSING_RETRY_AFTER))
+        self.assertFalse(ImageInfo.objects.exists())
+
+        # the slot is free again
+        with processing_slot():
+            pass
+
+
+class ChunkedUploadTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='test')
+        self.user.groups.add(Group.objects.create(name='user'))
+        self.client.force_authenticate(user=self.user)
+
+        session_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, session_dir)
+        settings_override = override_settings(UPLOAD_SESSION_DIR=session_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.content = create_test_image(img_size=(300, 200)).read()
+
+    def create_session(self, **data):
+        data = {'filename': 'photo.png', 'size': len(self.content), 'title': 'Chunked', 'tags': ['tag1'], **data}
+        response = self.client.post(reverse('upload-session-create'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['id']
+
+    def send_chunk(self, session_id, offset, chunk):
+        return self.client.patch(
+            reverse('upload-session', kwargs={'pk': session_id}), chunk,
+            content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def test_chunked_upload_resumes_and_finalizes(self):
+        session_id = self.create_session(file_ext='webp')
+        half = len(self.content) // 2
+
+        response = self.send_chunk(session_id, 0, self.content[:half])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Upload-Offset'], str(half))
+
+        # a retried chunk after a lost response is rejected with the offset to resume from
+        response = self.send_chunk(session_id, 0, self.content[:half])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['offset'], half)
+
+        response = self.client.post(reverse('upload-session-finalize', kwargs={'pk': session_id}))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        offset = self.client.get(reverse('upload-session', kwargs={'pk': session_id})).data['offset']
+        self.assertEqual(self.send_chunk(session_id, offset, self.content[offset:]).status_code, status.HTTP_200_OK)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('upload-session-finalize', kwargs={'pk': session_id}))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        image_info = ImageInfo.objects.get(title='Chunked')
+        try:
+            self.assertTrue(image_info.image.name.endswith('.webp'))
+            self.assertEqual(list(image_info.tags.values_list('name', flat=True)), ['tag1'])
+            self.assertFalse(UploadSession.objects.exists())
+            self.assertEqual(os.listdir(settings.UPLOAD_SESSION_DIR), [])
+        finally:
+            os.remove(settings.MEDIA_ROOT + image_info.image.name)
+
+    def test_session_being_finalized_is_not_changed(self):
+        session_id = self.create_session()
+        self.send_chunk(session_id, 0, self.content)
+        UploadSession.objects.filter(pk=session_id).update(finalizing_at=timezone.now())
+        finalize_url = reverse('upload-session-finalize', kwargs={'pk': session_id})
+
+        self.assertEqual(self.client.post(finalize_url).status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.send_chunk(session_id, 0, self.content).status_code, status.HTTP_409_CONFLICT)
+        response = self.client.delete(reverse('upload-session', kwargs={'pk': session_id}))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        # a failed finalize releases the session, an abandoned one is released after the timeout
+        UploadSession.objects.filter(pk=session_id).update(finalizing_at=None)
+        with mock.patch('image_api.views.create_image', side_effect=OSError):
+            with self.assertRaises(OSError):
+                self.client.post(finalize_url)
+        self.assertIsNone(UploadSession.objects.get(pk=session_id).finalizing_at)
+
+        abandoned_at = timezone.now() - timedelta(seconds=settings.UPLOAD_SESSION_FINALIZE_TIMEOUT + 1)
+        UploadSession.objects.filter(pk=session_id).update(finalizing_at=abandoned_at)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(finalize_url)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        image_info = ImageInfo.objects.get(title='Chunked')
+        os.remove(settings.MEDIA_ROOT + image_info.image.name)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_chunk_beyond_declared_size_is_rejected(self):
+        session_id = self.create_session(size=10)
+        response = self.send_chunk(session_id, 0, self.content[:11])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(reverse('upload-session-create'), {
+            'filename': 'huge.png', 'size': settings.UPLOAD_SESSION_MAX_SIZE + 1, 'title': 'Huge',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_sessions_are_private_to_their_user(self):
+        session_id = self.create_session()
+        other = User.objects.create_user(username='other', password='test')
+        other.groups.add(Group.objects.get(name='user'))
+        self.client.force_authenticate(user=other)
+        response = self.send_chunk(session_id, 0, self.content)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_expired_sessions_are_deleted(self):
+        session_id = self.create_session()
+        self.send_chunk(session_id, 0, self.content[:10])
+        UploadSession.objects.filter(pk=session_id).update(expires_at=timezone.now())
+
+        self.assertEqual(self.send_chunk(session_id, 10, self.content[10:]).status_code, status.HTTP_404_NOT_FOUND)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('expire_upload_sessions', stdout=StringIO())
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(settings.UPLOAD_SESSION_DIR), [])
+
+
 class ImageUpdateTest(APITestCase):
 
     def setUp(self):
@@ -210,6 +855,36 @@ class ImageUpdateTest(APITestCase):
         self.assertEqual(self.image_info.description, 'This is a new test image')
         self.assertCountEqual(self.image_info.tags.all(), [self.tag1])
 
+    def test_update_with_idempotency_key_runs_once(self):
+        data = {'title': 'New Test Image'}
+        response = self.client.patch(self.url_image_update, data, format='json', HTTP_IDEMPOTENCY_KEY='update-1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        ImageInfo.objects.filter(pk=self.image_info.pk).update(title='Changed since')
+        retry = self.client.patch(self.url_image_update, data, format='json', HTTP_IDEMPOTENCY_KEY='update-1')
+        self.assertEqual(retry.json(), response.json())
+        self.image_info.refresh_from_db()
+        self.assertEqual(self.image_info.title, 'Changed since')
+
+        # keys are scoped to the user
+        other = User.objects.create_user(username='other', password='test')
+        other.groups.add(self.admin_group)
+        self.client.force_authenticate(user=other)
+        self.client.patch(self.url_image_update, data, format='json', HTTP_IDEMPOTENCY_KEY='update-1')
+        self.image_info.refresh_from_db()
+        self.assertEqual(self.image_info.title, 'New Test Image')
+
+    def test_expired_idempotency_keys_are_reused_and_deleted(self):
+        self.client.patch(self.url_image_update, {'title': 'First'}, format='json', HTTP_IDEMPOTENCY_KEY='k')
+        IdempotencyKey.objects.update(expires_at=timezone.now())
+
+        response = self.client.patch(self.url_image_update, {'title': 'Second'}, format='json', HTTP_IDEMPOTENCY_KEY='k')
+        self.assertEqual(response.data['title'], 'Second')
+
+        IdempotencyKey.objects.update(expires_at=timezone.now())
+        call_command('expire_idempotency_keys', stdout=StringIO())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
 
 class ImageDeleteTest(APITestCase):
 
@@ -335,3 +1010,57 @@ class APIAccessTestCase(APITestCase):
         }
         response = self.client.post(self.url_image_upload, data, format='multipart')
         self.assertEqual(response.status_code, 401)
+
+
+class ReplicaRoutingTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='user')
+        self.user.groups.add(Group.objects.create(name='user'))
+        self.client.force_authenticate(user=self.user)
+        self.image_info = ImageInfo.objects.create(title='Test Image')
+
+    def test_router_reads_from_selected_alias_and_writes_to_primary(self):
+        router = ReplicaRouter()
+        self.assertIsNone(router.db_for_read(ImageInfo))
+        use_read_alias('replica')
+        try:
+            self.assertEqual(router.db_for_read(ImageInfo), 'replica')
+            self.assertEqual(router.db_for_write(ImageInfo), 'default')
+        finally:
+            use_read_alias(None)
+
+        with mock.patch('image_api.db_router.replica_alias', return_value='replica'):
+            self.assertFalse(router.allow_migrate('replica', 'image_api'))
+            self.assertIsNone(router.allow_migrate('default', 'image_api'))
+
+    @mock.patch('image_api.views.use_read_alias')
+    @mock.patch('image_api.views.replica_alias', return_value='replica')
+    def test_read_endpoints_use_replica(self, replica_alias_mock, use_read_alias_mock):
+        for url in (reverse('image-list'), reverse('tag-list'),
+                    reverse('image-retrieve', kwargs={'pk': self.image_info.pk})):
+            use_read_alias_mock.reset_mock()
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+            use_read_alias_mock.assert_any_call('replica')
+            # always reset at the end of the request
+            self.assertEqual(use_read_alias_mock.call_args, mock.call(None))
+
+    @mock.patch('image_api.views.use_read_alias')
+    @mock.patch('image_api.views.replica_alias', return_value='replica')
+    def test_user_reads_from_primary_after_write(self, replica_alias_mock, use_read_alias_mock):
+        url_image_update = reverse('image-update', kwargs={'pk': self.image_info.pk})
+        response = self.client.patch(url_image_update, {'title': 'New Title'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        use_read_alias_mock.reset_mock()
+        response = self.client.get(reverse('image-list'))
+        self.assertEqual(response.data[0]['title'], 'New Title')
+        self.assertNotIn(mock.call('replica'), use_read_alias_mock.call_args_list)
+
+        # other users are not affected
+        other_user = User.objects.create_user(username='other', password='other')
+        other_user.groups.add(Group.objects.get(name='user'))
+        self.client.force_authenticate(user=other_user)
+        self.client.get(reverse('image-list'))
+        use_read_alias_mock.assert_any_call('replica')
@@ -0,0 +1,232 @@
+import json
+import os
+import shutil
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.test import TestCase
+from PIL import Image
+
+from ..models import ImageInfo, ImageVariant, Tag
+
+
+class ImportImagesCommandTest(TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.source, 'nested'))
+        Image.new('RGB', (40, 30), 'red').save(os.path.join(self.source, 'red.png'))
+        Image.new('RGB', (30, 40), 'blue').save(os.path.join(self.source, 'nested', 'blue.jpg'))
+        with open(os.path.join(self.source, 'broken.png'), 'wb') as broken:
+            broken.write(b'not an image')
+        with open(os.path.join(self.source, 'notes.txt'), 'w') as notes:
+            notes.write('skipped')
+
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), 'import.checkpoint')
+        self.addCleanup(shutil.rmtree, self.source)
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.checkpoint))
+
+    def tearDown(self):
+        for image in ImageInfo.objects.all():
+            os.remove(settings.MEDIA_ROOT + image.image.name)
+
+    def import_images(self, source, *args):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('import_images', source, '--checkpoint', self.checkpoint, *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_import_directory_with_worker_processes(self):
+        stdout, stderr = self.import_images(self.source, '--workers', '2', '--file-ext', 'webp', '--tags', 'imported')
+        self.assertIn('Imported 2 images, 1 failed', stdout)
+        self.assertIn('broken.png: Uploaded file is not a valid image.', stderr)
+
+        images = {image.title: image for image in ImageInfo.objects.all()}
+        self.assertEqual(set(images), {'red', 'blue'})
+        self.assertEqual((images['blue'].width, images['blue'].height), (30, 40))
+        self.assertTrue(images['red'].image.name.endswith('.webp'))
+        with Image.open(images['red'].image.path) as stored:
+            self.assertEqual(stored.format, 'WEBP')
+        self.assertEqual(list(images['red'].tags.values_list('name', flat=True)), ['imported'])
+        self.assertEqual(Tag.objects.get(name='imported').image_count, 2)
+
+    def test_import_resumes_from_checkpoint(self):
+        self.import_images(self.source, '--workers', '1', '--batch-size', '1')
+        self.assertEqual(ImageInfo.objects.count(), 2)
+
+        Image.new('RGB', (10, 10), 'green').save(os.path.join(self.source, 'green.png'))
+        stdout, _ = self.import_images(self.source, '--workers', '1')
+        self.assertIn('2 images to import (2 already imported)', stdout)
+        self.assertEqual(sorted(ImageInfo.objects.values_list('title', flat=True)), ['blue', 'green', 'red'])
+
+    def test_import_json_manifest(self):
+        manifest = os.path.join(self.source, 'manifest.json')
+        with open(manifest, 'w') as manifest_file:
+            json.dump([
+                {'path': 'red.png', 'title': 'Red square', 'description': 'A red one', 'tags': ['red', 'square']},
+                {'path': 'nested/blue.jpg', 'tags': ['square']},
+            ], manifest_file)
+
+        self.import_images(manifest, '--workers', '1')
+        red = ImageInfo.objects.get(title='Red square')
+        self.assertEqual(red.description, 'A red one')
+        self.assertEqual(sorted(red.tags.values_list('name', flat=True)), ['red', 'square'])
+        self.assertTrue(ImageInfo.objects.filter(title='blue').exists())
+        self.assertEqual(Tag.objects.get(name='square').image_count, 2)
+
+
+class ReprocessImagesCommandTest(TestCase):
+
+    def setUp(self):
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), 'reprocess.checkpoint')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.checkpoint))
+
+        storage = ImageInfo._meta.get_field('image').storage
+        self.images = []
+        for color in ('red', 'green', 'blue'):
+            output = BytesIO()
+            Image.new('RGB', (20, 10), color).save(output, 'png')
+            name = storage.save(f'images/{color}.png', ContentFile(output.getvalue()))
+            # stale dimensions, as if they were never recorded
+            self.images.append(ImageInfo.objects.create(image=name, title=color, width=1, height=1))
+
+    def tearDown(self):
+        for image in ImageInfo.objects.all():
+            os.remove(settings.MEDIA_ROOT + image.image.name)
+
+    def reprocess(self, *args):
+        stdout = StringIO()
+        call_command('reprocess_images', '--checkpoint', self.checkpoint, *args, stdout=stdout, stderr=StringIO())
+        return stdout.getvalue()
+
+    def test_dry_run_changes_nothing(self):
+        stdout = self.reprocess('--file-ext', 'webp', '--workers', '1', '--dry-run')
+        self.assertIn('Processed 3 images, 3 would be rewritten, 0 failed', stdout)
+        self.assertEqual(
+            sorted(ImageInfo.objects.values_list('image', 'width')),
+            [('images/blue.png', 1), ('images/green.png', 1), ('images/red.png', 1)],
+        )
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_reprocess_converts_and_resumes_from_checkpoint(self):
+        with open(self.checkpoint, 'w') as checkpoint_file:
+            checkpoint_file.write(str(self.images[0].pk))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            stdout = self.reprocess('--file-ext', 'webp', '--workers', '2', '--batch-size', '1')
+        self.assertIn(f'Resuming after id {self.images[0].pk}', stdout)
+        self.assertIn('Processed 2 images, 2 rewritten, 0 failed', stdout)
+
+        red, green, blue = (ImageInfo.objects.get(pk=image.pk) for image in self.images)
+        self.assertEqual(red.image.name, 'images/red.png')
+        for image, color in ((green, 'green'), (blue, 'blue')):
+            self.assertTrue(image.image.name.endswith('.webp'))
+            self.assertEqual((image.width, image.height), (20, 10))
+            self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, f'images/{color}.png')))
+        with open(self.checkpoint) as checkpoint_file:
+            self.assertEqual(checkpoint_file.read(), str(blue.pk))
+
+    def test_reprocess_refreshes_dimensions_of_kept_files(self):
+        stdout = self.reprocess('--workers', '1', '--restart')
+        self.assertIn('Processed 3 images, 0 rewritten, 0 failed', stdout)
+        self.assertEqual(set(ImageInfo.objects.values_list('width', 'height')), {(20, 10)})
+        self.assertEqual(ImageInfo.objects.get(title='red').image.name, 'images/red.png')
+
+
+class BackfillImageMetadataCommandTest(TestCase):
+
+    def setUp(self):
+        storage = ImageInfo._meta.get_field('image').storage
+        output = BytesIO()
+        Image.new('RGB', (30, 20), 'red').save(output, 'jpeg')
+        self.name = storage.save('images/backfill.jpg', ContentFile(output.getvalue()))
+        self.addCleanup(storage.delete, self.name)
+        self.image = ImageInfo.objects.create(image=self.name, title='backfill')
+        self.missing = ImageInfo.objects.create(image='images/missing.png', title='missing')
+        self.recorded = ImageInfo.objects.create(
+            image='images/recorded.png', title='recorded',
+            width=1, height=1, file_size=1, format='PNG', mime_type='image/png',
+        )
+
+    def test_loading_images_never_reads_storage(self):
+        storage = ImageInfo._meta.get_field('image').storage
+        with mock.patch.object(storage, 'open') as open_mock:
+            images = list(ImageInfo.objects.all())
+            ImageInfo.objects.get(pk=self.image.pk).refresh_from_db()
+        open_mock.assert_not_called()
+        self.assertIsNone(images[0].width)
+
+    def test_backfill_reads_headers_of_rows_missing_metadata(self):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('backfill_image_metadata', '--workers', '2', stdout=stdout, stderr=stderr)
+        self.assertIn('Backfilled 1 images, 1 failed', stdout.getvalue())
+        self.assertIn('images/missing.png', stderr.getvalue())
+
+        self.image.refresh_from_db()
+        self.assertEqual(
+            [getattr(self.image, field) for field in ImageInfo.FILE_METADATA_FIELDS],
+            [30, 20, os.path.getsize(self.image.image.path), 'JPEG', 'image/jpeg'],
+        )
+        self.recorded.refresh_from_db()
+        self.assertEqual(self.recorded.file_size, 1)
+
+
+class ShardMediaFilesCommandTest(TestCase):
+
+    def setUp(self):
+        storage = ImageInfo._meta.get_field('image').storage
+        name = storage.save('images/flat.png', ContentFile(b'image bytes'))
+        self.image = ImageInfo.objects.create(image=name, title='flat')
+        variant_name = storage.save('variants/flat_64.webp', ContentFile(b'variant bytes'))
+        self.variant = ImageVariant.objects.create(
+            image=self.image, format='webp', width=64, height=64, file=variant_name, size=13,
+        )
+        self.missing = ImageInfo.objects.create(image='images/missing.png', title='missing')
+
+    def tearDown(self):
+        storage = ImageInfo._meta.get_field('image').storage
+        for name in (*ImageInfo.objects.values_list('image', flat=True),
+                     *ImageVariant.objects.values_list('file', flat=True)):
+            storage.delete(name)
+
+    def shard(self, *args):
+        stdout, stderr = StringIO(), StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('shard_media_files', '--workers', '2', *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_new_files_are_stored_in_sharded_directories(self):
+        upload_to = ImageInfo._meta.get_field('image').upload_to
+        name = ImageInfo._meta.get_field('image').generate_filename(None, 'photo.JPG')
+        self.assertRegex(name, r'^images/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{32}\.jpg$')
+        self.assertTrue(upload_to.is_sharded(name))
+        self.assertFalse(upload_to.is_sharded('images/flat.png'))
+
+    def test_dry_run_moves_nothing(self):
+        stdout, _ = self.shard('--dry-run')
+        self.assertIn('ImageInfo.image: 2 files to move', stdout)
+        self.assertEqual(ImageInfo.objects.get(pk=self.image.pk).image.name, 'images/flat.png')
+
+    def test_files_are_moved_and_rows_updated(self):
+        stdout, stderr = self.shard('--batch-size', '1')
+        self.assertIn('ImageInfo.image: 1 files moved, 1 failed', stdout)
+        self.assertIn('ImageVariant.file: 1 files moved, 0 failed', stdout)
+        self.assertIn('images/missing.png', stderr)
+
+        image = ImageInfo.objects.get(pk=self.image.pk)
+        variant = ImageVariant.objects.get(pk=self.variant.pk)
+        self.assertRegex(image.image.name, r'^images/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{32}\.png$')
+        self.assertRegex(variant.file.name, r'^variants/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{32}\.webp$')
+        with open(image.image.path, 'rb') as stored:
+            self.assertEqual(stored.read(), b'image bytes')
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, 'images/flat.png')))
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, 'variants/flat_64.webp')))
+
+        # already sharded files are left alone
+        stdout, _ = self.shard()
+        self.assertIn('ImageInfo.image: 0 files moved, 1 failed', stdout)
+        self.assertEqual(ImageInfo.objects.get(pk=self.image.pk).image.name, image.image.name)
+
@@ -0,0 +1,192 @@
+import os
+from io import BytesIO
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.files.base import ContentFile
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+from PIL import Image
+from rest_framework.test import APITestCase
+
+from ..models import ImageInfo, ImageVariant
+from ..variants import negotiate_variant_format
+
+
+class MediaViewTest(APITestCase):
+
+    def setUp(self):
+        self.content = bytes(range(256)) * 4
+        storage = ImageInfo._meta.get_field('image').storage
+        self.name = storage.save('images/media_test.png', ContentFile(self.content))
+        self.addCleanup(os.remove, settings.MEDIA_ROOT + self.name)
+        ImageInfo.objects.filter(pk=ImageInfo.objects.create(title='media').pk).update(image=self.name)
+        self.url = reverse('media', kwargs={'path': self.name})
+
+    def read(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_serves_image_with_validators(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='image/webp')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.read(response), self.content)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Cache-Control'], f'public, max-age={settings.MEDIA_CACHE_MAX_AGE}')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_range_requests(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEqual(self.read(response), self.content[10:20])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(self.read(response), self.content[-5:])
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+
+        # the file changed since the client's copy, send it whole
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_only_image_files_are_served(self):
+        storage = ImageInfo._meta.get_field('image').storage
+        name = storage.save('images/orphan.png', ContentFile(b'orphan'))
+        self.addCleanup(os.remove, settings.MEDIA_ROOT + name)
+
+        self.assertEqual(self.client.get(reverse('media', kwargs={'path': name})).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/media/../manage.py').status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(MEDIA_ACCEL_REDIRECT='nginx')
+    def test_nginx_accel_redirect(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.name)
+        self.assertEqual(response.content, b'')
+
+    @override_settings(MEDIA_ACCEL_REDIRECT='sendfile')
+    def test_x_sendfile(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], os.path.join(settings.MEDIA_ROOT, self.name))
+
+    @override_settings(MEDIA_REQUIRE_AUTHENTICATION=True)
+    def test_authentication_required(self):
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_401_UNAUTHORIZED)
+
+        user = User.objects.create_user(username='guest', password='test')
+        user.groups.add(Group.objects.create(name='guest'))
+        self.client.force_authenticate(user=user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Cache-Control'].startswith('private'))
+
+
+class ImageVariantViewTest(APITestCase):
+
+    def setUp(self):
+        output = BytesIO()
+        Image.new('RGB', (120, 80), 'orange').save(output, 'png')
+        storage = ImageInfo._meta.get_field('image').storage
+        name = storage.save('images/variant_test.png', ContentFile(output.getvalue()))
+        self.addCleanup(storage.delete, name)
+        self.image = ImageInfo.objects.create(title='variant')
+        ImageInfo.objects.filter(pk=self.image.pk).update(image=name, width=120, height=80)
+        self.image.refresh_from_db()
+        self.url = reverse('image-variant', kwargs={'pk': self.image.pk})
+
+    def tearDown(self):
+        for variant in ImageVariant.objects.all():
+            variant.file.storage.delete(variant.file.name)
+
+    def test_negotiation_prefers_explicit_modern_formats(self):
+        formats = ['avif', 'webp']
+        self.assertEqual(negotiate_variant_format('image/avif,image/webp,*/*;q=0.8', formats), 'avif')
+        self.assertEqual(negotiate_variant_format('image/webp,image/avif;q=0.5', formats), 'webp')
+        self.assertEqual(negotiate_variant_format('image/webp', ['webp']), 'webp')
+        self.assertIsNone(negotiate_variant_format('image/*,*/*', formats))
+        self.assertIsNone(negotiate_variant_format('image/webp;q=0', formats))
+        self.assertIsNone(negotiate_variant_format(None, formats))
+
+    @override_settings(IMAGE_VARIANT_FORMATS=['webp'])
+    def test_webp_variant_is_built_once_and_served(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='image/avif,image/webp,*/*')
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertIn('Accept', response['Vary'])
+        variant = ImageVariant.objects.get()
+        self.assertEqual((variant.format, variant.width, variant.height), ('webp', 120, 80))
+        self.assertEqual(response['Location'], variant.file.url)
+        with Image.open(variant.file.path) as stored:
+            self.assertEqual(stored.format, 'WEBP')
+
+        with mock.patch('image_api.variants.ImageUtil.PIL_to_bytes') as encode_mock:
+            response = self.client.get(self.url, HTTP_ACCEPT='image/webp')
+        encode_mock.assert_not_called()
+        self.assertEqual(response['Location'], variant.file.url)
+
+        # variant files are served like the originals
+        response = self.client.get(reverse('media', kwargs={'path': variant.file.name}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        with open(variant.file.path, 'rb') as stored:
+            self.assertEqual(b''.join(response.streaming_content), stored.read())
+
+    @override_settings(IMAGE_VARIANT_FORMATS=['webp'], IMAGE_RENDITION_WIDTHS=[64, 240])
+    def test_renditions_by_width(self):
+        response = self.client.get(self.url, {'w': 64}, HTTP_ACCEPT='image/webp')
+        variant = ImageVariant.objects.get()
+        self.assertEqual(response['Location'], variant.file.url)
+        self.assertEqual((variant.format, variant.width, variant.height), ('webp', 64, 43))
+
+        # without a variant format the rendition keeps the original format
+        self.client.get(self.url, {'w': 64}, HTTP_ACCEPT='*/*')
+        with Image.open(ImageVariant.objects.get(format='png').file.path) as stored:
+            self.assertEqual((stored.format, stored.size), ('PNG', (64, 43)))
+
+        # wider than the image is the full size, which is the original file for those clients
+        response = self.client.get(self.url, {'w': 240}, HTTP_ACCEPT='*/*')
+        self.assertEqual(response['Location'], self.image.image.url)
+
+        self.assertEqual(self.client.get(self.url, {'w': 100}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(IMAGE_VARIANT_FORMATS=['webp'], IMAGE_RENDITION_WIDTHS=[64])
+    def test_animated_variants_keep_their_frames(self):
+        output = BytesIO()
+        frames = [Image.new('RGB', (120, 80), color) for color in ('red', 'green')]
+        frames[0].save(output, 'gif', save_all=True, append_images=frames[1:], duration=100)
+        storage = ImageInfo._meta.get_field('image').storage
+        name = storage.save('images/variant_test.gif', ContentFile(output.getvalue()))
+        self.addCleanup(storage.delete, name)
+        ImageInfo.objects.filter(pk=self.image.pk).update(image=name)
+
+        self.client.get(self.url, {'w': 64}, HTTP_ACCEPT='image/webp')
+        variant = ImageVariant.objects.get()
+        self.assertEqual((variant.format, variant.width, variant.height), ('webp', 64, 43))
+        with Image.open(variant.file.path) as stored:
+            self.assertEqual((stored.size, stored.n_frames), ((64, 43), 2))
+
+        # a GIF rendition would keep only the first frame
+        response = self.client.get(self.url, {'w': 64}, HTTP_ACCEPT='*/*')
+        self.assertEqual(response['Location'], storage.url(name))
+
+    def test_clients_without_modern_formats_get_the_original(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='*/*')
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(response['Location'], self.image.image.url)
+        self.assertFalse(ImageVariant.objects.exists())
+
+    def test_variant_files_are_deleted_with_the_image(self):
+        self.client.get(self.url, HTTP_ACCEPT='image/webp')
+        variant = ImageVariant.objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.image.delete()
+        self.assertFalse(os.path.exists(variant.file.path))
@@ -0,0 +1,156 @@
+import json
+import os
+import signal
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.test import SimpleTestCase, override_settings
+from image_backend.workers import RecyclingUvicornWorker
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from ..models import ImageInfo, Tag
+from ..util.image_util import ImageUtil
+from ..util.perf import end_record, start_record
+from .tests_api import create_test_image
+
+
+class PerfTimingMiddlewareTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(username='testuser', password='test')
+        self.user.groups.add(Group.objects.create(name='admin'))
+        self.client.force_authenticate(user=self.user)
+
+        image = ImageInfo.objects.create(title='image1', description='description1')
+        image.tags.set([Tag.objects.create(name='tag1')])
+
+    def parse_server_timing(self, response):
+        metrics = {}
+        for metric in response['Server-Timing'].split(', '):
+            name, *params = metric.split(';')
+            metrics[name] = dict(param.split('=', 1) for param in params)
+        return metrics
+
+    @override_settings(PERF_SAMPLE_RATE=1.0)
+    def test_server_timing_header_on_list(self):
+        with self.assertLogs('image_api.perf', level='INFO') as logs:
+            response = self.client.get(reverse('image-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        metrics = self.parse_server_timing(response)
+        self.assertIn('db', metrics)
+        self.assertNotEqual(metrics['db']['desc'], '"0 queries"')
+        self.assertIn('serialize', metrics)
+        self.assertIn('render', metrics)
+        self.assertIn('total', metrics)
+
+        log_line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(log_line['view'], 'image-list')
+        self.assertEqual(log_line['status'], 200)
+        self.assertGreater(log_line['db_queries'], 0)
+
+    @override_settings(PERF_SAMPLE_RATE=1.0)
+    def test_server_timing_header_on_upload_with_conversion(self):
+        data = {'image': create_test_image(), 'title': 'Test Image'}
+        response = self.client.post(f"{reverse('image-upload')}?file_ext=webp", data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        try:
+            metrics = self.parse_server_timing(response)
+            for stage in ('image.decode', 'image.convert', 'image.encode', 'storage.write'):
+                self.assertIn(stage, metrics)
+        finally:
+            os.remove(settings.MEDIA_ROOT + ImageInfo.objects.get(title='Test Image').image.name)
+
+    def test_decode_is_timed_apart_from_encode_without_conversion(self):
+        record = start_record()
+        try:
+            ImageUtil.optimize_image_bytes_size(create_test_image(file_ext='jpeg').read(), 'jpg', 1)
+        finally:
+            end_record(record)
+        self.assertEqual(record.counts['image.decode'], 1)
+        self.assertNotIn('image.convert', record.counts)
+        self.assertEqual(record.counts['image.encode'], 2)
+
+    @override_settings(PERF_SAMPLE_RATE=1.0)
+    async def test_server_timing_header_under_asgi(self):
+        token = AccessToken.for_user(self.user)
+        with self.assertLogs('image_api.perf', level='INFO'):
+            response = await self.async_client.get(
+                reverse('image-list'), headers={'Authorization': f'Bearer {token}'},
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # queries run in the request's sync thread are timed too
+        self.assertNotEqual(self.parse_server_timing(response)['db']['desc'], '"0 queries"')
+
+    @override_settings(PERF_SAMPLE_RATE=0)
+    def test_unsampled_request_has_no_server_timing(self):
+        response = self.client.get(reverse('image-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+
+class MetricsEndpointTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(username='testuser', password='test')
+        self.user.groups.add(Group.objects.create(name='admin'))
+        self.client.force_authenticate(user=self.user)
+
+    def test_metrics_after_upload(self):
+        data = {'image': create_test_image(), 'title': 'Test Image'}
+        response = self.client.post(f"{reverse('image-upload')}?file_ext=webp", data, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        os.remove(settings.MEDIA_ROOT + ImageInfo.objects.get(title='Test Image').image.name)
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.content.decode()
+        self.assertIn('image_upload_decisions_total{decision="convert"}', body)
+        self.assertIn('image_processing_stage_seconds_count{stage="encode"}', body)
+        self.assertIn('image_processing_stage_seconds_count{stage="storage_write"}', body)
+        self.assertIn('image_upload_bytes_count{direction="output"}', body)
+        self.assertIn('image_api_request_seconds_count{method="POST",status="201",view="image-upload"}', body)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_token_required(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class RecyclingUvicornWorkerTest(SimpleTestCase):
+
+    def create_worker(self, max_rss_mb):
+        # the gunicorn arguments of __init__ are not needed by the memory check
+        worker = RecyclingUvicornWorker.__new__(RecyclingUvicornWorker)
+        worker.max_rss, worker.alive, worker.pid, worker.log = max_rss_mb * 2 ** 20, True, 1234, mock.Mock()
+        return worker
+
+    @mock.patch('image_backend.workers.os.kill')
+    @mock.patch('image_backend.workers.current_rss', return_value=600 * 2 ** 20)
+    def test_worker_over_rss_limit_exits_gracefully(self, rss_mock, kill_mock):
+        worker = self.create_worker(1024)
+        worker.recycle_if_over_rss()
+        kill_mock.assert_not_called()
+        self.assertTrue(worker.alive)
+
+        worker = self.create_worker(512)
+        worker.recycle_if_over_rss()
+        kill_mock.assert_called_once_with(os.getpid(), signal.SIGTERM)
+        self.assertFalse(worker.alive)
+
+        # already exiting
+        worker.recycle_if_over_rss()
+        kill_mock.assert_called_once()
+
+    @mock.patch('image_backend.workers.os.kill')
+    @mock.patch('image_backend.workers.current_rss', return_value=600 * 2 ** 20)
+    def test_no_limit_never_recycles(self, rss_mock, kill_mock):
+        self.create_worker(0).recycle_if_over_rss()
+        rss_mock.assert_not_called()
+        kill_mock.assert_not_called()
+
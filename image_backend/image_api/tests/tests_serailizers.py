@@ -6,7 +6,8 @@ from unittest import mock
 from django.conf import settings
 from django.core.files import File
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.urls import reverse
 from PIL import Image
 
 from ..models import ImageInfo, Tag
@@ -29,7 +30,7 @@ class TagSerializerTest(TestCase):
 
     def test_tag_serializer_to_json(self):
         serialized_data = TagSerializer(self.tag).data
-        self.assertEqual(serialized_data, {'label': 'Test Tag', 'value': 'test-tag'})
+        self.assertEqual(serialized_data, {'label': 'Test Tag', 'value': 'test-tag', 'count': 0})
 
     def test_tag_serializer_from_json(self):
         json_data = {'label': 'Test Tag', 'value': 'test-tag'}
@@ -57,6 +58,22 @@ class ImageSerializerTest(TestCase):
         self.assertEqual(serialized_data['description'], 'Test Description')
         self.assertEqual(serialized_data['tags'], ['Tag 1', 'Tag 2'])
 
+    @override_settings(IMAGE_RENDITION_WIDTHS=[640, 320, 1280])
+    def test_image_serializer_srcset(self):
+        self.assertEqual(ImageSerializer(self.image).data['srcset'], [])
+
+        ImageInfo.objects.filter(pk=self.image.pk).update(image='images/srcset.png', width=1000, height=800)
+        with mock.patch.object(ImageInfo._meta.get_field('image').storage, 'open') as open_mock:
+            srcset = ImageSerializer(ImageInfo.objects.get(pk=self.image.pk)).data['srcset']
+        open_mock.assert_not_called()
+
+        url = reverse('image-variant', kwargs={'pk': self.image.pk})
+        self.assertEqual(srcset, [
+            {'url': f'{url}?w=320', 'width': 320},
+            {'url': f'{url}?w=640', 'width': 640},
+            {'url': url, 'width': 1000},
+        ])
+
     def test_image_serializer_from_json(self):
         file_mock = create_test_image()
         json_data = {'title': 'Test Image', 'description': 'Test Description', 'image': file_mock}
@@ -0,0 +1,116 @@
+import random
+import time
+import uuid
+from contextlib import contextmanager
+
+from auth_api.permissions import GuestPermission
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.exceptions import Throttled
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from .metrics import THROTTLED_REQUESTS
+
+# most privileged first, a user in several groups gets the rate of the first one
+ROLES = GuestPermission.required_groups
+
+PROCESSING_SLOT_KEY = 'image_processing_slot:{index}'
+
+
+def parse_rate(rate):
+    """'30/min' -> (bucket capacity, tokens refilled per second)."""
+    num, period = rate.split('/')
+    num = int(num)
+    seconds = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+    return num, num / seconds
+
+
+class RoleTokenBucketThrottle(BaseThrottle):
+    """
+    Token bucket per user and view `throttle_scope`, with the rate of the user's role.
+
+    Rates are DEFAULT_THROTTLE_RATES entries named `<scope>_<role>` (roles are the auth_api groups, `anon` for
+    unauthenticated clients), falling back to `<scope>`, a None rate is unlimited. A bucket holds up to the rate's
+    count of requests (the allowed burst) and refills continuously, so '30/min' allows a burst of 30 then one
+    request every 2 seconds. The buckets live in the default cache, shared by every worker when it's Redis.
+    Like DRF's own throttles the read-modify-write isn't atomic, concurrent requests may overshoot by a few.
+    """
+    cache = cache
+    cache_format = 'throttle_bucket:{scope}:{ident}'
+    timer = time.time
+
+    def __init__(self):
+        self.wait_seconds = None
+
+    def allow_request(self, request, view):
+        scope = getattr(view, 'throttle_scope', None)
+        rate = self.get_rate(scope, self.get_role(request.user)) if scope else None
+        if rate is None:
+            return True
+
+        capacity, refill = parse_rate(rate)
+        key = self.cache_format.format(scope=scope, ident=self.get_bucket_ident(request))
+        now = self.timer()
+        tokens, updated_at = self.cache.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * refill)
+        if tokens < 1:
+            self.wait_seconds = (1 - tokens) / refill
+            THROTTLED_REQUESTS.labels(reason=scope).inc()
+            return False
+
+        # the bucket is full again once it expired, no need to keep it longer
+        self.cache.set(key, (tokens - 1, now), int(capacity / refill) + 1)
+        return True
+
+    def wait(self):
+        return self.wait_seconds
+
+    @staticmethod
+    def get_role(user):
+        if not user or not user.is_authenticated:
+            return 'anon'
+        groups = set(user.groups.values_list('name', flat=True))
+        return next((role for role in ROLES if role in groups), None)
+
+    @staticmethod
+    def get_rate(scope, role):
+        rates = api_settings.DEFAULT_THROTTLE_RATES
+        name = f'{scope}_{role}'
+        return rates[name] if name in rates else rates.get(scope)
+
+    def get_bucket_ident(self, request):
+        if request.user and request.user.is_authenticated:
+            return f'user:{request.user.pk}'
+        return f'anon:{self.get_ident(request)}'
+
+
+@contextmanager
+def processing_slot():
+    """
+    Hold one of the PROCESSING_CONCURRENCY image processing slots shared by all workers, or raise Throttled (429).
+
+    A slot is a cache key taken with an atomic add, it expires after PROCESSING_SLOT_TIMEOUT so a worker killed
+    while processing doesn't leak it.
+    """
+    limit = settings.PROCESSING_CONCURRENCY
+    if not limit:
+        yield
+        return
+
+    token = uuid.uuid4().hex
+    # start at a random slot, workers don't all contend for the first keys
+    first = random.randrange(limit)
+    for offset in range(limit):
+        key = PROCESSING_SLOT_KEY.format(index=(first + offset) % limit)
+        if cache.add(key, token, settings.PROCESSING_SLOT_TIMEOUT):
+            try:
+                yield
+            finally:
+                # the slot may have expired and been taken by another request meanwhile
+                if cache.get(key) == token:
+                    cache.delete(key)
+            return
+
+    THROTTLED_REQUESTS.labels(reason='processing_concurrency').inc()
+    raise Throttled(wait=settings.PROCESSING_RETRY_AFTER, detail='Image processing is at capacity, retry later.')
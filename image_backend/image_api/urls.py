@@ -1,14 +1,32 @@
+from django.conf import settings
 from django.urls import include, path
 from rest_framework import routers
 
-from .views import (ImageDeleteView, ImageListView, ImageRetrieveView,
-                    ImageUpdateView, ImageUploadView, TagListView)
+from .async_views import (AsyncImageListView, AsyncImageRetrieveView,
+                          AsyncTagListView)
+from .media import ImageVariantView
+from .views import (ImageDeleteView, ImageExportView, ImageListView,
+                    ImageRetrieveView, ImageUpdateView, ImageUploadView,
+                    TagFacetView, TagListView, TagSuggestView,
+                    UploadSessionCreateView, UploadSessionFinalizeView,
+                    UploadSessionView)
+
+# read endpoints are served by async views when running under an ASGI server
+if settings.ASYNC_READ_VIEWS:
+    ImageListView, ImageRetrieveView, TagListView = AsyncImageListView, AsyncImageRetrieveView, AsyncTagListView
 
 urlpatterns = [
     path('', ImageListView.as_view(), name='image-list'),
+    path('export', ImageExportView.as_view(), name='image-export'),
     path('upload/', ImageUploadView.as_view(), name='image-upload'),
+    path('upload/sessions', UploadSessionCreateView.as_view(), name='upload-session-create'),
+    path('upload/sessions/<uuid:pk>', UploadSessionView.as_view(), name='upload-session'),
+    path('upload/sessions/<uuid:pk>/finalize', UploadSessionFinalizeView.as_view(), name='upload-session-finalize'),
     path('tags/', TagListView.as_view(), name='tag-list'),
+    path('tags/suggest', TagSuggestView.as_view(), name='tag-suggest'),
+    path('tags/facets', TagFacetView.as_view(), name='tag-facets'),
     path('<int:pk>/', ImageRetrieveView.as_view(), name='image-retrieve'),
+    path('<int:pk>/variant', ImageVariantView.as_view(), name='image-variant'),
     path('<int:pk>/update', ImageUpdateView.as_view(), name='image-update'),
     path('<int:pk>/delete', ImageDeleteView.as_view(), name='image-delete'),
 ]
@@ -1,28 +1,109 @@
-import logging
+import math
 import os
 from io import BytesIO
-from typing import Union
+from typing import BinaryIO, NamedTuple, Optional, Union
 
 import PIL.Image
 
-# Suppress PIL logging
-logging.getLogger("PIL.Image").setLevel(logging.CRITICAL + 1)
-logging.getLogger("PIL.PngImagePlugin").setLevel(logging.CRITICAL + 1)
-
+from .perf import stage, timed
 
 DEFAULT_TARGET_SIZE = 1 * 1024 * 1024
 DEFAULT_MAX_DIMENSION = 2400
 
+# Encoder options per profile and PIL format, profiles keep the same quality and trade encode CPU for bytes:
+# JPEG optimized Huffman tables and progressive scans, PNG zlib level, WebP method (0 fastest .. 6 smallest),
+# AVIF speed (10 fastest .. 0 smallest, only used when Pillow has an AVIF encoder).
+ENCODER_PROFILES = {
+    'fast': {
+        'JPEG': {'quality': 90, 'subsampling': '4:2:0', 'optimize': False, 'progressive': False},
+        'PNG': {'compress_level': 1},
+        'WEBP': {'quality': 90, 'method': 0},
+        'AVIF': {'quality': 75, 'speed': 10},
+    },
+    'balanced': {
+        'JPEG': {'quality': 90, 'subsampling': '4:2:0', 'optimize': True, 'progressive': False},
+        'PNG': {'compress_level': 6},
+        'WEBP': {'quality': 90, 'method': 4},
+        'AVIF': {'quality': 75, 'speed': 6},
+    },
+    'max-compression': {
+        'JPEG': {'quality': 90, 'subsampling': '4:2:0', 'optimize': True, 'progressive': True},
+        'PNG': {'compress_level': 9, 'optimize': True},
+        'WEBP': {'quality': 90, 'method': 6},
+        'AVIF': {'quality': 75, 'speed': 2},
+    },
+}
+DEFAULT_ENCODER_PROFILE = 'balanced'
+
+# Output formats animations are re-encoded to frame by frame (the GIF and APNG encoders of PIL keep every frame in
+# memory), other outputs keep the first frame
+ANIMATION_FILE_EXT = ('webp',)
+
+
+class ImageTooLargeError(ValueError):
+    """The image can't be decoded within the memory budget."""
+
+
+class ImageHeader(NamedTuple):
+    format: str
+    width: int
+    height: int
+    frame_count: int
+
+    @property
+    def pixel_count(self) -> int:
+        return self.width * self.height
+
+    @property
+    def is_animation(self) -> bool:
+        # MPO frames are views of a still picture, not an animation
+        return self.frame_count > 1 and self.format != 'MPO'
+
+
+class _AnimationFrames:
+    """
+    Frames of an animation from `start`, decoded, converted and resized when the encoder seeks to them.
+
+    Given to the WebP encoder as `append_images`, which reads the mode, size and pixels of one frame after seeking
+    to it, so only the current frame is in memory instead of a list of every resized frame. The duration of each
+    frame is appended to the shared `durations` on seek.
+    """
+
+    def __init__(self, img: PIL.Image.Image, size: tuple, start: int, durations: list, max_duration: Optional[int]):
+        self.frame = None
+        self.img = img
+        self.output_size = size
+        self.start = start
+        self.durations = durations
+        self.max_duration = max_duration
+        self.n_frames = img.n_frames - start
+
+    def seek(self, index: int):
+        self.img.seek(self.start + index)
+        self.durations.append(self.img.info.get('duration', 0))
+        if self.max_duration and sum(self.durations) > self.max_duration:
+            raise ImageTooLargeError(f"Animation lasts more than {self.max_duration / 1000:g} seconds.")
+
+        frame = self.img.convert('RGBA')
+        if frame.size != self.output_size:
+            frame = frame.resize(self.output_size, PIL.Image.LANCZOS)
+        self.frame = frame
+
+    def __getattr__(self, name):
+        return getattr(self.frame, name)
+
 
 class ImageUtil:
 
-    @staticmethod
-    def open_image(image: Union[os.PathLike, str, bytes, BytesIO, PIL.Image.Image]) -> PIL.Image.Image:
+    @classmethod
+    def open_image(cls, image: Union[os.PathLike, str, bytes, BytesIO, PIL.Image.Image],
+                   memory_budget: Optional[int] = None) -> PIL.Image.Image:
         """
         Open the image using various input types.
 
         Args:
             image (Union[os.PathLike, str, bytes, BytesIO, Image.Image]): The input image data.
+            memory_budget (Optional[int]): Bytes the decoded pixels may use, see `fit_memory_budget`.
 
         Returns:
             Image.Image: The opened image.
@@ -30,82 +111,197 @@ class ImageUtil:
         Raises:
             OSError: If the image cannot be opened or converted.
             ValueError: If the input image type is not supported.
+            ImageTooLargeError: If the image can't be decoded within `memory_budget`.
         """
         if isinstance(image, (os.PathLike, str, BytesIO)):
-            return PIL.Image.open(image)
+            img = PIL.Image.open(image)
         elif isinstance(image, bytes):
-            return PIL.Image.open(BytesIO(image))
+            img = PIL.Image.open(BytesIO(image))
         elif isinstance(image, PIL.Image.Image):
-            return image
+            img = image
         else:
             raise ValueError(f"Unsupported image type. {type(image)}")
 
+        if memory_budget:
+            cls.fit_memory_budget(img, memory_budget)
+        return img
+
+    @staticmethod
+    def decoded_bytes(size: tuple, mode: str) -> int:
+        """
+        Approximate memory used by the decoded pixels of an image.
+
+        Args:
+            size (tuple): Width and height in pixels.
+            mode (str): The PIL image mode.
+
+        Returns:
+            int: Bytes, PIL keeps every multi-band pixel in 4 bytes.
+        """
+        if mode in ('1', 'L', 'P'):
+            bytes_per_pixel = 1
+        elif mode.startswith('I;16'):
+            bytes_per_pixel = 2
+        else:
+            bytes_per_pixel = 4
+        return size[0] * size[1] * bytes_per_pixel
+
+    @classmethod
+    def fit_memory_budget(cls, img: PIL.Image.Image, memory_budget: int) -> PIL.Image.Image:
+        """
+        Make sure decoding the opened (not yet loaded) image fits in the memory budget.
+
+        The estimate is the decoded pixels plus one RGB(A) copy made by a conversion. A JPEG over the budget is
+        decoded at 1/2, 1/4 or 1/8 of its size (DCT scaling, the full size is never in memory), other formats
+        can't be reduced while decoding and are rejected.
+
+        Args:
+            img (Image.Image): The opened image, its size changes when it is scaled on load.
+            memory_budget (int): Bytes the decoding may use.
+
+        Returns:
+            Image.Image: The same image.
+
+        Raises:
+            ImageTooLargeError: If the image can't be decoded within the budget.
+        """
+        needed = cls.decoded_bytes(img.size, img.mode) + cls.decoded_bytes(img.size, 'RGBA')
+        if needed <= memory_budget:
+            return img
+
+        if img.format in ('JPEG', 'MPO') and img.im is None:
+            for scale in (2, 4, 8):
+                if needed / scale ** 2 <= memory_budget:
+                    img.draft(img.mode, (math.ceil(img.width / scale), math.ceil(img.height / scale)))
+                    return img
+
+        raise ImageTooLargeError(
+            f"Decoding needs about {needed // 2 ** 20}MB, over the budget of {memory_budget // 2 ** 20}MB."
+        )
+
+    @staticmethod
+    def read_image_header(image: Union[os.PathLike, str, bytes, BinaryIO]) -> ImageHeader:
+        """
+        Read format, dimensions and frame count from the image header without decoding pixel data.
+
+        File-like inputs are rewound to their start position afterwards so they can still be read in full.
+
+        Args:
+            image (Union[os.PathLike, str, bytes, BinaryIO]): The input image data.
+
+        Returns:
+            ImageHeader: The header information of the image.
+
+        Raises:
+            PIL.UnidentifiedImageError: If the data is not a recognised image.
+            PIL.Image.DecompressionBombError: If the pixel count is far above PIL's safety limit.
+        """
+        if isinstance(image, bytes):
+            image = BytesIO(image)
+
+        position = image.tell() if hasattr(image, 'tell') else None
+        try:
+            with PIL.Image.open(image) as img:
+                width, height = img.size
+                return ImageHeader(img.format, width, height, getattr(img, 'n_frames', 1))
+        finally:
+            if position is not None:
+                image.seek(position)
+
     @staticmethod
-    def PIL_to_bytes(image: PIL.Image.Image, file_ext: str) -> BytesIO:
+    def encoder_options(file_ext: str, profile: str = DEFAULT_ENCODER_PROFILE) -> dict:
+        """
+        PIL save options of an encoder profile for the output format.
+
+        Args:
+            file_ext (str): The file extension of the output image.
+            profile (str): One of ENCODER_PROFILES.
+
+        Returns:
+            dict: Keyword arguments for `PIL.Image.Image.save`, empty for formats without tuned options.
+
+        Raises:
+            ValueError: If the profile is unknown.
+        """
+        if profile not in ENCODER_PROFILES:
+            raise ValueError(f"Unknown encoder profile. {profile}")
+        image_format = 'JPEG' if file_ext.lower() in ('jpg', 'jpeg') else file_ext.upper()
+        return dict(ENCODER_PROFILES[profile].get(image_format, {}))
+
+    @classmethod
+    @timed('image.encode')
+    def PIL_to_bytes(cls, image: PIL.Image.Image, file_ext: str, profile: str = DEFAULT_ENCODER_PROFILE) -> BytesIO:
         """
         Convert a PIL image to bytes.
 
         Args:
             image (Image.Image): The PIL image to convert.
             file_ext (str): The file extension of the output image.
+            profile (str): The encoder profile, one of ENCODER_PROFILES.
 
         Returns:
             BytesIO: The converted image as bytes.
 
         """
+        if file_ext == 'jpg':
+            file_ext = 'jpeg'
         output = BytesIO()
-        image.save(output, format=file_ext.upper(), quality=90)
+        image.save(output, format=file_ext.upper(), **cls.encoder_options(file_ext, profile))
         output.seek(0)
         return output
 
     @classmethod
     def convert_image_type(cls, image: Union[os.PathLike, str, bytes, BytesIO, PIL.Image.Image],
-                           file_ext: str) -> PIL.Image.Image:
+                           file_ext: str, memory_budget: Optional[int] = None) -> PIL.Image.Image:
         """
         Convert the image to the specified file format.
 
         Args:
             image (Union[os.PathLike, str, bytes, BytesIO, PIL.Image.Image]): The input image data.
             file_ext (str): The desired file extension for the output image.
+            memory_budget (Optional[int]): Bytes the decoding may use, see `fit_memory_budget`.
 
         Returns:
             Image.Image: The converted image.
 
+        Raises:
+            ImageTooLargeError: If the image can't be decoded within `memory_budget`.
         """
-        img = cls.open_image(image)
+        img = cls.open_image(image, memory_budget)
 
         # jpg is jpeg in PIL
         if file_ext == 'jpg':
             file_ext = 'jpeg'
 
+        # decoded here on every path, a same-format resize would otherwise decode inside its encode stage
+        with stage('image.decode'):
+            img.load()
+
         # Convert to file_ext if not already
         if img.format != file_ext.upper():
-            img = img.convert('RGBA' if file_ext.lower() == 'png' else 'RGB')
+            with stage('image.convert'):
+                img = img.convert('RGBA' if file_ext.lower() == 'png' else 'RGB')
             img.format = file_ext.upper()
 
         return img
 
-    @classmethod
-    def reduce_image_size(cls,
-                          image: Union[os.PathLike, str, bytes, BytesIO, PIL.Image.Image],
-                          max_dimension: int = DEFAULT_MAX_DIMENSION) -> PIL.Image.Image:
+    @staticmethod
+    def reduced_dimensions(width: int, height: int, max_dimension: int = DEFAULT_MAX_DIMENSION) -> tuple:
         """
-        Reduce the size of the image while maintaining aspect ratio.
+        Output dimensions of `reduce_image_size`.
 
         Args:
-            image (Union[os.PathLike, str, bytes, BytesIO, PIL.Image.Image]): The input image data.
+            width (int): The width of the image in pixels.
+            height (int): The height of the image in pixels.
             max_dimension (int): The maximum dimension (width or height in pixels) of the output image.
 
         Returns:
-            Image.Image: The resized image.
+            tuple: Width and height, unchanged when the image is already within `max_dimension`.
 
         """
-        img = cls.open_image(image)
-        width, height = img.size
-
-        # If the image size is already smaller than the max_dimension size, return the original image
+        # If the image size is already smaller than the max_dimension size, keep the original size
         if max(width, height) <= max_dimension:
-            return img
+            return width, height
 
         # if half size still more than max_dimension, set it to max_dimension with keeping image ratio
         # else just resize to half size
@@ -119,15 +315,66 @@ class ImageUtil:
         else:
             new_width = width // 2
             new_height = height // 2
+        return new_width, new_height
+
+    @classmethod
+    @timed('image.resize')
+    def reduce_image_size(cls,
+                          image: Union[os.PathLike, str, bytes, BytesIO, PIL.Image.Image],
+                          max_dimension: int = DEFAULT_MAX_DIMENSION) -> PIL.Image.Image:
+        """
+        Reduce the size of the image while maintaining aspect ratio.
+
+        Args:
+            image (Union[os.PathLike, str, bytes, BytesIO, PIL.Image.Image]): The input image data.
+            max_dimension (int): The maximum dimension (width or height in pixels) of the output image.
+
+        Returns:
+            Image.Image: The resized image.
+
+        """
+        img = cls.open_image(image)
+        new_size = cls.reduced_dimensions(*img.size, max_dimension)
+
+        # If the image size is already smaller than the max_dimension size, return the original image
+        if new_size == img.size:
+            return img
 
-        resized_img = img.resize((new_width, new_height))
+        resized_img = img.resize(new_size)
         return resized_img
 
+    @classmethod
+    @timed('image.resize')
+    def resize_to_width(cls,
+                        image: Union[os.PathLike, str, bytes, BytesIO, PIL.Image.Image],
+                        width: int) -> PIL.Image.Image:
+        """
+        Downscale the image to the given width, keeping the aspect ratio.
+
+        Args:
+            image (Union[os.PathLike, str, bytes, BytesIO, PIL.Image.Image]): The input image data.
+            width (int): The width of the output image in pixels.
+
+        Returns:
+            Image.Image: The resized image, or the input image when it is not wider than `width`.
+
+        """
+        img = cls.open_image(image)
+        if img.width <= width:
+            return img
+
+        height = max(1, round(img.height * width / img.width))
+        # let the decoder skip pixels first (JPEG DCT scaling), then resample the rest
+        img.draft(img.mode, (width, height))
+        return img.resize((width, height), PIL.Image.LANCZOS)
+
     @classmethod
     def optimize_image_bytes_size(cls,
                                   image: bytes,
                                   file_ext: str = 'jpeg',
-                                  target_size: int = DEFAULT_TARGET_SIZE) -> BytesIO:
+                                  target_size: int = DEFAULT_TARGET_SIZE,
+                                  profile: str = DEFAULT_ENCODER_PROFILE,
+                                  memory_budget: Optional[int] = None) -> BytesIO:
         """
         Optimize the size of the bytes image (Ex. image data from InMemoryUploadedFile) .
 
@@ -135,19 +382,25 @@ class ImageUtil:
             image (bytes): The input image data as bytes.
             file_ext (str): The desired file extension for the output image.
             target_size (int): The target size of the output image in bytes.
+            profile (str): The encoder profile, one of ENCODER_PROFILES.
+            memory_budget (Optional[int]): Bytes the decoding may use, see `fit_memory_budget`.
 
         Returns:
             BytesIO: The optimized image as BytesIO.
 
+        Raises:
+            ImageTooLargeError: If the image can't be decoded within `memory_budget`.
         """
         if file_ext == 'jpg':
             file_ext = 'jpeg'
 
-        img = cls.convert_image_type(image, file_ext)
+        options = cls.encoder_options(file_ext, profile)
+        img = cls.convert_image_type(image, file_ext, memory_budget)
 
         # Save the resized image to a BytesIO object
         output = BytesIO()
-        img.save(output, format=file_ext.upper(), quality=90)
+        with stage('image.encode'):
+            img.save(output, format=file_ext.upper(), **options)
 
         # Get the file size
         file_size = output.tell()
@@ -157,9 +410,87 @@ class ImageUtil:
             resized_img = cls.reduce_image_size(img)
 
             output = BytesIO()
-            resized_img.save(output, format=file_ext.upper(), quality=90)
+            with stage('image.encode'):
+                resized_img.save(output, format=file_ext.upper(), **options)
 
         # Reset the file pointer to the beginning of the stream
         output.seek(0)
 
         return output
+
+    @classmethod
+    @timed('image.encode')
+    def animation_to_bytes(cls, img: PIL.Image.Image, file_ext: str, size: Optional[tuple] = None,
+                           profile: str = DEFAULT_ENCODER_PROFILE, max_duration: Optional[int] = None) -> BytesIO:
+        """
+        Re-encode every frame of an animated image into an animation, one frame decoded and resized at a time.
+
+        Args:
+            img (Image.Image): The opened animated image.
+            file_ext (str): The file extension of the output image, one of ANIMATION_FILE_EXT.
+            size (Optional[tuple]): Width and height of the output frames, the image size by default.
+            profile (str): The encoder profile, one of ENCODER_PROFILES.
+            max_duration (Optional[int]): Milliseconds the frames may last.
+
+        Returns:
+            BytesIO: The animation as bytes.
+
+        Raises:
+            ImageTooLargeError: If the frames last more than `max_duration`.
+        """
+        size = size or img.size
+        # the encoder reads the duration of a frame after seeking to it
+        durations = []
+        first = _AnimationFrames(img, size, 0, durations, max_duration)
+        first.seek(0)
+        frames = _AnimationFrames(img, size, 1, durations, max_duration)
+
+        output = BytesIO()
+        try:
+            first.frame.save(
+                output, format=file_ext.upper(), save_all=True, append_images=[frames], duration=durations,
+                # a GIF without loop count plays once
+                loop=img.info.get('loop', 1), **cls.encoder_options(file_ext, profile),
+            )
+        finally:
+            img.seek(0)
+        output.seek(0)
+        return output
+
+    @classmethod
+    def reencode_animation(cls,
+                           image: Union[os.PathLike, str, bytes, BytesIO, PIL.Image.Image],
+                           file_ext: str = 'webp',
+                           size: Optional[tuple] = None,
+                           target_size: Optional[int] = None,
+                           profile: str = DEFAULT_ENCODER_PROFILE,
+                           memory_budget: Optional[int] = None,
+                           max_duration: Optional[int] = None) -> BytesIO:
+        """
+        Re-encode an animated image keeping its animation, like `optimize_image_bytes_size` for still images.
+
+        Args:
+            image (Union[os.PathLike, str, bytes, BytesIO, PIL.Image.Image]): The input image data.
+            file_ext (str): The file extension of the output image, one of ANIMATION_FILE_EXT.
+            size (Optional[tuple]): Width and height of the output frames, the image size by default.
+            target_size (Optional[int]): When the output is larger, it is encoded again with reduced dimensions.
+            profile (str): The encoder profile, one of ENCODER_PROFILES.
+            memory_budget (Optional[int]): Bytes the decoding of a frame may use, see `fit_memory_budget`.
+            max_duration (Optional[int]): Milliseconds the frames may last.
+
+        Returns:
+            BytesIO: The animation as bytes.
+
+        Raises:
+            ImageTooLargeError: If a frame can't be decoded within `memory_budget` or the frames last
+                more than `max_duration`.
+        """
+        img = cls.open_image(image, memory_budget)
+        output = cls.animation_to_bytes(img, file_ext, size, profile, max_duration)
+
+        size = size or img.size
+        if target_size and output.getbuffer().nbytes > target_size:
+            reduced = cls.reduced_dimensions(*size)
+            if reduced != size:
+                output = cls.animation_to_bytes(img, file_ext, reduced, profile, max_duration)
+        return output
@@ -0,0 +1,80 @@
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+_current_record = contextvars.ContextVar('perf_record', default=None)
+_active_stages = contextvars.ContextVar('perf_active_stages', default=frozenset())
+_observers: List[Callable[[str, float], None]] = []
+
+
+class PerfRecord:
+    """Accumulated duration and call count per stage for a single request."""
+
+    def __init__(self):
+        self.durations: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+
+    def add(self, name: str, seconds: float, count: int = 1) -> None:
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + count
+
+
+def start_record() -> PerfRecord:
+    """Start collecting stages for the current request, returns the record to pass to `end_record`."""
+    record = PerfRecord()
+    record.token = _current_record.set(record)
+    return record
+
+
+def end_record(record: PerfRecord) -> None:
+    _current_record.reset(record.token)
+
+
+def current_record() -> Optional[PerfRecord]:
+    return _current_record.get()
+
+
+def add_observer(observer: Callable[[str, float], None]) -> None:
+    """Register `observer(stage_name, seconds)` to be called for every timed stage, sampled or not."""
+    _observers.append(observer)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time the enclosed block as `name` on the current request record and report it to the observers.
+
+    Does nothing when there is neither a record nor an observer, nested blocks of the same stage are counted once.
+    """
+    record = _current_record.get()
+    active = _active_stages.get()
+    if (record is None and not _observers) or name in active:
+        yield
+        return
+
+    token = _active_stages.set(active | {name})
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _active_stages.reset(token)
+        if record is not None:
+            record.add(name, seconds)
+        for observer in _observers:
+            observer(name, seconds)
+
+
+def timed(name: str):
+    """Decorator form of `stage`."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
@@ -0,0 +1,139 @@
+import logging
+import os
+
+import PIL.Image
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.urls import reverse
+
+from .models import ImageVariant
+from .throttling import processing_slot
+from .util.image_util import ANIMATION_FILE_EXT, ImageTooLargeError, ImageUtil
+
+try:
+    # registers an AVIF encoder with Pillow versions that have none
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+logger = logging.getLogger(__name__)
+
+# formats a smaller rendition can keep when the client accepts no variant format
+RENDITION_FORMATS = ('jpeg', 'png', 'webp')
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpeg': 'image/jpeg', 'png': 'image/png'}
+FILE_EXT = {'jpeg': 'jpg'}
+
+
+def supported_variant_formats():
+    """IMAGE_VARIANT_FORMATS (most preferred first) that the installed Pillow can encode."""
+    # plugins like WebP only register their encoder once PIL is initialized, on the first image opened otherwise
+    PIL.Image.init()
+    return [file_format for file_format in settings.IMAGE_VARIANT_FORMATS if file_format.upper() in PIL.Image.SAVE]
+
+
+def parse_accept(header):
+    """{media type: q} of an Accept header, parameters other than q are ignored."""
+    accepted = {}
+    for part in (header or '').split(','):
+        media_type, *params = [item.strip() for item in part.split(';')]
+        if not media_type:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[media_type.lower()] = q
+    return accepted
+
+
+def negotiate_variant_format(accept_header, formats):
+    """
+    The format of `formats` the client prefers, None when it names none of them.
+
+    Only explicitly listed types count, `*/*` or `image/*` are sent by clients that may not decode WebP/AVIF.
+    Ties go to the earlier (preferred) format.
+    """
+    accepted = parse_accept(accept_header)
+    candidates = [file_format for file_format in formats if accepted.get(MIME_TYPES[file_format], 0) > 0]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda file_format: accepted[MIME_TYPES[file_format]])
+
+
+def get_or_build_variant(image_info, file_format, width):
+    """
+    The variant of `image_info` in `file_format` at `width`, encoded from the original on first request.
+
+    Animated originals are re-encoded frame by frame in the formats of ANIMATION_FILE_EXT. Returns None when the
+    original can't be decoded within IMAGE_MEMORY_BUDGET, or is animated and `file_format` would keep only the
+    first frame.
+    Two requests building the same variant at once both
+    encode it, the second one drops its file and returns the stored one.
+    """
+    lookup = {'image': image_info, 'format': file_format, 'width': width}
+    variant = ImageVariant.objects.filter(**lookup).first()
+    if variant is not None:
+        return variant
+
+    file_field = ImageVariant._meta.get_field('file')
+    try:
+        with processing_slot():
+            with image_info.image.storage.open(image_info.image.name) as stored:
+                img = ImageUtil.open_image(stored.read(), settings.IMAGE_MEMORY_BUDGET)
+            if getattr(img, 'is_animated', False) and img.format != 'MPO':
+                if file_format not in ANIMATION_FILE_EXT:
+                    return None
+                size = (width, max(1, round(img.height * width / img.width))) if width < img.width else img.size
+                output = ImageUtil.reencode_animation(img, file_format, size, profile=settings.IMAGE_ENCODER_PROFILE)
+                height = size[1]
+            else:
+                img = ImageUtil.resize_to_width(img, width)
+                mode = 'RGBA' if img.has_transparency_data and file_format != 'jpeg' else 'RGB'
+                if img.mode != mode:
+                    img = img.convert(mode)
+                output = ImageUtil.PIL_to_bytes(img, file_format, profile=settings.IMAGE_ENCODER_PROFILE)
+                height = img.height
+    except (PIL.UnidentifiedImageError, OSError, ImageTooLargeError) as error:
+        logger.warning(f'variant of image {image_info.pk} failed: {error}')
+        return None
+
+    file_name = f'{image_info.pk}_{width}.{FILE_EXT.get(file_format, file_format)}'
+    name = file_field.storage.save(file_field.generate_filename(None, file_name), ContentFile(output.getvalue()))
+    try:
+        with transaction.atomic():
+            return ImageVariant.objects.create(
+                **lookup, height=height, file=name, size=output.getbuffer().nbytes,
+            )
+    except IntegrityError:
+        file_field.storage.delete(name)
+        return ImageVariant.objects.get(**lookup)
+
+
+
+def original_format(image_info):
+    """Format of the stored original from its extension ('jpeg', 'png', ...)."""
+    ext = os.path.splitext(image_info.image.name)[1].lower().lstrip('.')
+    return 'jpeg' if ext == 'jpg' else ext
+
+
+def srcset(image_id, width, request=None):
+    """
+    `[{'url', 'width'}]` for an `<img srcset>`, narrowest first: the IMAGE_RENDITION_WIDTHS below the image width,
+    then the full size. Computed from the stored width only, the files are built when a client requests them.
+    """
+    if not width:
+        return []
+    url = reverse('image-variant', kwargs={'pk': image_id})
+    if request is not None:
+        url = request.build_absolute_uri(url)
+    entries = [
+        {'url': f'{url}?w={rendition}', 'width': rendition}
+        for rendition in sorted(settings.IMAGE_RENDITION_WIDTHS) if rendition < width
+    ]
+    entries.append({'url': url, 'width': width})
+    return entries
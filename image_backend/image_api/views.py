@@ -1,74 +1,162 @@
 import json
+import os
 import random
-from datetime import datetime
+import shutil
+import tempfile
+from datetime import timedelta
 
 from auth_api.permissions import (AdminPermission, GuestPermission,
                                   UserPermission)
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.handlers.asgi import ASGIRequest
+from django.db import router, transaction
+from django.db.models import Count, F
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils import timezone
 from rest_framework import generics, status
 from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .models import ImageInfo, Tag
+from .db_router import (is_primary_sticky, mark_primary_sticky,
+                        replica_alias, use_read_alias)
+from .export import aiter_ndjson, iter_ndjson
+from .filters import ImageFilter
+from .idempotency import IdempotencyMixin
+from .models import ImageInfo, Tag, UploadSession
+from .processing import ImageProcessor
 from .serializers import (ImageSerializer, ImageUpdateSerializer,
-                          ImageUploadSerializer, TagSerializer)
-from .util.image_util import ImageUtil
+                          ImageUploadSerializer, ImageValuesSerializer,
+                          TagFacetSerializer, TagSerializer,
+                          UploadSessionSerializer)
+from .tag_index import tag_index
+from .throttling import RoleTokenBucketThrottle, processing_slot
 
 
-class TagListView(generics.ListAPIView):
+class ReplicaReadMixin:
+    """
+    Serve safe requests from the read replica, if one is configured.
+
+    Users who wrote recently are kept on the primary (see PrimaryStickyMixin) so they read their own writes.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # authentication ran on the primary, only the view's own queries move to the replica
+        if request.method in ('GET', 'HEAD') and not is_primary_sticky(request.user):
+            use_read_alias(replica_alias())
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        use_read_alias(None)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class PrimaryStickyMixin:
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if response.status_code < 400:
+            mark_primary_sticky(request.user)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class TagListView(ReplicaReadMixin, generics.ListAPIView):
     permission_classes = [IsAuthenticated, GuestPermission]
-    queryset = Tag.objects.all()
+    queryset = Tag.objects.order_by('name')
     serializer_class = TagSerializer
+    # paginated only when `limit` is given, the full list is returned otherwise
+    pagination_class = LimitOffsetPagination
 
 
-class ImageListView(generics.ListAPIView):
+class TagSuggestView(ReplicaReadMixin, APIView):
+    permission_classes = [IsAuthenticated, GuestPermission]
+
+    DEFAULT_LIMIT = 10
+    MAX_LIMIT = 50
+
+    def get(self, request, *args, **kwargs):
+        prefix = request.query_params.get('prefix', '').strip()
+        try:
+            limit = min(int(request.query_params.get('limit', self.DEFAULT_LIMIT)), self.MAX_LIMIT)
+        except ValueError:
+            raise ValidationError('limit must be an integer.')
+
+        suggestions = tag_index.suggest(prefix, limit)
+        return Response([
+            {'label': entry.name, 'value': entry.name_slug, 'count': entry.count} for entry in suggestions
+        ])
+
+
+class ImageFilterMixin:
+    """Image list filters (tags, created date, full-text search) shared by the views listing images."""
+
+    def filter_images(self, queryset):
+        return ImageFilter(self.request.query_params).filter(queryset)
+
+    def has_image_filters(self):
+        return ImageFilter(self.request.query_params).is_active()
+
+
+class SparseFieldsetMixin:
+    """
+    `?fields=id,image,tags` limits the image fields returned (ImageSerializer.DEFAULT_FIELDS otherwise),
+    `?expand=tags` returns tags as objects with slug and count instead of names.
+    """
+
+    default_fields = ImageSerializer.DEFAULT_FIELDS
+
+    def get_fieldset(self):
+        if not hasattr(self, '_fieldset'):
+            fields = self.__parse_field_names('fields', ImageSerializer.Meta.fields)
+            expand = self.__parse_field_names('expand', ImageSerializer.EXPANDABLE_FIELDS)
+            self._fieldset = (fields or self.default_fields, expand)
+        return self._fieldset
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fields'], context['expand'] = self.get_fieldset()
+        return context
+
+    def __parse_field_names(self, param, allowed):
+        names = {
+            name.strip() for value in self.request.query_params.getlist(param) for name in value.split(',')
+            if name.strip()
+        }
+        unknown = names - set(allowed)
+        if unknown:
+            raise ValidationError(f"Unknown {param}: {', '.join(sorted(unknown))}")
+        # keep the serializer's field order whatever the order requested
+        return tuple(name for name in allowed if name in names)
+
+
+class ImageListView(ReplicaReadMixin, ImageFilterMixin, SparseFieldsetMixin, generics.ListAPIView):
     permission_classes = [IsAuthenticated, GuestPermission]
     serializer_class = ImageSerializer
 
     def get_queryset(self):
         queryset = ImageInfo.objects.all()
 
-        queryset = self.__filter_by_tags(queryset)
-        queryset = self.__filter_by_created_date(queryset)
+        queryset = self.filter_images(queryset)
         queryset = self.__order_by_random(queryset)
+        queryset = self.get_values_serializer().select(queryset)
         queryset = self.__apply_limit_offset(queryset)
 
         return queryset
 
-    def __filter_by_tags(self, queryset):
-        tags = self.request.query_params.getlist('tags') + self.request.query_params.getlist('tags[]')
-        if tags:
-            queryset = queryset.filter(tags__name__in=tags).distinct()
-        return queryset
+    def get_values_serializer(self):
+        fields, expand = self.get_fieldset()
+        return ImageValuesSerializer(fields, expand, context=self.get_serializer_context())
 
-    def __filter_by_created_date(self, queryset):
-        created_date_exact = self.request.query_params.get('created_date')
-        created_date_after = self.request.query_params.get('created_date__after')
-        created_date_before = self.request.query_params.get('created_date__before')
-
-        if created_date_exact:
-            if created_date_after or created_date_before:
-                raise ValidationError(
-                    "Invalid query parameters. 'created_date' cannot be used with 'created_date__after' or 'created_date__before'."
-                )
-            date = datetime.strptime(created_date_exact, '%Y-%m-%d')
-            queryset = queryset.filter(created_at__date=date)
-
-        if created_date_after and created_date_before:
-            date_after = datetime.strptime(created_date_after, '%Y-%m-%d')
-            date_before = datetime.strptime(created_date_before, '%Y-%m-%d')
-            queryset = queryset.filter(created_at__date__range=[date_after, date_before])
-        elif created_date_after:
-            date = datetime.strptime(created_date_after, '%Y-%m-%d')
-            queryset = queryset.filter(created_at__date__gt=date)
-        elif created_date_before:
-            date = datetime.strptime(created_date_before, '%Y-%m-%d')
-            queryset = queryset.filter(created_at__date__lt=date)
-        return queryset
+    def list(self, request, *args, **kwargs):
+        # rows are plain dicts, see ImageValuesSerializer
+        serializer = self.get_values_serializer()
+        rows = list(self.filter_queryset(self.get_queryset()))
+        tag_rows = list(serializer.select_tags(rows))
+        return Response(serializer.to_representation(rows, tag_rows))
 
     def __order_by_random(self, queryset):
         is_random = self.request.query_params.get('random')
@@ -86,20 +174,88 @@ class ImageListView(generics.ListAPIView):
         return queryset
 
 
-class ImageRetrieveView(generics.RetrieveAPIView):
+class ImageExportView(ReplicaReadMixin, ImageFilterMixin, SparseFieldsetMixin, APIView):
+    """
+    Stream every image matching the image list filters as NDJSON (one JSON object per line), ordered by id.
+
+    Rows are read in chunks of EXPORT_CHUNK_SIZE through a server-side cursor, so the response size
+    does not bound the memory used.
+    """
+    permission_classes = [IsAuthenticated, GuestPermission]
+    throttle_classes = [RoleTokenBucketThrottle]
+    throttle_scope = 'export'
+    default_fields = ImageSerializer.Meta.fields
+
+    def get(self, request, *args, **kwargs):
+        fields, expand = self.get_fieldset()
+        serializer = ImageValuesSerializer(fields, expand, context={'request': request})
+        queryset = serializer.select(self.filter_images(ImageInfo.objects.all())).order_by('id')
+        # the response is consumed after finalize_response resets the read alias, pin the database now
+        queryset = queryset.using(router.db_for_read(ImageInfo))
+
+        if isinstance(request._request, ASGIRequest):
+            # a sync iterator would be buffered entirely by the ASGI handler
+            content = aiter_ndjson(queryset, serializer, settings.EXPORT_CHUNK_SIZE)
+        else:
+            content = iter_ndjson(queryset, serializer, settings.EXPORT_CHUNK_SIZE)
+        response = StreamingHttpResponse(content, content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="images.ndjson"'
+        return response
+
+
+class TagFacetView(ReplicaReadMixin, ImageFilterMixin, generics.ListAPIView):
+    """
+    Tags of the images matching the image list filters, with the number of matching images per tag.
+
+    Without filters the counts maintained on Tag are returned as is, otherwise they are aggregated
+    over the filtered images only.
+    """
+    permission_classes = [IsAuthenticated, GuestPermission]
+    serializer_class = TagFacetSerializer
+
+    DEFAULT_LIMIT = 50
+    MAX_LIMIT = 500
+
+    def get_queryset(self):
+        try:
+            limit = min(int(self.request.query_params.get('facet_limit', self.DEFAULT_LIMIT)), self.MAX_LIMIT)
+        except ValueError:
+            raise ValidationError('facet_limit must be an integer.')
+
+        if not self.has_image_filters():
+            queryset = Tag.objects.filter(image_count__gt=0).annotate(facet_count=F('image_count'))
+        else:
+            images = self.filter_images(ImageInfo.objects.all()).order_by().values('pk')
+            queryset = Tag.objects.filter(imageinfo__in=images).annotate(facet_count=Count('imageinfo'))
+        return queryset.order_by('-facet_count', 'name')[:limit]
+
+
+class ImageRetrieveView(ReplicaReadMixin, SparseFieldsetMixin, generics.RetrieveAPIView):
     permission_classes = [IsAuthenticated, GuestPermission]
-    queryset = ImageInfo.objects.all()
     serializer_class = ImageSerializer
 
+    def get_queryset(self):
+        fields, expand = self.get_fieldset()
+        queryset = ImageInfo.objects.only(*ImageSerializer.model_columns(fields))
+        if 'tags' in fields:
+            queryset = queryset.prefetch_related('tags')
+        return queryset
+
 
-class ImageUploadView(APIView):
+class ImageUploadView(PrimaryStickyMixin, IdempotencyMixin, APIView):
     parser_classes = (MultiPartParser, FormParser)
     permission_classes = [IsAuthenticated, UserPermission]
+    throttle_classes = [RoleTokenBucketThrottle]
+    throttle_scope = 'upload'
 
-    SUPPORT_FILE_EXT = ["jpg", "png", "webp"]
-    MAX_IMG_SIZE = 2 * 1024 * 1024  # 2MB
+    # the rules live in ImageProcessor, shared with the import command
+    SUPPORT_FILE_EXT = ImageProcessor.SUPPORT_FILE_EXT
+    MAX_IMG_SIZE = ImageProcessor.MAX_IMG_SIZE
 
     def post(self, request, *args, **kwargs):
+        return self.idempotent(self.upload, request, *args, **kwargs)
+
+    def upload(self, request, *args, **kwargs):
         # data
         title = request.POST.get('title')
         description = request.POST.get('description')
@@ -108,76 +264,196 @@ class ImageUploadView(APIView):
 
         # param
         file_ext = self.request.query_params.get('file_ext')
+        encoder_profile = self.request.query_params.get('encoder_profile')
+
+        return create_image(image, title, description, tags, file_ext, encoder_profile)
 
+
+def create_image(image, title, description, tags, file_ext, encoder_profile=None):
+    """Process an uploaded image file and create its ImageInfo, the response of the upload endpoints."""
+    with processing_slot():
         try:
-            if file_ext:
-                self.__validate_file_ext(file_ext)
-            image_valid = self.__validate_image(image, transform_ext=file_ext)
+            processed = ImageProcessor(transform_ext=file_ext, encoder_profile=encoder_profile).process(image)
 
         except ValidationError as error:
             return Response({'error': error.detail}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as error:
             return Response({'error': 'Image pre-process validation error'}, status=status.HTTP_400_BAD_REQUEST)
 
-        data = {
-            'title': title,
-            'description': description,
-            'tags': tags,
-            'image': image_valid,
-        }
-        serializer = ImageUploadSerializer(data=data)
-        if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-        else:
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-
-    def __validate_file_ext(self, file_ext):
-        if file_ext not in self.SUPPORT_FILE_EXT:
-            raise ValidationError(f'Not Support file_ext: {file_ext}')
-        return True
-
-    def __validate_image(self, image, transform_ext):
-        # size exceeded do resize
-        if image.size > self.MAX_IMG_SIZE:
-            if not transform_ext:
-                return self.__resize_image(image, 'jpeg', self.MAX_IMG_SIZE)
-            else:
-                return self.__resize_image(image, transform_ext, self.MAX_IMG_SIZE)
+    data = {
+        'title': title,
+        'description': description,
+        'tags': tags,
+        'image': processed.file,
+    }
+    serializer = ImageUploadSerializer(data=data)
+    if serializer.is_valid():
+        serializer.save(**processed.metadata())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+    else:
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class UploadSessionCreateView(PrimaryStickyMixin, generics.CreateAPIView):
+    """
+    Start a resumable upload: POST the file metadata, then PATCH the bytes in chunks to UploadSessionView
+    and POST to UploadSessionFinalizeView once `offset` reached `size`.
+    """
+    permission_classes = [IsAuthenticated, UserPermission]
+    serializer_class = UploadSessionSerializer
 
-        # size not exceeded but image ext needed to covert
-        if transform_ext and not image.name.endswith("." + transform_ext):
-            image = self.__convert_image(image, transform_ext)
+    def perform_create(self, serializer):
+        expires_at = timezone.now() + timedelta(seconds=settings.UPLOAD_SESSION_TTL)
+        session = serializer.save(user=self.request.user, expires_at=expires_at)
+        os.makedirs(settings.UPLOAD_SESSION_DIR, exist_ok=True)
+        open(session.temp_path, 'wb').close()
 
-        return image
 
-    def __resize_image(self, image, transform_ext, target_size):
-        resized_image = ImageUtil.optimize_image_bytes_size(image.read(), transform_ext, target_size)
-        return self.__create_memory_upload_file(resized_image, image.name, transform_ext)
+class UploadSessionMixin:
+    permission_classes = [IsAuthenticated, UserPermission]
 
-    def __convert_image(self, image, transform_ext):
-        converted_image = ImageUtil.convert_image_type(image.read(), transform_ext)
-        converted_image = ImageUtil.PIL_to_bytes(converted_image, transform_ext)
-        return self.__create_memory_upload_file(converted_image, image.name, transform_ext)
+    @staticmethod
+    def is_finalizing(session):
+        # a mark older than the timeout was left by a finalize that died, e.g. with its worker
+        timeout = timedelta(seconds=settings.UPLOAD_SESSION_FINALIZE_TIMEOUT)
+        return session.finalizing_at is not None and session.finalizing_at > timezone.now() - timeout
+
+    @staticmethod
+    def finalizing_response(session):
+        return Response(
+            {'error': 'Upload is being finalized.', 'offset': session.offset},
+            status=status.HTTP_409_CONFLICT, headers={'Upload-Offset': session.offset},
+        )
+
+    def get_session(self, lock=False):
+        queryset = UploadSession.objects.filter(user=self.request.user, expires_at__gt=timezone.now())
+        if lock:
+            queryset = queryset.select_for_update()
+        try:
+            return queryset.get(pk=self.kwargs['pk'])
+        except UploadSession.DoesNotExist:
+            raise Http404('No upload session matches the given query.')
 
-    def __create_memory_upload_file(self, image, image_name, ext):
-        if not image_name.endswith("." + ext):
-            image_name = image_name.replace(image_name.split(".")[-1], ext, 1)
+    @staticmethod
+    def session_response(session, status_code=status.HTTP_200_OK):
+        return Response(UploadSessionSerializer(session).data, status=status_code, headers={'Upload-Offset': session.offset})
 
-        new_image = InMemoryUploadedFile(image, None, image_name, 'image/' + ext, image.__sizeof__, None)
-        if not new_image:
-            raise ValidationError("Could not resize the image.")
 
-        return new_image
+class UploadSessionView(PrimaryStickyMixin, UploadSessionMixin, APIView):
+    """
+    GET returns the session, `offset` is where the client resumes after an interruption.
 
+    PATCH appends the request body at the `Upload-Offset` header, which must match the session offset
+    (409 with the current offset otherwise). DELETE cancels the upload.
+    """
 
-class ImageUpdateView(generics.UpdateAPIView):
+    def get(self, request, *args, **kwargs):
+        return self.session_response(self.get_session())
+
+    def patch(self, request, *args, **kwargs):
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            return Response({'error': 'Upload-Offset header is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        self.get_session()
+
+        # read the chunk before locking the session, the client may be slow to send it
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as chunk:
+            length = 0
+            while request.stream is not None:
+                block = request.stream.read(64 * 1024)
+                if not block:
+                    break
+                length += len(block)
+                if length > settings.UPLOAD_CHUNK_MAX_SIZE:
+                    return Response(
+                        {'error': f'Chunk exceeds the maximum of {settings.UPLOAD_CHUNK_MAX_SIZE} bytes.'},
+                        status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    )
+                chunk.write(block)
+
+            with transaction.atomic():
+                session = self.get_session(lock=True)
+                if self.is_finalizing(session):
+                    return self.finalizing_response(session)
+                if offset != session.offset:
+                    return Response(
+                        {'error': 'Upload-Offset does not match the session offset.', 'offset': session.offset},
+                        status=status.HTTP_409_CONFLICT, headers={'Upload-Offset': session.offset},
+                    )
+                if session.offset + length > session.size:
+                    return Response({'error': 'Chunk exceeds the declared size.'}, status=status.HTTP_400_BAD_REQUEST)
+
+                # write at the offset and cut anything after it, a chunk retried after a crash is not appended twice
+                chunk.seek(0)
+                with open(session.temp_path, 'r+b') as temp_file:
+                    temp_file.seek(session.offset)
+                    shutil.copyfileobj(chunk, temp_file)
+                    temp_file.truncate()
+
+                session.offset += length
+                session.expires_at = timezone.now() + timedelta(seconds=settings.UPLOAD_SESSION_TTL)
+                session.save(update_fields=['offset', 'expires_at'])
+
+        return self.session_response(session)
+
+    def delete(self, request, *args, **kwargs):
+        with transaction.atomic():
+            session = self.get_session(lock=True)
+            if self.is_finalizing(session):
+                return self.finalizing_response(session)
+            session.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadSessionFinalizeView(PrimaryStickyMixin, IdempotencyMixin, UploadSessionMixin, APIView):
+    """Run the upload pipeline on the completed file, the response is the one of ImageUploadView."""
+    throttle_classes = [RoleTokenBucketThrottle]
+    throttle_scope = 'upload'
+
+    def post(self, request, *args, **kwargs):
+        return self.idempotent(self.finalize, request, *args, **kwargs)
+
+    def finalize(self, request, *args, **kwargs):
+        # only the claim holds the row lock, the image is processed outside of it
+        with transaction.atomic():
+            session = self.get_session(lock=True)
+            if session.offset != session.size:
+                return Response(
+                    {'error': 'Upload is incomplete.', 'offset': session.offset},
+                    status=status.HTTP_409_CONFLICT, headers={'Upload-Offset': session.offset},
+                )
+            if self.is_finalizing(session):
+                return self.finalizing_response(session)
+            session.finalizing_at = timezone.now()
+            session.save(update_fields=['finalizing_at'])
+
+        response = None
+        try:
+            with open(session.temp_path, 'rb') as temp_file:
+                image = UploadedFile(temp_file, name=session.filename, size=session.size)
+                response = create_image(
+                    image, session.title, session.description, session.tags, session.file_ext, session.encoder_profile
+                )
+        finally:
+            if response is not None and response.status_code == status.HTTP_201_CREATED:
+                session.delete()
+            else:
+                # the upload can be finalized again, e.g. with other options after a validation error
+                UploadSession.objects.filter(pk=session.pk).update(finalizing_at=None)
+        return response
+
+
+class ImageUpdateView(PrimaryStickyMixin, IdempotencyMixin, generics.UpdateAPIView):
     permission_classes = [IsAuthenticated, UserPermission]
     queryset = ImageInfo.objects.all()
     serializer_class = ImageUpdateSerializer
 
+    def update(self, request, *args, **kwargs):
+        return self.idempotent(super().update, request, *args, **kwargs)
+
 
-class ImageDeleteView(generics.DestroyAPIView):
+class ImageDeleteView(PrimaryStickyMixin, generics.DestroyAPIView):
     permission_classes = [IsAuthenticated, UserPermission]
     queryset = ImageInfo.objects.all()
     serializer_class = ImageSerializer
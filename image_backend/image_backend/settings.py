@@ -48,6 +48,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "image_api.middleware.MetricsMiddleware",
+    "image_api.middleware.PerfTimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
@@ -79,6 +81,10 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "image_backend.wsgi.application"
+ASGI_APPLICATION = "image_backend.asgi.application"
+
+# Serve list/retrieve/tag endpoints with async views, enable when running under an ASGI server
+ASYNC_READ_VIEWS = os.environ.get('ASYNC_READ_VIEWS', 'False') == 'True'
 
 
 # Database
@@ -92,6 +98,9 @@ DATABASES = {
         'PASSWORD': 'im@geb@ckend',
         'HOST': 'localhost',
         'PORT': '5432',
+        # no persistent connections under ASGI, each request thread would keep its own open
+        'CONN_MAX_AGE': 0 if ASYNC_READ_VIEWS else 60,
+        'CONN_HEALTH_CHECKS': True,
     },
     'TEST': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -103,6 +112,12 @@ DATABASES = {
     },
 }
 
+# Reads of the list/retrieve/tag endpoints go to the 'replica' alias when it is configured,
+# users who wrote within DATABASE_REPLICA_STICKY_SECONDS keep reading from the primary
+DATABASE_ROUTERS = ['image_api.db_router.ReplicaRouter']
+DATABASE_REPLICA_ALIAS = 'replica'
+DATABASE_REPLICA_STICKY_SECONDS = 10
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -139,14 +154,73 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 MEDIA_URL = '/media/'
+# local files, with the time spent writing and reading them recorded as storage stages (image_api.storage)
+DEFAULT_FILE_STORAGE = 'image_api.storage.TimedFileSystemStorage'
+
+# Local media (non-production) is served by image_api.media.MediaView.
+# 'nginx' (X-Accel-Redirect to MEDIA_ACCEL_PREFIX, an internal location aliased to MEDIA_ROOT) or 'sendfile'
+# (X-Sendfile) let the front proxy send the bytes, unset streams them from Python
+MEDIA_ACCEL_REDIRECT = os.environ.get('MEDIA_ACCEL_REDIRECT') or None
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+MEDIA_REQUIRE_AUTHENTICATION = os.environ.get('MEDIA_REQUIRE_AUTHENTICATION', 'False') == 'True'
+MEDIA_CACHE_MAX_AGE = 24 * 60 * 60
+
+# Encoder effort of re-encoded images (image_api.util.image_util.ENCODER_PROFILES): fast, balanced, max-compression,
+# uploads can choose another one with the `encoder_profile` parameter
+IMAGE_ENCODER_PROFILE = os.environ.get('IMAGE_ENCODER_PROFILE', 'balanced')
+
+# Images above this many pixels are rejected from their header, before any decoding (also PIL's decompression bomb
+# limit for every image opened by the workers)
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 50 * 1000 * 1000))
+# Bytes the decoded pixels of one image may use while it is processed, larger JPEGs are decoded at a reduced scale,
+# other larger images are rejected
+IMAGE_MEMORY_BUDGET = int(os.environ.get('IMAGE_MEMORY_BUDGET', 512 * 1024 * 1024))
+
+# Formats of the variants served by image_api.media.ImageVariantView to clients that accept them, most preferred
+# first. AVIF needs a Pillow with an AVIF encoder (Pillow >= 11.2 or the pillow-avif-plugin package), it is skipped
+# otherwise
+IMAGE_VARIANT_FORMATS = ['avif', 'webp']
+IMAGE_VARIANT_REDIRECT_MAX_AGE = 60 * 60
+# Widths offered in the `srcset` of image responses, below the width of each image
+IMAGE_RENDITION_WIDTHS = [320, 640, 960, 1280, 1920]
+
+# Resumable chunked uploads (image_api.views.UploadSession*View), chunks are appended to a file in UPLOAD_SESSION_DIR
+# must be shared by every server handling the API when there is more than one
+UPLOAD_SESSION_DIR = os.environ.get('UPLOAD_SESSION_DIR', os.path.join(BASE_DIR, 'upload_sessions/'))
+UPLOAD_SESSION_TTL = 24 * 60 * 60  # seconds since the last chunk before a session expires
+UPLOAD_SESSION_FINALIZE_TIMEOUT = 10 * 60  # seconds before a finalize that never returned can be retried
+UPLOAD_SESSION_MAX_SIZE = 50 * 1024 * 1024
+UPLOAD_CHUNK_MAX_SIZE = 8 * 1024 * 1024
+
+# Responses of the upload and update endpoints are kept for this long under the client's Idempotency-Key
+# (image_api.idempotency), a retry with the same key gets the stored response instead of a second image
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+# a key whose request never stored its response (e.g. its worker was killed) is free again after this
+IDEMPOTENCY_PENDING_TIMEOUT = 10 * 60
+
+# False drops the upload and export rates below, e.g. for load tests (benchmarks/http_load.py)
+API_THROTTLING = os.environ.get('API_THROTTLING', 'True') == 'True'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
             "rest_framework_simplejwt.authentication.JWTAuthentication",
         ],
     'DEFAULT_PERMISSION_CLASSES': ['rest_framework.permissions.IsAuthenticated',],
+    # token buckets of image_api.throttling.RoleTokenBucketThrottle, `<scope>_<role>` with a `<scope>` fallback
+    'DEFAULT_THROTTLE_RATES': {
+        'upload_admin': '120/min',
+        'upload_user': '30/min',
+        'upload': '10/min',
+        'export_admin': '30/min',
+        'export': '10/min',
+    } if API_THROTTLING else {},
 }
 
+# Image processing running at once across all workers (through the cache), more uploads get 429 (0: no limit)
+PROCESSING_CONCURRENCY = int(os.environ.get('PROCESSING_CONCURRENCY', '4'))
+PROCESSING_SLOT_TIMEOUT = 120  # seconds, frees the slot of a worker killed while processing
+PROCESSING_RETRY_AFTER = 2
+
 
 CORS_ORIGIN_ALLOW_ALL = True
 CORS_ALLOW_CREDENTIALS = True
@@ -158,6 +232,23 @@ SIMPLE_JWT = {
 }
 
 
+# Fraction of requests instrumented with a Server-Timing header and a perf log line, off unless set
+# (e.g. PERF_SAMPLE_RATE=1 to profile every request locally)
+PERF_SAMPLE_RATE = float(os.environ.get('PERF_SAMPLE_RATE', '0'))
+
+# Postgres text search configuration used for the image list `q` parameter
+IMAGE_SEARCH_CONFIG = 'english'
+
+# Seconds before the in-process tag autocomplete index is fully reloaded from the database
+TAG_INDEX_TTL = 300
+
+# Images read (and written) per chunk by the NDJSON export endpoint and command
+EXPORT_CHUNK_SIZE = 2000
+
+# When set, /metrics requires the header "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -167,15 +258,37 @@ LOGGING = {
             'class': 'logging.StreamHandler',
             'formatter': 'custom',
         },
+        'perf': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'perf',
+        },
     },
     'formatters': {
         'custom': {
             'format': '[{asctime}] ({module}) {levelname}: {message}',
             'style': '{',
         },
+        'perf': {
+            'format': '{message}',
+            'style': '{',
+        },
+    },
+    'loggers': {
+        'image_api.perf': {
+            'handlers': ['perf'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'django.db.backends': {
+            'level': 'WARNING',
+        },
+        # PIL logs every PNG chunk at DEBUG, its warnings and errors still go through
+        'PIL': {
+            'level': 'INFO',
+        },
     },
     'root': {
         'handlers': ['console'],
-        'level': 'DEBUG',
+        'level': os.environ.get('LOG_LEVEL', 'INFO'),
     },
 }
@@ -14,6 +14,8 @@ from pathlib import Path
 import os
 import datetime
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -47,6 +49,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "image_api.middleware.MetricsMiddleware",
+    "image_api.middleware.PerfTimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
@@ -78,6 +82,11 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "image_backend.wsgi.application"
+ASGI_APPLICATION = "image_backend.asgi.application"
+
+# Serve list/retrieve/tag endpoints with async views, enable when running under an ASGI server. The Docker image runs
+# WSGI (gthread workers) with persistent connections, ASGI needs a connection pooler (see DATABASES)
+ASYNC_READ_VIEWS = os.environ.get('ASYNC_READ_VIEWS', 'False') == 'True'
 
 
 # Database
@@ -91,6 +100,13 @@ DATABASES = {
         'PASSWORD': os.environ.get('POSTGRES_DB_PASSWORD'),
         'HOST': os.environ.get('POSTGRES_DB_HOST'),
         'PORT': '5432',
+        # persistent connections per worker thread, checked before reuse. Not under ASGI (ASYNC_READ_VIEWS): every
+        # request runs its queries in its own thread, whose connection would stay open until its age runs out. Point
+        # POSTGRES_DB_HOST at a PgBouncer in transaction pooling mode there and set POSTGRES_PGBOUNCER=True
+        'CONN_MAX_AGE': int(os.environ.get('POSTGRES_CONN_MAX_AGE', '0' if ASYNC_READ_VIEWS else '300')),
+        'CONN_HEALTH_CHECKS': True,
+        # server-side cursors (.iterator()) don't survive transaction pooling, the pooler may switch connections
+        'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('POSTGRES_PGBOUNCER', 'False') == 'True',
     },
     'TEST': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -102,6 +118,19 @@ DATABASES = {
     },
 }
 
+if os.environ.get('POSTGRES_REPLICA_HOST'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST': os.environ.get('POSTGRES_REPLICA_HOST'),
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# Reads of the list/retrieve/tag endpoints go to the 'replica' alias when it is configured,
+# users who wrote within DATABASE_REPLICA_STICKY_SECONDS keep reading from the primary
+DATABASE_ROUTERS = ['image_api.db_router.ReplicaRouter']
+DATABASE_REPLICA_ALIAS = 'replica'
+DATABASE_REPLICA_STICKY_SECONDS = 10
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -139,13 +168,70 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 MEDIA_URL = '/media/'
 
+# Local media (non-production) is served by image_api.media.MediaView.
+# 'nginx' (X-Accel-Redirect to MEDIA_ACCEL_PREFIX, an internal location aliased to MEDIA_ROOT) or 'sendfile'
+# (X-Sendfile) let the front proxy send the bytes, unset streams them from Python
+MEDIA_ACCEL_REDIRECT = os.environ.get('MEDIA_ACCEL_REDIRECT') or None
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+MEDIA_REQUIRE_AUTHENTICATION = os.environ.get('MEDIA_REQUIRE_AUTHENTICATION', 'False') == 'True'
+MEDIA_CACHE_MAX_AGE = 24 * 60 * 60
+
+# Encoder effort of re-encoded images (image_api.util.image_util.ENCODER_PROFILES): fast, balanced, max-compression,
+# uploads can choose another one with the `encoder_profile` parameter
+IMAGE_ENCODER_PROFILE = os.environ.get('IMAGE_ENCODER_PROFILE', 'balanced')
+
+# Images above this many pixels are rejected from their header, before any decoding (also PIL's decompression bomb
+# limit for every image opened by the workers)
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 50 * 1000 * 1000))
+# Bytes the decoded pixels of one image may use while it is processed, larger JPEGs are decoded at a reduced scale,
+# other larger images are rejected
+IMAGE_MEMORY_BUDGET = int(os.environ.get('IMAGE_MEMORY_BUDGET', 512 * 1024 * 1024))
+
+# Formats of the variants served by image_api.media.ImageVariantView to clients that accept them, most preferred
+# first. AVIF needs a Pillow with an AVIF encoder (Pillow >= 11.2 or the pillow-avif-plugin package), it is skipped
+# otherwise
+IMAGE_VARIANT_FORMATS = ['avif', 'webp']
+IMAGE_VARIANT_REDIRECT_MAX_AGE = 60 * 60
+# Widths offered in the `srcset` of image responses, below the width of each image
+IMAGE_RENDITION_WIDTHS = [320, 640, 960, 1280, 1920]
+
+# Resumable chunked uploads (image_api.views.UploadSession*View), chunks are appended to a file in UPLOAD_SESSION_DIR
+# must be shared by every server handling the API when there is more than one
+UPLOAD_SESSION_DIR = os.environ.get('UPLOAD_SESSION_DIR', os.path.join(BASE_DIR, 'upload_sessions/'))
+UPLOAD_SESSION_TTL = 24 * 60 * 60  # seconds since the last chunk before a session expires
+UPLOAD_SESSION_FINALIZE_TIMEOUT = 10 * 60  # seconds before a finalize that never returned can be retried
+UPLOAD_SESSION_MAX_SIZE = 50 * 1024 * 1024
+UPLOAD_CHUNK_MAX_SIZE = 8 * 1024 * 1024
+
+# Responses of the upload and update endpoints are kept for this long under the client's Idempotency-Key
+# (image_api.idempotency), a retry with the same key gets the stored response instead of a second image
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+# a key whose request never stored its response (e.g. its worker was killed) is free again after this
+IDEMPOTENCY_PENDING_TIMEOUT = 10 * 60
+
+# False drops the upload and export rates below, e.g. for load tests (benchmarks/http_load.py)
+API_THROTTLING = os.environ.get('API_THROTTLING', 'True') == 'True'
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
             'rest_framework_simplejwt.authentication.JWTAuthentication',
         ],
     'DEFAULT_PERMISSION_CLASSES': ['rest_framework.permissions.IsAuthenticated',],
+    # token buckets of image_api.throttling.RoleTokenBucketThrottle, `<scope>_<role>` with a `<scope>` fallback
+    'DEFAULT_THROTTLE_RATES': {
+        'upload_admin': '120/min',
+        'upload_user': '30/min',
+        'upload': '10/min',
+        'export_admin': '30/min',
+        'export': '10/min',
+    } if API_THROTTLING else {},
 }
 
+# Image processing running at once across all workers (through the cache), more uploads get 429 (0: no limit)
+PROCESSING_CONCURRENCY = int(os.environ.get('PROCESSING_CONCURRENCY', '4'))
+PROCESSING_SLOT_TIMEOUT = 120  # seconds, frees the slot of a worker killed while processing
+PROCESSING_RETRY_AFTER = 2
+
 
 CORS_ORIGIN_ALLOW_ALL = True
 CORS_ALLOW_CREDENTIALS = True
@@ -166,9 +252,38 @@ AWS_S3_REGION_NAME = 'ap-northeast-1'
 AWS_DEFAULT_ACL = 'public-read'
 AWS_QUERYSTRING_AUTH = False
 AWS_S3_FILE_OVERWRITE = False
-DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
+# S3, with the time spent writing and reading objects recorded as storage stages (image_api.storage)
+DEFAULT_FILE_STORAGE = 'image_api.storage.TimedS3Boto3Storage'
 MEDIA_URL = f"https://{AWS_STORAGE_BUCKET_NAME}.s3.{AWS_S3_REGION_NAME}.amazonaws.com/"
 
+# Shared between gunicorn workers: upload/export token buckets, processing slots and replica stickiness only hold
+# across workers with a shared cache, a per-process memory cache would silently apply them per worker
+if not os.environ.get('REDIS_URL'):
+    raise ImproperlyConfigured('REDIS_URL is required in production, rate limits and replica stickiness need a cache '
+                               'shared by every worker.')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL'),
+    }
+}
+
+# Fraction of requests instrumented with a Server-Timing header and a perf log line
+PERF_SAMPLE_RATE = float(os.environ.get('PERF_SAMPLE_RATE', '0.1'))
+
+# Postgres text search configuration used for the image list `q` parameter
+IMAGE_SEARCH_CONFIG = 'english'
+
+# Seconds before the in-process tag autocomplete index is fully reloaded from the database
+TAG_INDEX_TTL = 300
+
+# Images read (and written) per chunk by the NDJSON export endpoint and command
+EXPORT_CHUNK_SIZE = 2000
+
+# When set, /metrics requires the header "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -178,15 +293,37 @@ LOGGING = {
             'class': 'logging.StreamHandler',
             'formatter': 'custom',
         },
+        'perf': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'perf',
+        },
     },
     'formatters': {
         'custom': {
             'format': '[{asctime}] ({module}) {levelname}: {message}',
             'style': '{',
         },
+        'perf': {
+            'format': '{message}',
+            'style': '{',
+        },
+    },
+    'loggers': {
+        'image_api.perf': {
+            'handlers': ['perf'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'django.db.backends': {
+            'level': 'WARNING',
+        },
+        # PIL logs every PNG chunk at DEBUG, its warnings and errors still go through
+        'PIL': {
+            'level': 'INFO',
+        },
     },
     'root': {
         'handlers': ['console'],
-        'level': 'DEBUG',
+        'level': os.environ.get('LOG_LEVEL', 'INFO'),
     },
 }
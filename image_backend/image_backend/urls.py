@@ -17,10 +17,16 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
-from django.conf.urls.static import static
+from image_api.media import MediaView
+from image_api.metrics import metrics_view
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", metrics_view, name="metrics"),
     path("image_api/image/", include("image_api.urls")),
     path("image_api/auth/", include("auth_api.urls"))
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
+
+# in production MEDIA_URL points at S3
+if not settings.IS_PRODUCTION:
+    urlpatterns.append(path(settings.MEDIA_URL.lstrip('/') + '<path:path>', MediaView.as_view(), name='media'))
@@ -0,0 +1,48 @@
+"""
+Gunicorn worker classes and helpers, see gunicorn.conf.py.
+"""
+import os
+import signal
+
+from uvicorn_worker import UvicornWorker
+
+
+def max_worker_rss():
+    """GUNICORN_MAX_WORKER_RSS_MB in bytes, 0 when workers are never recycled for their memory."""
+    return int(os.environ.get('GUNICORN_MAX_WORKER_RSS_MB', '0')) * 1024 * 1024
+
+
+def current_rss():
+    """Resident memory of this process in bytes, 0 where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return 0
+
+
+class RecyclingUvicornWorker(UvicornWorker):
+    """
+    UvicornWorker replaced once its resident memory is above GUNICORN_MAX_WORKER_RSS_MB.
+
+    Decoding large images leaves the heap fragmented and the memory is rarely given back to the system. The memory is
+    checked on the worker heartbeat (every `timeout` seconds), a worker above the limit is sent SIGTERM: uvicorn stops
+    accepting connections, finishes the requests in flight and exits, then the arbiter starts a new worker.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_rss = max_worker_rss()
+
+    async def callback_notify(self):
+        await super().callback_notify()
+        self.recycle_if_over_rss()
+
+    def recycle_if_over_rss(self):
+        if not self.max_rss or not self.alive:
+            return
+        rss = current_rss()
+        if rss > self.max_rss:
+            self.log.info(f'Worker {self.pid} uses {rss // 2 ** 20}MB, restarting')
+            self.alive = False
+            os.kill(os.getpid(), signal.SIGTERM)